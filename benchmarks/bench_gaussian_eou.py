@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+bench_gaussian_eou.py
+=====================
+
+Time and peak memory needed to write a frequency-step ``*.EOu`` file
+(energy, gradients and Hessian) with the former row-by-row
+``str.format`` implementation and with the streaming
+``write_gaussian_EOu``. Both outputs are checked to be identical.
+If Garleek is not installed, the copy in this source tree is used.
+
+    python benchmarks/bench_gaussian_eou.py [n_atoms ...]
+"""
+
+from __future__ import print_function, absolute_import, division
+import os
+import sys
+import time
+from tempfile import mkdtemp
+
+import numpy as np
+
+try:
+    import garleek  # noqa
+except ImportError:  # run from a source checkout
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from garleek.qm.gaussian import write_gaussian_EOu
+
+
+def format_EOu(n_atoms, energy, dipole_moment, gradients=None, hessian=None):
+    """
+    The original ``prepare_gaussian_EOu`` implementation, kept here
+    as the reference.
+    """
+    lines = [[energy] + list(dipole_moment)]
+    template = '{: 20.12e}'
+    for gradient in gradients:
+        lines.append(gradient)
+    polarizability, dipole_polarizability = np.zeros(6), np.zeros(9*n_atoms)
+    for i in range(0, polarizability.size, 3):
+        lines.append(polarizability[i:i+3])
+    for i in range(0, dipole_polarizability.size, 3):
+        lines.append(dipole_polarizability[i:i+3])
+    for i in range(0, hessian.size, 3):
+        lines.append(hessian[i:i+3])
+    lines.append([])
+    return '\n'.join([(template*len(line)).format(*line) for line in lines])
+
+
+def measure(function):
+    """
+    Wall time (s) and peak of memory allocated by Python (MB). Memory
+    is traced in a second run, since tracing slows everything down.
+    The peak is None where :mod:`tracemalloc` is not available.
+    """
+    t0 = time.time()
+    function()
+    elapsed = time.time() - t0
+    try:
+        import tracemalloc
+    except ImportError:  # Python 2
+        return elapsed, None
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak / 2**20
+
+
+def main(sizes=(100, 500, 1000)):
+    tmp = mkdtemp(prefix='garleek-bench')
+    old_path, new_path = os.path.join(tmp, 'old.EOu'), os.path.join(tmp, 'new.EOu')
+    print('{:>6} {:>10} {:>10} {:>10} {:>12} {:>12}'.format(
+          'atoms', 'elements', 'old (s)', 'new (s)', 'old (MB)', 'new (MB)'))
+    for n_atoms in sizes:
+        rng = np.random.RandomState(n_atoms)
+        gradients = rng.randn(n_atoms, 3)
+        hessian = rng.randn(3*n_atoms*(3*n_atoms+1)//2)
+
+        def old():
+            with open(old_path, 'w') as f:
+                f.write(format_EOu(n_atoms, -1.0, np.ones(3), gradients, hessian))
+
+        def new():
+            write_gaussian_EOu(new_path, n_atoms, -1.0, np.ones(3), gradients, hessian)
+
+        t_old, m_old = measure(old)
+        t_new, m_new = measure(new)
+        with open(old_path, 'rb') as f_old, open(new_path, 'rb') as f_new:
+            assert f_old.read() == f_new.read(), 'outputs differ!'
+        print('{:>6} {:>10} {:>10.3f} {:>10.3f} {:>12} {:>12}'.format(
+              n_atoms, hessian.size, t_old, t_new,
+              *['-' if m is None else '{:.1f}'.format(m) for m in (m_old, m_new)]))
+    for path in old_path, new_path:
+        os.remove(path)
+    os.rmdir(tmp)
+
+
+if __name__ == '__main__':
+    main([int(n) for n in sys.argv[1:]] or (100, 500, 1000))
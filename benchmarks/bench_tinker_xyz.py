@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+bench_tinker_xyz.py
+===================
+
+Compare ``prepare_tinker_xyz`` (dict based, one ``str.format`` call per
+atom) against ``write_tinker_xyz`` (array based, bulk formatting) on
+synthetic linear alkanes of growing size. If Garleek is not installed,
+the copy in this source tree is used.
+
+    python benchmarks/bench_tinker_xyz.py [n_atoms ...]
+"""
+
+from __future__ import print_function, absolute_import, division
+import os
+import sys
+import time
+from tempfile import mkdtemp
+
+import numpy as np
+
+try:
+    import garleek  # noqa
+except ImportError:  # run from a source checkout
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from garleek.qm.gaussian import GaussianEIn
+from garleek.mm.tinker import prepare_tinker_xyz, write_tinker_xyz
+
+
+def synthetic_ein(n_atoms):
+    """
+    A chain of ``n_atoms`` carbon atoms, 1.5 A apart, with
+    single bonds between neighbours.
+    """
+    xyz = np.zeros((n_atoms, 3))
+    xyz[:, 0] = np.arange(n_atoms) * 2.83
+    neighbours = [[j for j in (i - 1, i + 1) if 0 <= j < n_atoms] for i in range(n_atoms)]
+    bond_indptr = np.zeros(n_atoms + 1, dtype=int)
+    bond_indptr[1:] = np.cumsum([len(n) for n in neighbours])
+    bond_indices = np.array([j + 1 for n in neighbours for j in n])
+    return GaussianEIn(n_atoms, 1, 0, 1, np.array(['6'] * n_atoms), np.array(['1'] * n_atoms),
+                       xyz, np.zeros(n_atoms), bond_indptr, bond_indices,
+                       np.ones(bond_indices.size))
+
+
+def best_of(function, repeat=3):
+    timings = []
+    for _ in range(repeat):
+        t0 = time.time()
+        function()
+        timings.append(time.time() - t0)
+    return min(timings)
+
+
+def main(sizes=(1000, 10000, 100000)):
+    tmp = mkdtemp(prefix='garleek-bench')
+    path = os.path.join(tmp, 'bench.xyz')
+    print('{:>8} {:>12} {:>12} {:>8}'.format('atoms', 'format (s)', 'bulk (s)', 'speedup'))
+    for n_atoms in sizes:
+        ein = synthetic_ein(n_atoms)
+        atoms, bonds = ein['atoms'], ein['bonds']  # not part of the timings
+
+        def old():
+            with open(path, 'w') as f:
+                f.write(prepare_tinker_xyz(atoms, bonds))
+
+        def new():
+            write_tinker_xyz(path, ein.elements, ein.types, ein.xyz,
+                             ein.bond_indptr, ein.bond_indices, ein.bond_orders)
+
+        t_old, t_new = best_of(old), best_of(new)
+        print('{:>8} {:>12.4f} {:>12.4f} {:>7.1f}x'.format(n_atoms, t_old, t_new, t_old / t_new))
+    os.remove(path)
+    os.rmdir(tmp)
+
+
+if __name__ == '__main__':
+    main([int(n) for n in sys.argv[1:]] or (1000, 10000, 100000))
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+suite.py
+========
+
+Benchmark suite of the hot paths of a ``garleek-backend`` call, with a
+stored baseline to catch performance regressions between releases.
+
+Each benchmark runs on the synthetic polyglycine chains of
+``synthetic.py``, at every requested size:
+
+- ``patch``: ``GaussianPatcher.patch`` on the ONIOM input
+- ``parse_ein_<version>``: ``parse_gaussian_EIn`` for every supported
+  connectivity layout
+- ``prepare_tinker_xyz`` and ``write_tinker_xyz``
+- ``parse_analyze``, ``parse_testgrad`` and ``parse_testhess``, on
+  outputs written by the TINKER stand-in (:mod:`garleek.mm.tinker_standin`)
+- ``prepare_gaussian_EOu``, with gradients and, up to ``--max-hessian``
+  atoms, the Hessian. ``parse_testhess`` is limited likewise.
+
+Times are the best of ``--repeat`` runs; peak memory is the peak of
+memory allocated by Python (including numpy arrays) in one more run
+under :mod:`tracemalloc`.
+
+    python benchmarks/suite.py run [--output FILE]
+    python benchmarks/suite.py record [--baseline FILE]
+    python benchmarks/suite.py compare [--baseline FILE] [--results FILE] [--threshold 0.25]
+
+``record`` (re)writes the baseline, ``benchmarks/baseline.json`` by
+default. ``compare`` runs the suite (or loads the results of a previous
+``run``) and exits with status 1 if any benchmark is slower than the
+baseline by more than ``--threshold`` (relative), or needs more memory
+than ``--memory-threshold`` allows. Differences under ``--min-time``
+seconds are ignored as noise. Baselines are only comparable on the
+same machine.
+
+If Garleek is not installed, the copy in this source tree is used; set
+``$PYTHONPATH`` to benchmark another one. Record the baseline from a
+separate checkout of the reference version, never from the tree it is
+meant to check, or a regression ends up in the baseline too::
+
+    git worktree add /tmp/garleek-ref <reference commit>
+    PYTHONPATH=/tmp/garleek-ref python benchmarks/suite.py record
+    python benchmarks/suite.py compare
+
+``compare`` reports both Garleek versions, and warns if they are the same.
+"""
+
+from __future__ import print_function, absolute_import, division
+import gc
+import json
+import os
+import platform
+import shutil
+import sys
+import time
+from argparse import ArgumentParser
+from tempfile import mkdtemp
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+try:
+    from StringIO import StringIO
+except ImportError:  # Python 3
+    from io import StringIO
+
+import numpy as np
+
+try:
+    import garleek  # noqa
+except ImportError:  # run from a source checkout
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from garleek import _get_version
+from garleek.atom_types import parse as parse_atom_types
+from garleek.mm import tinker_standin
+from garleek.mm.tinker import (prepare_tinker_xyz, write_tinker_xyz, _parse_tinker_analyze,
+                               _parse_tinker_testgrad, _parse_tinker_testhess)
+from garleek.qm.gaussian import (GaussianPatcher, parse_gaussian_EIn, prepare_gaussian_EOu,
+                                 supported_versions)
+
+from synthetic import build_system, write_atom_types, write_ein, write_gaussian_input
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASELINE = os.path.join(HERE, 'baseline.json')
+SIZES = 100, 1000, 10000
+MAX_HESSIAN = 1000
+_clock = getattr(time, 'perf_counter', time.time)
+
+
+def measure(function, setup=None, repeat=5):
+    """
+    Best wall time (s) of ``repeat`` runs and peak of memory allocated
+    by Python (MB) in one more, traced, run. ``setup`` is called before
+    each run, outside the measurements.
+    """
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        gc.collect()
+        t0 = _clock()
+        function()
+        timings.append(_clock() - t0)
+    peak = None
+    if tracemalloc is not None:
+        if setup is not None:
+            setup()
+        tracemalloc.start()
+        function()
+        peak = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    return min(timings), peak
+
+
+def _tinker_output(program, xyz_file):
+    out = StringIO()
+    tinker_standin.run(program, [xyz_file, 'garleek.key'] + (['E'] if program == 'analyze' else []),
+                       stdout=out)
+    return out.getvalue()
+
+
+def benchmarks(n_atoms, directory, max_hessian=MAX_HESSIAN):
+    """
+    Prepare the inputs for a system of about ``n_atoms`` atoms in
+    ``directory`` and yield ``(name, function, setup)`` for each
+    benchmark.
+    """
+    system = build_system(n_atoms, kind='chain')
+    hessian_too = n_atoms <= max_hessian
+    n_atoms = len(system['xyz'])
+    base = os.path.join(directory, 'chain')
+    gaussian_input = write_gaussian_input(base + '.in', system)
+    types = parse_atom_types(write_atom_types(base + '.types', system))
+    yield 'patch', lambda: GaussianPatcher(gaussian_input, types).patch(), None
+
+    eins = dict((v, write_ein('{}_{}.EIn'.format(base, v), system, v)) for v in supported_versions)
+    for version in supported_versions:
+        yield ('parse_ein_' + version,
+               lambda version=version: parse_gaussian_EIn(eins[version], version=version), None)
+
+    ein = parse_gaussian_EIn(eins['16'])
+    atoms, bonds = ein['atoms'], ein['bonds']
+    xyz_file = base + '.xyz'
+    yield 'prepare_tinker_xyz', lambda: prepare_tinker_xyz(atoms, bonds), None
+    yield 'write_tinker_xyz', lambda: write_tinker_xyz(
+        xyz_file, ein.elements, ein.types, ein.xyz,
+        ein.bond_indptr, ein.bond_indices, ein.bond_orders), None
+
+    analyze = _tinker_output('analyze', xyz_file)
+    testgrad = _tinker_output('testgrad', xyz_file)
+    yield 'parse_analyze', lambda: _parse_tinker_analyze(analyze), None
+    yield 'parse_testgrad', lambda: _parse_tinker_testgrad(testgrad, n_atoms), None
+
+    rng = np.random.RandomState(n_atoms)
+    gradients = rng.randn(n_atoms, 3)
+    yield 'prepare_gaussian_EOu', lambda: prepare_gaussian_EOu(
+        n_atoms, -1.0, np.ones(3), gradients), None
+    if not hessian_too:
+        return
+
+    hes_file = base + '.hes'
+    reference = tinker_standin.write_hes(base + '.reference.hes', *tinker_standin.read_tinker_xyz(
+                                         xyz_file)[::2])
+    yield ('parse_testhess', lambda: _parse_tinker_testhess(hes_file, n_atoms),
+           lambda: shutil.copyfile(reference, hes_file))  # the parser removes it
+    hessian = rng.randn(3 * n_atoms * (3 * n_atoms + 1) // 2)
+    yield 'prepare_gaussian_EOu_hessian', lambda: prepare_gaussian_EOu(
+        n_atoms, -1.0, np.ones(3), gradients, hessian), None
+
+
+def run(sizes=SIZES, repeat=5, max_hessian=MAX_HESSIAN, verbose=True):
+    """
+    Run the suite. Returns a dict with the ``results``, keyed by
+    ``<benchmark>/<atoms>``, and a description of the ``environment``.
+    """
+    results = {}
+    for n_atoms in sizes:
+        directory = mkdtemp(prefix='garleek-bench')
+        try:
+            for name, function, setup in benchmarks(n_atoms, directory, max_hessian):
+                elapsed, peak = measure(function, setup, repeat)
+                key = '{}/{}'.format(name, n_atoms)
+                results[key] = {'time': round(elapsed, 6),
+                                'peak_mb': None if peak is None else round(peak, 3)}
+                if verbose:
+                    print('{:<36} {:>10.4f} s {:>10} MB'.format(
+                          key, elapsed, '-' if peak is None else '{:.1f}'.format(peak)))
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+    return {
+        'environment': {'garleek': _get_version(), 'python': platform.python_version(),
+                        'numpy': np.__version__, 'machine': platform.machine(),
+                        'date': time.strftime('%Y-%m-%d')},
+        'settings': {'sizes': list(sizes), 'repeat': repeat, 'max_hessian': max_hessian},
+        'results': results,
+    }
+
+
+def compare(baseline, current, threshold=0.25, memory_threshold=0.25, min_time=0.01):
+    """
+    Compare two :func:`run` outputs.
+
+    Returns
+    -------
+    rows : list of tuple
+        ``(key, baseline time, current time, baseline MB, current MB, status)``
+        for every benchmark in both, where ``status`` is ``'ok'``,
+        ``'slower'``, ``'memory'`` or ``'new'``/``'missing'``.
+    regressions : int
+        Number of benchmarks that regressed beyond the thresholds
+    """
+    rows, regressions = [], 0
+    old, new = baseline['results'], current['results']
+    for key in sorted(set(old) | set(new), key=_sort_key):
+        if key not in old or key not in new:
+            b, c = old.get(key, {}), new.get(key, {})
+            rows.append((key, b.get('time'), c.get('time'), b.get('peak_mb'), c.get('peak_mb'),
+                         'new' if key not in old else 'missing'))
+            continue
+        b, c = old[key], new[key]
+        status = 'ok'
+        if c['time'] - b['time'] > max(min_time, threshold * b['time']):
+            status = 'slower'
+        elif (b['peak_mb'] is not None and c['peak_mb'] is not None and
+              c['peak_mb'] - b['peak_mb'] > max(1.0, memory_threshold * b['peak_mb'])):
+            status = 'memory'
+        if status != 'ok':
+            regressions += 1
+        rows.append((key, b['time'], c['time'], b['peak_mb'], c['peak_mb'], status))
+    return rows, regressions
+
+
+def _sort_key(key):
+    name, n_atoms = key.rsplit('/', 1)
+    return name, int(n_atoms)
+
+
+def format_comparison(rows):
+    def number(value, template):
+        return '-' if value is None else template.format(value)
+
+    out = ['{:<36} {:>10} {:>10} {:>8} {:>9} {:>9}  {}'.format(
+           'benchmark', 'base (s)', 'now (s)', 'ratio', 'base (MB)', 'now (MB)', 'status')]
+    for key, t_old, t_new, m_old, m_new, status in rows:
+        ratio = t_new / t_old if t_old and t_new is not None else None
+        out.append('{:<36} {:>10} {:>10} {:>8} {:>9} {:>9}  {}'.format(
+                   key, number(t_old, '{:.4f}'), number(t_new, '{:.4f}'),
+                   number(ratio, '{:.2f}x'), number(m_old, '{:.1f}'), number(m_new, '{:.1f}'),
+                   status))
+    return '\n'.join(out)
+
+
+def _dump(data, path):
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+        f.write('\n')
+
+
+def main(argv=None):
+    p = ArgumentParser(description='Garleek benchmark suite')
+    p.add_argument('command', choices=('run', 'record', 'compare'))
+    p.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    p.add_argument('--repeat', type=int, default=5)
+    p.add_argument('--max-hessian', type=int, default=MAX_HESSIAN,
+                   help='Largest system for the Hessian benchmarks')
+    p.add_argument('--baseline', default=BASELINE)
+    p.add_argument('--output', help='Write the results of `run` to this JSON file')
+    p.add_argument('--results', help='For `compare`: results of a previous `run`, '
+                   'instead of running the suite again')
+    p.add_argument('--threshold', type=float, default=0.25,
+                   help='Allowed relative slowdown')
+    p.add_argument('--memory-threshold', type=float, default=0.25,
+                   help='Allowed relative increase of peak memory')
+    p.add_argument('--min-time', type=float, default=0.01,
+                   help='Slowdowns below this many seconds are ignored')
+    args = p.parse_args(argv)
+
+    if args.command == 'compare' and args.results:
+        with open(args.results) as f:
+            current = json.load(f)
+    else:
+        current = run(args.sizes, args.repeat, args.max_hessian)
+    if args.command == 'run':
+        if args.output:
+            _dump(current, args.output)
+        return 0
+    if args.command == 'record':
+        _dump(current, args.baseline)
+        print('Baseline written to', args.baseline)
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    rows, regressions = compare(baseline, current, args.threshold, args.memory_threshold,
+                                args.min_time)
+    versions = baseline['environment']['garleek'], current['environment']['garleek']
+    print('\nBaseline: garleek {} ({}); now: garleek {}'.format(
+          versions[0], baseline['environment']['date'], versions[1]))
+    if versions[0] == versions[1]:
+        print('WARNING: the baseline was recorded from this same version')
+    print()
+    print(format_comparison(rows))
+    if regressions:
+        print('\n{} benchmark(s) regressed beyond the thresholds'.format(regressions))
+        return 1
+    print('\nNo regressions')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+synthetic.py
+============
+
+Scalable synthetic ONIOM systems, from a hundred to a few hundred
+thousand atoms, to benchmark Garleek at production scale:
+
+- ``chain``: a polyglycine chain folded in a serpentine, so it stays
+  compact at any length.
+- ``box``: a short polyglycine solute in a box of TIP3P-like waters.
+
+In both, the first ``qm_residues`` residues make the QM (high) layer and
+the rest is MM (low). The bond that crosses the boundary gets a link
+atom. For each system this writes:
+
+- a Gaussian ONIOM input with layers, link atoms, connectivity and PDB
+  residue info, ready for ``garleek`` / ``GaussianPatcher``
+- the matching atom types file (QM ``<ResName>_<type>`` to MM3 type)
+- the EIn file Gaussian would write for a real-system step, with MM
+  atom types and connectivity in each requested ``version`` layout
+
+Geometries are built from ideal fragments on a grid (a seeded random
+generator orients the waters), so they are reproducible but not
+relaxed. Bonds at the serpentine turns are stretched.
+
+    python benchmarks/synthetic.py [--kind chain|box] [n_atoms ...]
+    python benchmarks/synthetic.py --write DIRECTORY [--kind chain|box] [n_atoms ...]
+
+Without ``--write``, the time needed to patch the input and to parse
+the EIn files is reported. If Garleek is not installed, the copy in
+this source tree is used.
+"""
+
+from __future__ import print_function, absolute_import, division
+import os
+import sys
+import time
+from argparse import ArgumentParser
+from tempfile import mkdtemp
+
+import numpy as np
+
+try:
+    import garleek  # noqa
+except ImportError:  # run from a source checkout
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from garleek import units as u
+from garleek.atom_types import ELEMENTS
+from garleek.qm.gaussian import GaussianPatcher, parse_gaussian_EIn
+
+
+# Glycine residue: PDB name, element, QM (Amber-like) type, MM3 type, charge, xyz (A)
+RESIDUE = [
+    ('N',   'N', 'N',  '9',  -0.4157, (0.000,  0.000,  0.000)),
+    ('H',   'H', 'H',  '28',  0.2719, (-0.450, -0.900,  0.000)),
+    ('CA',  'C', 'CT', '1',  -0.0252, (1.460,  0.000,  0.000)),
+    ('HA2', 'H', 'H1', '5',   0.0698, (1.820, -0.520,  0.890)),
+    ('HA3', 'H', 'H1', '5',   0.0698, (1.820, -0.520, -0.890)),
+    ('C',   'C', 'C',  '3',   0.5973, (2.550,  0.900,  0.000)),
+    ('O',   'O', 'O',  '7',  -0.5679, (2.300,  2.100,  0.000)),
+]
+RESIDUE_BONDS = [(0, 1, 1.0), (0, 2, 1.0), (2, 3, 1.0), (2, 4, 1.0), (2, 5, 1.0), (5, 6, 2.0)]
+PEPTIDE_BOND = 5, 0  # C of residue i, N of residue i+1
+RESIDUE_LENGTH = 3.6
+ROW_SPACING = 6.0, 5.0  # between serpentine rows (y) and planes (z)
+
+WATER = [
+    ('O',  'O', 'OW', '75', -0.834, (0.000, 0.000, 0.000)),
+    ('H1', 'H', 'HW', '21',  0.417, (0.957, 0.000, 0.000)),
+    ('H2', 'H', 'HW', '21',  0.417, (-0.240, 0.927, 0.000)),
+]
+WATER_BONDS = [(0, 1, 1.0), (0, 2, 1.0)]
+WATER_SPACING = 3.1  # A, close to the density of liquid water
+LINK = 'H', 'H1', '5'  # element, QM type and MM3 type of link atoms
+
+KINDS = 'chain', 'box'
+EIN_VERSIONS = '16', '09a'
+
+
+def _template(fragment):
+    names, elements, types, mm_types, charges, xyz = zip(*fragment)
+    return (np.array(names), np.array(elements), np.array(types), np.array(mm_types),
+            np.array(charges), np.array(xyz, dtype=float))
+
+
+def _serpentine(n_residues):
+    """
+    Origin of each residue, and whether it runs backwards (odd rows)
+    """
+    per_row = max(1, int(np.ceil(np.sqrt(n_residues))))
+    rows_per_plane = per_row
+    index = np.arange(n_residues)
+    row, column = np.divmod(index, per_row)
+    plane, row_in_plane = np.divmod(row, rows_per_plane)
+    backwards = row % 2 == 1
+    x = np.where(backwards, (per_row - column) * RESIDUE_LENGTH, column * RESIDUE_LENGTH)
+    origins = np.column_stack([x, row_in_plane * ROW_SPACING[0], plane * ROW_SPACING[1]])
+    return origins, backwards
+
+
+def _random_rotations(rng, n):
+    q = rng.randn(n, 4)
+    q /= np.sqrt((q * q).sum(axis=1))[:, None]
+    w, x, y, z = q.T
+    return np.stack([
+        np.stack([1 - 2*(y*y + z*z), 2*(x*y - z*w), 2*(x*z + y*w)], axis=-1),
+        np.stack([2*(x*y + z*w), 1 - 2*(x*x + z*z), 2*(y*z - x*w)], axis=-1),
+        np.stack([2*(x*z - y*w), 2*(y*z + x*w), 1 - 2*(x*x + y*y)], axis=-1)], axis=1)
+
+
+def _peptide(n_residues):
+    names, elements, types, mm_types, charges, local = _template(RESIDUE)
+    size = len(RESIDUE)
+    origins, backwards = _serpentine(n_residues)
+    mirror = np.where(backwards, -1.0, 1.0)[:, None, None] * np.array([1.0, 0, 0]) \
+        + np.array([0, 1.0, 1.0])
+    xyz = (origins[:, None, :] + local[None] * mirror).reshape(-1, 3)
+    offsets = np.arange(n_residues) * size
+    bonds = [(offsets[:, None] + a, offsets[:, None] + b, np.full((n_residues, 1), o))
+             for (a, b, o) in RESIDUE_BONDS]
+    bonds.append((offsets[:-1, None] + PEPTIDE_BOND[0], offsets[1:, None] + PEPTIDE_BOND[1],
+                  np.ones((n_residues - 1, 1))))
+    return {
+        'names': np.tile(names, n_residues), 'elements': np.tile(elements, n_residues),
+        'types': np.tile(types, n_residues), 'mm_types': np.tile(mm_types, n_residues),
+        'charges': np.tile(charges, n_residues), 'xyz': xyz,
+        'resnames': np.full(n_residues * size, 'GLY'),
+        'resnums': np.repeat(np.arange(1, n_residues + 1), size),
+        'bonds': np.column_stack([np.concatenate([a.ravel() for (a, _, _) in bonds]),
+                                  np.concatenate([b.ravel() for (_, b, _) in bonds])]),
+        'orders': np.concatenate([o.ravel() for (_, _, o) in bonds]),
+    }
+
+
+def _waters(n_waters, exclude_min, exclude_max, rng):
+    """
+    ``n_waters`` molecules on a grid around the excluded box
+    (the solute), filling a cube
+    """
+    names, elements, types, mm_types, charges, local = _template(WATER)
+    center = (exclude_min + exclude_max) / 2
+    extent = exclude_max - exclude_min + 2 * WATER_SPACING
+    side = int(np.ceil((n_waters + np.prod(extent / WATER_SPACING)) ** (1 / 3))) + 1
+    grid = (np.indices((side, side, side)).reshape(3, -1).T - (side - 1) / 2) * WATER_SPACING
+    grid = grid + center
+    inside = np.all((grid > exclude_min - WATER_SPACING) & (grid < exclude_max + WATER_SPACING),
+                    axis=1)
+    grid = grid[~inside]
+    grid = grid[np.argsort(np.abs(grid - center).max(axis=1), kind='mergesort')[:n_waters]]
+    xyz = (grid[:, None, :] + np.einsum('nij,aj->nai', _random_rotations(rng, len(grid)), local))
+    n = len(grid)
+    offsets = np.arange(n) * len(WATER)
+    return {
+        'names': np.tile(names, n), 'elements': np.tile(elements, n),
+        'types': np.tile(types, n), 'mm_types': np.tile(mm_types, n),
+        'charges': np.tile(charges, n), 'xyz': xyz.reshape(-1, 3),
+        'resnames': np.full(n * len(WATER), 'WAT'),
+        'resnums': np.repeat(np.arange(1, n + 1), len(WATER)),
+        'bonds': np.concatenate([np.column_stack([offsets + a, offsets + b])
+                                 for (a, b, _) in WATER_BONDS]),
+        'orders': np.concatenate([np.full(n, o) for (_, _, o) in WATER_BONDS]),
+    }
+
+
+def build_system(n_atoms, kind='chain', qm_residues=2, solute_residues=10, seed=0):
+    """
+    Build a synthetic system with about ``n_atoms`` atoms.
+
+    Returns
+    -------
+    system : dict of arrays
+        ``names``, ``elements``, ``types`` (QM), ``mm_types``, ``charges``,
+        ``xyz`` (A), ``resnames``, ``resnums`` and ``layers`` per atom;
+        ``bonds`` (B, 2), 0-based, and their ``orders``; ``links``, a dict
+        mapping each MM atom bonded to the QM layer to its QM partner.
+    """
+    if kind not in KINDS:
+        raise ValueError('`kind` must be one of {}'.format(', '.join(KINDS)))
+    if kind == 'chain':
+        system = _peptide(max(qm_residues + 1, int(round(n_atoms / len(RESIDUE)))))
+    else:
+        solute = _peptide(max(qm_residues + 1, solute_residues))
+        n_waters = max(0, (n_atoms - len(solute['xyz'])) // len(WATER))
+        water = _waters(n_waters, solute['xyz'].min(axis=0), solute['xyz'].max(axis=0),
+                        np.random.RandomState(seed))
+        water['resnums'] += solute['resnums'][-1]
+        water['bonds'] += len(solute['xyz'])
+        system = dict((key, np.concatenate([solute[key], water[key]])) for key in solute)
+    n_qm = qm_residues * len(RESIDUE)
+    system['layers'] = np.where(np.arange(len(system['xyz'])) < n_qm, 'H', 'L')
+    bonds = system['bonds']
+    crossing = (bonds[:, 0] < n_qm) != (bonds[:, 1] < n_qm)
+    system['links'] = dict((int(b.max()), int(b.min())) for b in bonds[crossing])
+    return system
+
+
+def atom_types(system):
+    """
+    QM to MM atom types mapping of ``system``, as ``garleek`` expects
+    it (``<ResName>_<type>`` keys, uppercased)
+    """
+    mapping = dict(('{}_{}'.format(r, t).upper(), m) for (r, t, m) in
+                   set(zip(system['resnames'], system['types'], system['mm_types'])))
+    mapping[LINK[1].upper()] = LINK[2]
+    return mapping
+
+
+def write_atom_types(path, system):
+    with open(path, 'w') as f:
+        f.write('# Synthetic system types: QM type, MM3 type\n')
+        for key, value in sorted(atom_types(system).items()):
+            f.write('{} {}\n'.format(key, value))
+    return path
+
+
+def _upper_neighbours(system):
+    """
+    For each atom, the (1-based) bonded atoms with higher index and
+    the bond orders, as in Gaussian's connectivity input
+    """
+    bonds, orders = np.sort(system['bonds'], axis=1), system['orders']
+    lists = [[] for _ in range(len(system['xyz']))]
+    for (a, b), order in zip(bonds.tolist(), orders.tolist()):
+        lists[a].append(' {} {:.1f}'.format(b + 1, order))
+    return lists
+
+
+def write_gaussian_input(path, system, title=None):
+    """
+    Write a Gaussian ONIOM input for ``system``, with PDB residue info
+    """
+    n_atoms = len(system['xyz'])
+    title = title or 'Synthetic system with {} atoms'.format(n_atoms)
+    links = system['links']
+    lines = ['%mem=8000MB\n',
+             '#p oniom(B3LYP/6-31G*:external=garleek) geom=connectivity nosymm\n',
+             '\n', title + '\n', '\n', '0 1 0 1 0 1\n']
+    for i, (name, element, atom_type, charge, (x, y, z), resname, resnum, layer) in enumerate(zip(
+            system['names'], system['elements'], system['types'], system['charges'],
+            system['xyz'].tolist(), system['resnames'], system['resnums'], system['layers'])):
+        line = ' {}-{}-{:.4f}(PDBName={},ResName={},ResNum={}) 0 {:14.8f} {:14.8f} {:14.8f} {}'.format(
+               element, atom_type, charge, name, resname, resnum, x, y, z, layer)
+        if i in links:
+            line += ' {}-{} {}'.format(LINK[0], LINK[1], links[i] + 1)
+        lines.append(line + '\n')
+    lines.append('\n')
+    for i, neighbours in enumerate(_upper_neighbours(system)):
+        lines.append(' {}{}\n'.format(i + 1, ''.join(neighbours)))
+    lines.append('\n')
+    with open(path, 'w') as f:
+        f.write(''.join(lines))
+    return path
+
+
+def write_ein(path, system, version='16', derivatives=1):
+    """
+    Write the EIn file Gaussian would pass to Garleek for a real-system
+    step of ``system`` (coordinates in bohr, MM atom types), with the
+    connectivity in the layout of Gaussian ``version``.
+    """
+    n_atoms = len(system['xyz'])
+    numbers = [ELEMENTS[e] for e in system['elements']]
+    xyz = system['xyz'] * u.ANGSTROM_TO_RBOHR
+    lines = ['{:10d}{:10d}{:10d}{:10d}\n'.format(n_atoms, derivatives, 0, 1)]
+    lines += ['%10d%20.12f%20.12f%20.12f%20.12f %s\n' % (n, x, y, z, q, t) for (n, (x, y, z), q, t)
+              in zip(numbers, xyz.tolist(), system['charges'].tolist(), system['mm_types'])]
+    neighbours = [[] for _ in range(n_atoms)]
+    for (a, b), order in zip(system['bonds'].tolist(), system['orders'].tolist()):
+        neighbours[a].append(' {} {:.3f}'.format(b + 1, order))
+        neighbours[b].append(' {} {:.3f}'.format(a + 1, order))
+    if version in ('09d', '16'):
+        lines.append('Connectivity\n')
+        lines += [' {}{}\n'.format(i + 1, ''.join(n)) for (i, n) in enumerate(neighbours)]
+    elif version in ('09a', '09b', '09c'):
+        lines += [' Bond {0} x x x {0}{1}\n'.format(i + 1, ''.join(n))
+                  for (i, n) in enumerate(neighbours)]
+    else:
+        raise ValueError('Unknown EIn layout for Gaussian {}'.format(version))
+    lines.append(' \n')
+    with open(path, 'w') as f:
+        f.write(''.join(lines))
+    return path
+
+
+def write_system(directory, n_atoms, kind='chain', versions=EIN_VERSIONS, **kwargs):
+    """
+    Write the Gaussian input, atom types and EIn files (one per version)
+    of a synthetic system to ``directory``. Returns their paths.
+    """
+    system = build_system(n_atoms, kind=kind, **kwargs)
+    base = os.path.join(directory, '{}_{}'.format(kind, len(system['xyz'])))
+    paths = {'input': write_gaussian_input(base + '.in', system),
+             'types': write_atom_types(base + '.types', system)}
+    for version in versions:
+        paths[version] = write_ein('{}_{}.EIn'.format(base, version), system, version)
+    return paths
+
+
+def main(sizes=(100, 1000, 10000), kind='chain', write=None):
+    if write:
+        if not os.path.isdir(write):
+            os.makedirs(write)
+        for n_atoms in sizes:
+            for name, path in sorted(write_system(write, n_atoms, kind).items()):
+                print('{:>6} {}'.format(name, path))
+        return
+    from garleek.atom_types import parse as parse_atom_types
+    tmp = mkdtemp(prefix='garleek-bench')
+    print('{:>7} {:>9} {:>10}'.format('atoms', 'build (s)', 'patch (s)') +
+          ''.join(' {:>13}'.format('parse {} (s)'.format(v)) for v in EIN_VERSIONS))
+    for n_atoms in sizes:
+        t0 = time.time()
+        paths = write_system(tmp, n_atoms, kind)
+        t_build = time.time() - t0
+        t0 = time.time()
+        patched = GaussianPatcher(paths['input'], parse_atom_types(paths['types'])).patch()
+        t_patch = time.time() - t0
+        assert patched.count('garleek-backend') == 1
+        timings, atoms = [], None
+        for version in EIN_VERSIONS:
+            t0 = time.time()
+            ein = parse_gaussian_EIn(paths[version], version=version)
+            timings.append(time.time() - t0)
+            assert atoms is None or (ein.bond_indices == atoms).all(), 'layouts differ!'
+            atoms = ein.bond_indices
+        print('{:>7} {:>9.3f} {:>10.3f}'.format(ein['n_atoms'], t_build, t_patch) +
+              ''.join(' {:>13.3f}'.format(t) for t in timings))
+        for path in paths.values():
+            os.remove(path)
+    os.rmdir(tmp)
+
+
+if __name__ == '__main__':
+    p = ArgumentParser(description='Synthetic ONIOM systems for benchmarks')
+    p.add_argument('sizes', type=int, nargs='*', default=[100, 1000, 10000])
+    p.add_argument('--kind', choices=KINDS, default='chain')
+    p.add_argument('--write', metavar='DIRECTORY',
+                   help='Write the files to this directory instead of benchmarking')
+    args = p.parse_args()
+    main(args.sizes, args.kind, args.write)
@@ -30,9 +30,37 @@ Application layer
 
 - ``cli`` module lists the CLI entry-points for users (frontend)
   and QM softwares handling the ONIOM calculation (backend)
+
+Startup cost
+............
+
+``garleek-backend`` is launched once per MM evaluation, so everything
+done at import time is paid on every single ONIOM step. Expensive
+lookups (``__version__``, which may spawn ``git`` from a source
+checkout; ``atom_types.BUILTIN_TYPES``; the Tinker executables;
+NumPy and the QM/MM engine modules) are deferred until first use.
+``_IMPORT_STARTED`` records when the package started loading so the
+backend can report its import time (see ``cli.backend_app_main``).
 """
 
-from ._version import get_versions
-__version__ = get_versions()['version']
-del get_versions
+import sys
+import time
+_IMPORT_STARTED = time.time()
 __author__ = "Jaime Rodriguez-Guerra & Ignacio Funes-Ardoiz"
+
+
+def _get_version():
+    global __version__
+    if '__version__' not in globals():
+        from ._version import get_versions
+        __version__ = get_versions()['version']
+    return __version__
+
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        if name == '__version__':
+            return _get_version()
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+else:
+    _get_version()
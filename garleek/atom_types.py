@@ -11,7 +11,7 @@ These files are needed to convert atom types found in the QM
 engine to those expected by the MM engine. This is a key part
 of the whole QM/MM calculation, so those types must be chosen
 wisely. While we provide a few default mappings (check
-``BUILTIN_TYPES`` list), the user is encouraged to define
+``BUILTIN_TYPES`` list, or ``builtin_types()``), the user is encouraged to define
 his or her own conversions if needed.
 
 An ``atom_types`` file format is very simple: just two
@@ -42,9 +42,10 @@ This is valid syntax:
 
 from __future__ import print_function, absolute_import, division
 import os
+import sys
 
 
-BUILTIN_TYPES = sorted(os.listdir(os.path.join((os.path.dirname(__file__)), 'data', 'atom_types')))
+_BUILTIN_TYPES = None
 ELEMENTS = {
     'H': 1, 'He': 2, 'Li': 3, 'Be': 4, 'B': 5, 'C': 6, 'N': 7, 'O': 8, 'F': 9,
     'Ne': 10, 'Na': 11, 'Mg': 12, 'Al': 13, 'Si': 14, 'P': 15, 'S': 16, 'Cl': 17,
@@ -65,6 +66,26 @@ ELEMENTS = {
 PERIODIC_TABLE = dict((v, k) for (k, v) in ELEMENTS.items())
 
 
+def builtin_types():
+    """
+    List the ``atom_types`` files shipped with Garleek. The data
+    directory is only listed on first use.
+    """
+    global _BUILTIN_TYPES
+    if _BUILTIN_TYPES is None:
+        _BUILTIN_TYPES = sorted(os.listdir(os.path.join((os.path.dirname(__file__)), 'data', 'atom_types')))
+    return _BUILTIN_TYPES
+
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        if name == 'BUILTIN_TYPES':
+            return builtin_types()
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+else:
+    BUILTIN_TYPES = builtin_types()
+
+
 def get_file(filename):
     """
     Get file from one of the default locations
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+cache.py
+========
+
+Helpers for the on-disk caches Garleek keeps across steps and jobs.
+
+Cached files live in ``$GARLEEK_CACHE_DIR`` if set, or in
+``$XDG_CACHE_HOME/garleek`` (``~/.cache/garleek`` by default).
+Entries are always named after a hash of their contents (or of
+whatever they were generated from), and written atomically, so
+concurrent jobs can safely share the same cache directory.
+"""
+
+from __future__ import print_function, absolute_import, division
+import hashlib
+import os
+from tempfile import NamedTemporaryFile
+
+
+_file_hashes = {}
+
+
+def cache_dir(*subdirs):
+    """
+    Return (and create, if needed) the cache directory, or
+    a subdirectory of it.
+    """
+    root = os.environ.get('GARLEEK_CACHE_DIR')
+    if not root:
+        xdg = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        root = os.path.join(xdg, 'garleek')
+    path = os.path.join(root, *subdirs)
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:  # created by a concurrent job
+            if not os.path.isdir(path):
+                raise
+    return path
+
+
+def hash_bytes(*chunks):
+    """
+    SHA1 hex digest of the given byte strings (text is UTF-8 encoded)
+    """
+    sha = hashlib.sha1()
+    for chunk in chunks:
+        if not isinstance(chunk, bytes):
+            chunk = chunk.encode('utf-8')
+        sha.update(chunk)
+    return sha.hexdigest()
+
+
+def file_hash(path):
+    """
+    SHA1 hex digest of the contents of ``path``. Results are memoized
+    per process, as long as the file size and mtime do not change.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    key = path, stat.st_size, stat.st_mtime
+    if key not in _file_hashes:
+        with open(path, 'rb') as f:
+            _file_hashes[key] = hash_bytes(f.read())
+    return _file_hashes[key]
+
+
+def atomic_write(path, data):
+    """
+    Write ``data`` (bytes or text) to ``path`` through a temporary file
+    in the same directory, so readers never see a partial file.
+    """
+    mode = 'wb' if isinstance(data, bytes) else 'w'
+    directory = os.path.dirname(os.path.abspath(path))
+    with NamedTemporaryFile(mode=mode, dir=directory, prefix='.tmp', delete=False) as f:
+        f.write(data)
+    os.rename(f.name, path)
+    return path
+
+
+class ResultCache(object):
+
+    """
+    Content-addressed, on-disk cache of MM results.
+
+    Entries are keyed by the geometry (coordinates rounded to
+    ``tolerance``) and any other data that defines the calculation
+    (atom types, connectivity, forcefield hash, engine options...).
+    Each entry remembers the derivative level it was computed with,
+    so a Hessian calculation can also answer later energy or gradient
+    requests for the same geometry.
+
+    The least recently used entries are removed once the total size of
+    the cache exceeds ``max_size`` bytes. Hits and misses are logged to
+    a ``stats`` file shared by all the processes using the cache.
+
+    Parameters
+    ----------
+    directory : str, optional
+        Cache location. Defaults to the ``results`` subdirectory
+        of Garleek's cache.
+    tolerance : float, optional=1e-6
+        Coordinates closer than this (same units as the coordinates)
+        are considered the same geometry.
+    max_size : int, optional
+        Maximum size of the cache, in bytes. Defaults to 512 MB.
+    """
+
+    _STORED = 'energy', 'dipole_moment', 'gradients', 'hessian'
+
+    def __init__(self, directory=None, tolerance=1e-6, max_size=512*2**20):
+        if directory is None:
+            directory = cache_dir('results')
+        elif not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.tolerance = tolerance
+        self.max_size = max_size
+        self.hits = self.misses = 0
+
+    def key(self, xyz, *parts):
+        """
+        Hash the coordinates array ``xyz`` (rounded to ``tolerance``)
+        together with any number of str/bytes ``parts``.
+        """
+        import numpy as np
+        grid = np.round(np.asarray(xyz, dtype=float) / self.tolerance).astype(np.int64)
+        return hash_bytes(grid.tobytes(), *[b'\0' + (p if isinstance(p, bytes) else str(p).encode('utf-8'))
+                                            for p in parts])
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def _log(self, event):
+        fd = os.open(os.path.join(self.directory, 'stats'), os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            os.write(fd, event + b'\n')
+        finally:
+            os.close(fd)
+
+    def get(self, key, derivatives=0):
+        """
+        Return the cached results for ``key`` if they were computed
+        with at least ``derivatives`` level, or None otherwise. Only the
+        quantities corresponding to ``derivatives`` are returned.
+        """
+        import numpy as np
+        path = self._path(key)
+        results = None
+        try:
+            with np.load(path) as data:
+                if int(data['derivatives']) >= derivatives:
+                    results = {'energy': float(data['energy']),
+                               'dipole_moment': data['dipole_moment']}
+                    if derivatives > 0:
+                        results['gradients'] = data['gradients']
+                    if derivatives > 1:
+                        results['hessian'] = data['hessian']
+        except (IOError, OSError, KeyError, ValueError):
+            results = None
+        if results is None:
+            self.misses += 1
+            self._log(b'm')
+        else:
+            self.hits += 1
+            self._log(b'h')
+            try:
+                os.utime(path, None)  # refresh LRU position
+            except OSError:
+                pass
+        return results
+
+    def put(self, key, derivatives, results):
+        """
+        Store ``results`` (computed at ``derivatives`` level) under ``key``,
+        unless an entry with a higher level is already there.
+        """
+        import numpy as np
+        path = self._path(key)
+        if os.path.isfile(path):
+            try:
+                with np.load(path) as data:
+                    if int(data['derivatives']) >= derivatives:
+                        return path
+            except (IOError, OSError, KeyError, ValueError):
+                pass
+        arrays = dict((k, results[k]) for k in self._STORED if results.get(k) is not None)
+        with NamedTemporaryFile(dir=self.directory, prefix='.tmp', suffix='.npz', delete=False) as f:
+            np.savez(f, derivatives=derivatives, **arrays)
+        os.rename(f.name, path)
+        self.evict()
+        return path
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits
+        in ``max_size`` bytes.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.npz') or name.startswith('.'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for (_, size, _) in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
+
+    def stats(self):
+        """
+        Hits and misses recorded by all processes using this cache
+        """
+        hits = misses = 0
+        try:
+            with open(os.path.join(self.directory, 'stats'), 'rb') as f:
+                data = f.read()
+            hits, misses = data.count(b'h'), data.count(b'm')
+        except (IOError, OSError):
+            pass
+        return {'hits': hits, 'misses': misses}
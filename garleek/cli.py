@@ -33,14 +33,24 @@ In general, the worfklow is the following:
     QM_engine QM_input_file.garleek.in
 
 4. Profit!
+
+If the input was patched with ``--client``, the QM engine will call the
+lightweight ``garleek-client`` instead, which forwards each request to a
+``garleek-server`` process running for the whole job (it falls back to
+a regular in-process backend run if no server is listening)::
+
+    garleek-server &
+    QM_engine QM_input_file.garleek.in
+    garleek-client --stop-server
 """
 from __future__ import print_function, absolute_import, division
 from argparse import ArgumentParser, REMAINDER, SUPPRESS, ArgumentTypeError
 import os
 import sys
-from . import __version__
+import time
+from . import _get_version, _IMPORT_STARTED
 from .connectors import CONNECTORS, PATCHERS
-from .atom_types import get_file, parse as parse_atom_types, BUILTIN_TYPES
+from .atom_types import get_file, parse as parse_atom_types, builtin_types
 
 
 ###
@@ -100,14 +110,32 @@ def _parse_engine_string(word):
 
 
 def backend_app_main(argv=None):
-    """ ``garleek-backend`` CLI entry-point """
-    msg = 'Entering Garleek v{}'.format(__version__)
+    """
+    ``garleek-backend`` CLI entry-point
+
+    If ``$GARLEEK_FAST_START`` is set, the version lookup is skipped
+    and the time spent importing Garleek is reported instead, along
+    with a warning if it exceeds ``$GARLEEK_IMPORT_BUDGET`` (in
+    milliseconds, 100 by default).
+    """
+    if os.environ.get('GARLEEK_FAST_START'):
+        msg = 'Entering Garleek (fast start)'
+        import_time = (time.time() - _IMPORT_STARTED) * 1000
+        budget = float(os.environ.get('GARLEEK_IMPORT_BUDGET') or 100)
+        report = 'Import time: {:.1f} ms (budget: {:.0f} ms)'.format(import_time, budget)
+        if import_time > budget:
+            report = 'WARNING! ' + report
+    else:
+        msg = 'Entering Garleek v{}'.format(_get_version())
+        report = None
     underline = '='*len(msg)
     print(underline)
     print(msg)
+    if report:
+        print(report)
     print(underline)
     args = _backend_args(argv)
-    backend_app(**vars(args))
+    backend_app(return_path=True, **vars(args))
     print(underline)
     print('Exiting Garleek'.center(len(msg)))
     print(underline)
@@ -137,6 +165,11 @@ def backend_app(qmargs, qm='gaussian', mm='tinker', ff='mm3.prm', **kw):
     -------
     result :
         Whatever the QM-MM connector returns
+
+    Notes
+    -----
+    If ``$GARLEEK_PROFILE`` is set, the connector runs under a profiler
+    and an allocation tracer. See :mod:`garleek.profiling`.
     """
     qm_engine, qm_version = _parse_engine_string(qm)
     mm_engine, mm_version = _parse_engine_string(mm)
@@ -145,7 +178,14 @@ def backend_app(qmargs, qm='gaussian', mm='tinker', ff='mm3.prm', **kw):
     except KeyError:
         sys.exit("ERROR: Connector with QM={} and MM={} "
                  "is not available".format(qm_engine, qm_engine))
-    return connector(qmargs, forcefield=_extant_file_prm(ff, abspath=True),
+    forcefield = _extant_file_prm(ff, abspath=True)
+    profile_dir = os.environ.get('GARLEEK_PROFILE')
+    if profile_dir:
+        from .profiling import Profiled
+        with Profiled(profile_dir, qmargs):
+            return connector(qmargs, forcefield=forcefield, qm_version=qm_version,
+                             mm_version=mm_version, **kw)
+    return connector(qmargs, forcefield=forcefield,
                      qm_version=qm_version, mm_version=mm_version, **kw)
 
 
@@ -161,12 +201,256 @@ def _backend_args(argv=None):
                         'like tinker_8')
     p.add_argument('--ff', type=_extant_file_prm, default='mmff.prm',
                    help='Forcefield to be used by the MM engine')
+    p.add_argument('--tinker-mode', choices=('separate', 'combined'),
+                   default=os.environ.get('GARLEEK_TINKER_MODE') or 'separate',
+                   help='separate: energy & dipole from analyze, gradients from testgrad. '
+                        'combined: energy & gradients from testgrad. '
+                        'Defaults to $GARLEEK_TINKER_MODE or separate')
+    p.add_argument('--no-dipole', dest='dipole_moment', action='store_false',
+                   help='Do not compute the MM dipole moment (reported as zero)')
+    p.add_argument('--tinker-jobs', type=int,
+                   default=int(os.environ.get('GARLEEK_TINKER_JOBS') or 1),
+                   help='Maximum number of Tinker programs running concurrently. '
+                        'Defaults to $GARLEEK_TINKER_JOBS or 1')
+    p.add_argument('--tinker-threads', type=int,
+                   default=int(os.environ.get('GARLEEK_TINKER_THREADS') or 0) or None,
+                   help='OpenMP threads shared by concurrent Tinker programs. '
+                        'Defaults to $GARLEEK_TINKER_THREADS; if unset, '
+                        '$OMP_NUM_THREADS is not modified')
+    p.add_argument('--trim-forcefield', action='store_true',
+                   default=bool(os.environ.get('GARLEEK_TRIM_FORCEFIELD')),
+                   help='Use a cached, reduced copy of the .prm forcefield with '
+                        'only the parameters needed by the system atom types. '
+                        'Also enabled with $GARLEEK_TRIM_FORCEFIELD')
+    p.add_argument('--tinker-keyword', dest='tinker_keywords', action='append',
+                   metavar='KEYWORD',
+                   help='Extra line for the Tinker key file. Can be used several times')
+    p.add_argument('--result-cache', metavar='DIRECTORY',
+                   default=os.environ.get('GARLEEK_RESULT_CACHE') or None,
+                   help='Reuse MM results for already seen geometries, stored in this '
+                        'directory. Defaults to $GARLEEK_RESULT_CACHE (disabled if unset)')
+    p.add_argument('--result-cache-size', metavar='MB', type=float,
+                   default=float(os.environ.get('GARLEEK_RESULT_CACHE_SIZE') or 512),
+                   help='Maximum size of the results cache. Defaults to '
+                        '$GARLEEK_RESULT_CACHE_SIZE or 512 MB')
+    p.add_argument('--hessian-mode', choices=('memory', 'memmap', 'sparse'),
+                   default=os.environ.get('GARLEEK_HESSIAN_MODE') or 'memory',
+                   help='memory: keep the MM Hessian in RAM. memmap: assemble it in a '
+                        'temporary file and stream it to Gaussian with bounded memory. '
+                        'sparse: drop off-diagonal elements below --hessian-cutoff. '
+                        'Defaults to $GARLEEK_HESSIAN_MODE or memory')
+    p.add_argument('--hessian-memory', metavar='MB', type=float,
+                   default=float(os.environ.get('GARLEEK_HESSIAN_MEMORY') or 256),
+                   help='Memory budget for --hessian-mode memmap and sparse. Defaults to '
+                        '$GARLEEK_HESSIAN_MEMORY or 256 MB')
+    p.add_argument('--hessian-cutoff', metavar='KCAL/MOL/A2', type=float,
+                   default=float(os.environ.get('GARLEEK_HESSIAN_CUTOFF') or 1e-3),
+                   help='Smallest off-diagonal MM Hessian element kept with '
+                        '--hessian-mode sparse. Defaults to $GARLEEK_HESSIAN_CUTOFF or 0.001')
+    p.add_argument('--hessian-dir', metavar='DIRECTORY',
+                   default=os.environ.get('GARLEEK_HESSIAN_DIR') or None,
+                   help='Where --hessian-mode memmap creates its file. Defaults to '
+                        '$GARLEEK_HESSIAN_DIR or the system temporary directory')
+    p.add_argument('--timings', metavar='FILE', default=os.environ.get('GARLEEK_TIMINGS'),
+                   help='Append the wall and CPU times of each phase of the call, and of '
+                        'each MM process, to this JSON-lines file. Defaults to $GARLEEK_TIMINGS')
+    p.add_argument('--record', metavar='DIRECTORY', default=os.environ.get('GARLEEK_RECORD_DIR'),
+                   help='Keep a copy of every input file received, so the job can be '
+                        'replayed with garleek-replay. Defaults to $GARLEEK_RECORD_DIR')
+    p.add_argument('--no-session', dest='session', action='store_false',
+                   default=not os.environ.get('GARLEEK_NO_SESSION'),
+                   help='Do not reuse the setup (key file, connectivity, Tinker XYZ fields) '
+                        'of earlier calls of the same job. Also disabled with '
+                        '$GARLEEK_NO_SESSION')
     # Arguments injected by the QM program
     p.add_argument('qmargs', nargs=REMAINDER, help=SUPPRESS)
 
     return p.parse_args(argv)
 
 
+###
+# SERVER
+###
+
+
+def server_app_main(argv=None):
+    """ ``garleek-server`` CLI entry-point """
+    args = _server_args(argv)
+    server_app(**vars(args))
+
+
+def server_app(socket=None, timeout=None, **kw):
+    """
+    ``garleek-server`` Python entry-point
+
+    Parameters
+    ----------
+    socket : str, optional
+        Path to the Unix socket ``garleek-client`` will connect to.
+        Defaults to ``$GARLEEK_SOCKET`` or ``garleek.sock`` in the
+        current working directory.
+    timeout : float, optional
+        Exit after this many seconds without requests. If not set,
+        the server runs until ``garleek-client --stop-server`` is called.
+
+    Returns
+    -------
+    served : int
+        Number of requests handled
+    """
+    from .daemon import BackendServer
+    return BackendServer(socket, timeout=timeout).serve()
+
+
+def _server_args(argv=None):
+    p = ArgumentParser(prog='garleek-server')
+    p.add_argument('--socket', type=str, default=None,
+                   help='Unix socket to listen on. Defaults to $GARLEEK_SOCKET '
+                        'or garleek.sock in the working directory')
+    p.add_argument('--timeout', type=float, default=None,
+                   help='Exit after this many seconds without requests')
+
+    return p.parse_args(argv)
+
+
+###
+# REPORT
+###
+
+
+def report_app_main(argv=None):
+    """ ``garleek-report`` CLI entry-point """
+    args = _report_args(argv)
+    print(report_app(**vars(args)))
+
+
+def report_app(log=None, timings=None, job=None, top=10, json=False, **kw):
+    """
+    ``garleek-report`` Python entry-point
+
+    Parameters
+    ----------
+    log : str, optional
+        Gaussian log file of the job
+    timings : str, optional
+        JSON-lines file written by ``garleek-backend --timings``.
+        Defaults to ``$GARLEEK_TIMINGS``.
+    job : int, optional
+        Only consider the timing records of this job (Gaussian PID).
+        Defaults to the job the log file belongs to.
+    top : int, optional=10
+        Number of slowest MM calls listed
+    json : bool, optional=False
+        Return the report as JSON instead of text
+
+    Returns
+    -------
+    report : str
+    """
+    from .report import build_report, format_report
+    report = build_report(log, timings, job=job, top=top)
+    if json:
+        import json as _json
+        return _json.dumps(report, indent=2, sort_keys=True)
+    return format_report(report)
+
+
+def _report_args(argv=None):
+    p = ArgumentParser(prog='garleek-report')
+    p.add_argument('log', nargs='?', type=_extant_file, default=None,
+                   help='Gaussian log file of the job')
+    p.add_argument('--timings', type=str, default=os.environ.get('GARLEEK_TIMINGS'),
+                   help='Timings file written by garleek-backend. Defaults to $GARLEEK_TIMINGS')
+    p.add_argument('--job', type=int, default=None,
+                   help='Only use the timings of this job (Gaussian PID). '
+                        'Defaults to the job of the log file')
+    p.add_argument('--top', type=int, default=10,
+                   help='Number of slowest MM calls to list')
+    p.add_argument('--json', action='store_true',
+                   help='Print the report as JSON')
+    args = p.parse_args(argv)
+    if args.timings and not os.path.isfile(args.timings):
+        p.error('Timings file {} does not exist'.format(args.timings))
+    if args.log is None and not args.timings:
+        p.error('A Gaussian log, a timings file or both are needed')
+    return args
+
+
+###
+# REPLAY
+###
+
+
+def replay_app_main(argv=None):
+    """ ``garleek-replay`` CLI entry-point """
+    args, backend_args = _replay_args(argv)
+    print(replay_app(backend_kwargs=backend_args, **vars(args)))
+
+
+def replay_app(directory, types=None, repeat=1, warmup=0, verbose=False, json=False,
+               backend_kwargs=None, **kw):
+    """
+    ``garleek-replay`` Python entry-point
+
+    Parameters
+    ----------
+    directory : str
+        Directory with the EIn files to replay, like those recorded
+        with ``garleek-backend --record``
+    types : str, optional
+        Atom types mapping to apply to the EIn files first, if they
+        carry QM atom types. See :mod:`garleek.atom_types`.
+    repeat : int, optional=1
+        Number of measured passes over the directory
+    warmup : int, optional=0
+        Number of unmeasured calls run first
+    verbose : bool, optional=False
+        Show the output of each backend call
+    json : bool, optional=False
+        Return the summary as JSON instead of text
+    backend_kwargs : dict, optional
+        ``garleek-backend`` options, as in :func:`backend_app`
+
+    Returns
+    -------
+    summary : str
+    """
+    from .replay import replay, format_replay
+    backend_kwargs = dict(backend_kwargs or {})
+    for name in ('qmargs', 'timings', 'record'):
+        backend_kwargs.pop(name, None)
+    mapping = parse_atom_types(get_file(types)) if types else None
+    summary = replay(directory, backend_kwargs, types=mapping, repeat=repeat,
+                     warmup=warmup, verbose=verbose)
+    if json:
+        import json as _json
+        return _json.dumps(summary, indent=2, sort_keys=True)
+    return format_replay(summary)
+
+
+def _replay_args(argv=None):
+    p = ArgumentParser(prog='garleek-replay',
+                       epilog='Any garleek-backend option (--ff, --tinker-mode...) '
+                              'is accepted as well')
+    p.add_argument('directory', help='Directory with the EIn files to replay')
+    p.add_argument('--types', type=_extant_file_types, default=None,
+                   help='Atom types mapping to translate QM atom types found in the '
+                        'EIn files. Can be either one of {{{}}}, or a user-provided '
+                        'two-column file'.format(','.join(builtin_types())))
+    p.add_argument('--repeat', type=int, default=1,
+                   help='Number of measured passes over the directory')
+    p.add_argument('--warmup', type=int, default=0,
+                   help='Number of unmeasured calls run first')
+    p.add_argument('--verbose', action='store_true',
+                   help='Show the output of each backend call')
+    p.add_argument('--json', action='store_true',
+                   help='Print the summary as JSON')
+    args, rest = p.parse_known_args(argv)
+    if not os.path.isdir(args.directory):
+        p.error('Directory {} does not exist'.format(args.directory))
+    return args, vars(_backend_args(rest))
+
+
 ###
 # FRONTEND
 ###
@@ -179,7 +463,7 @@ def frontend_app_main(argv=None):
 
 
 def frontend_app(input_file, types='uff_to_mm3', qm='gaussian', mm='tinker',
-                 ff='mm3.prm', **kw):
+                 ff='mm3.prm', client=False, **kw):
     """
     ``garleek`` Python entry-point
 
@@ -208,6 +492,10 @@ def frontend_app(input_file, types='uff_to_mm3', qm='gaussian', mm='tinker',
         values requested by the QM engine. It should conform to the
         specified ``types`` mapping. This is only needed so the patched
         ``garleek-backend`` calls include this argument.
+    client : bool, default=False
+        Call ``garleek-client`` instead of ``garleek-backend`` in the
+        patched file, so a running ``garleek-server`` can handle the
+        MM part without spawning a new Python process per step.
 
     Returns
     -------
@@ -218,7 +506,9 @@ def frontend_app(input_file, types='uff_to_mm3', qm='gaussian', mm='tinker',
     qm_engine, qm_version = _parse_engine_string(qm)
     rosetta = parse_atom_types(get_file(types))
     patcher = PATCHERS[qm_engine]
-    patched = patcher(input_file, rosetta, qm=qm, mm=mm, forcefield=ff, **kw)
+    backend = 'garleek-client' if client else 'garleek-backend'
+    patched = patcher(input_file, rosetta, qm=qm, mm=mm, forcefield=ff,
+                      backend=backend, **kw)
     filename, ext = os.path.splitext(input_file)
     outname = filename + '.garleek' + ext
     with open(outname, 'w') as f:
@@ -228,7 +518,7 @@ def frontend_app(input_file, types='uff_to_mm3', qm='gaussian', mm='tinker',
 
 def _frontend_args(argv=None):
     p = ArgumentParser(prog='garleek')
-    p.add_argument('--version', action='version', version='%(prog)s ' + __version__)
+    p.add_argument('--version', action='version', version='%(prog)s ' + _get_version())
     p.add_argument('--qm', type=str, default='gaussian',
                    help='QM program calling Garleek. Defaults to Gaussian. '
                         'Versions after an underscore: <engine>_<version>, '
@@ -242,7 +532,10 @@ def _frontend_args(argv=None):
     p.add_argument('--types', type=_extant_file_types, default='uff_to_mm3',
                    help='Dictionary of QM-provided and MM-needed, case-insensitive atom types. '
                    'Can be either one of {{{}}}, or a user-provided '
-                   'two-column file'.format(','.join(BUILTIN_TYPES)))
+                   'two-column file'.format(','.join(builtin_types())))
+    p.add_argument('--client', action='store_true',
+                   help='Patch the input to call garleek-client, which forwards '
+                        'the MM requests to a running garleek-server')
     p.add_argument('input_file', type=_extant_file, help='QM input file (must match '
                   '--qm software)')
 
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+client.py
+=========
+
+``garleek-client``: thin replacement for ``garleek-backend``.
+
+It accepts exactly the same arguments as ``garleek-backend`` and forwards
+them to a running ``garleek-server`` (see :mod:`garleek.daemon`) through
+a Unix socket, waiting until the server has written the output file the
+QM engine expects. Only the standard library is imported here, so
+launching it is much cheaper than a full backend run.
+
+If no server is listening, the request is handled in-process, exactly
+as ``garleek-backend`` would, so patched inputs keep working regardless.
+
+Two extra options are understood (and not forwarded):
+
+- ``--socket PATH``: Unix socket of the server. Defaults to
+  ``$GARLEEK_SOCKET`` or ``garleek.sock`` in the working directory.
+- ``--stop-server``: ask the server to shut down and exit.
+"""
+
+from __future__ import print_function, absolute_import, division
+import os
+import socket
+import sys
+from .daemon import socket_path, send_message, receive_message, forwarded_environment
+
+
+def _split_args(argv):
+    path, stop, forwarded = None, False, []
+    argv = list(argv)
+    while argv:
+        arg = argv.pop(0)
+        if arg == '--socket' and argv:
+            path = argv.pop(0)
+        elif arg.startswith('--socket='):
+            path = arg.split('=', 1)[1]
+        elif arg == '--stop-server':
+            stop = True
+        else:
+            forwarded.append(arg)
+    return path, stop, forwarded
+
+
+def forward(argv, path=None):
+    """
+    Send ``argv`` to the server listening on ``path``, with the
+    working directory and the relevant environment variables
+    (see :func:`garleek.daemon.forwarded_environment`).
+
+    Returns
+    -------
+    reply : dict or None
+        Server reply, or None if no server could be reached.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path(path))
+    except (IOError, OSError):
+        sock.close()
+        return None
+    try:
+        send_message(sock, {'argv': argv, 'cwd': os.getcwd(), 'env': forwarded_environment()})
+        return receive_message(sock)
+    finally:
+        sock.close()
+
+
+def stop_server(path=None):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path(path))
+    except (IOError, OSError):
+        sock.close()
+        return None
+    try:
+        send_message(sock, {'command': 'stop'})
+        return receive_message(sock)
+    finally:
+        sock.close()
+
+
+def client_app_main(argv=None):
+    """ ``garleek-client`` CLI entry-point """
+    if argv is None:
+        argv = sys.argv[1:]
+    path, stop, forwarded = _split_args(argv)
+    if stop:
+        reply = stop_server(path)
+        if reply is None:
+            sys.exit('ERROR: No Garleek server listening on {}'.format(socket_path(path)))
+        sys.stdout.write(reply['output'])
+        return
+    reply = forward(forwarded, path)
+    if reply is None:
+        # No server around: behave like garleek-backend
+        from .cli import backend_app_main
+        return backend_app_main(forwarded)
+    sys.stdout.write(reply['output'])
+    sys.stdout.flush()
+    if reply['returncode']:
+        sys.exit(reply['returncode'])
+
+
+if __name__ == '__main__':
+    client_app_main()
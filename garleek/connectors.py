@@ -12,22 +12,24 @@ unit conversion.
 A ``CONNECTORS`` dict is maintained at the end of the file
 listing the connectors available. It's a dict of dicts, where
 the primary keys are QM engines and secondary keys, MM engines.
+
+Engine modules (and NumPy) are only imported when a connector or
+patcher is actually called, so importing this module is cheap.
 """
 
 from __future__ import print_function, absolute_import, division
 import os
-import shutil
-import numpy as np
-from .qm.gaussian import (parse_gaussian_EIn, prepare_gaussian_EOu,
-                          supported_versions as gaussian_supported_versions,
-                          default_version as gaussian_default_version,
-                          patch_gaussian_input)
-from .mm.tinker import prepare_tinker_xyz, run_tinker, prepare_tinker_key
-from .atom_types import parse as parse_atom_types
+from . import scratch, timing
 from . import units as u
 
 
-def gaussian_tinker(qmargs, forcefield='mm3.prm', write_file=True, qm_version='16', **kwargs):
+def gaussian_tinker(qmargs, forcefield='mm3.prm', write_file=True, qm_version='16',
+                    tinker_mode='separate', dipole_moment=True, tinker_jobs=1,
+                    tinker_threads=None, trim_forcefield=False, tinker_keywords=None,
+                    result_cache=None, result_cache_size=512, hessian_mode='memory',
+                    hessian_memory=256, hessian_cutoff=1e-3, hessian_dir=None, timings=None,
+                    full_output=False, return_path=False,
+                    record=None, session=True, **kwargs):
     """
     Connects QM engine ``gaussian`` with MM engine ``tinker``.
 
@@ -42,7 +44,9 @@ def gaussian_tinker(qmargs, forcefield='mm3.prm', write_file=True, qm_version='1
     with the adequate syntax. So, that's what we are doing here:
 
         1. Parse Gaussian EIn file
-        2. Convert it to TINKER's XYZ and KEY files
+        2. Convert it to TINKER's XYZ and KEY files, in the job's
+           scratch workspace (see :mod:`garleek.scratch`). Later calls
+           reuse the setup saved by the first one (see :mod:`garleek.session`)
         3. Run TINKER to obtain energy, dipole, etc
         4. Convert units and write the EOu file
 
@@ -66,42 +70,230 @@ def gaussian_tinker(qmargs, forcefield='mm3.prm', write_file=True, qm_version='1
         Gaussian version in use. Needed to cover the slight differences
         between Gaussian versions (EIn/EOu syntax, number of args, and so on).
 
+    tinker_mode : str, optional=separate
+        How to distribute the work among TINKER programs. ``combined``
+        takes the energy from ``testgrad`` when gradients are requested.
+        See :func:`garleek.mm.tinker.run_tinker`.
+
+    dipole_moment : bool, optional=True
+        Whether to compute the MM dipole moment. If False, zeros are
+        reported to Gaussian and, in ``combined`` mode, gradient steps
+        only need one TINKER process.
+
+    tinker_jobs : int, optional=1
+        Maximum number of TINKER programs running concurrently. Frequency
+        steps need up to three independent programs.
+
+    tinker_threads : int, optional
+        OpenMP threads budget shared by the concurrent TINKER programs.
+
+    trim_forcefield : bool, optional=False
+        Use a cached copy of the ``*.prm`` forcefield containing only the
+        parameters relevant to the atom types present in the EIn file.
+        See :func:`garleek.mm.tinker.trim_tinker_prm`.
+
+    tinker_keywords : list of str, optional
+        Additional lines for the TINKER key file.
+
+    result_cache : str, optional
+        Directory of an on-disk cache of MM results (see
+        :class:`garleek.cache.ResultCache`). If set, TINKER is only run
+        for geometries (and derivative levels) not seen before.
+
+    result_cache_size : float, optional=512
+        Maximum size of the results cache, in MB.
+
+    hessian_mode : str, optional=memory
+        ``memory`` keeps the packed Hessian in RAM. ``memmap`` assembles
+        it in a temporary disk-backed file and converts units while
+        streaming it to the EOu file, so resident memory stays around
+        ``hessian_memory`` regardless of the system size. ``sparse`` only
+        keeps off-diagonal elements larger than ``hessian_cutoff`` and
+        expands them while streaming the EOu file; a summary of the
+        discarded elements is printed. Hessian steps are not stored in
+        the results cache in these two modes.
+
+    hessian_memory : float, optional=256
+        Memory budget for ``memmap`` and ``sparse`` modes, in MB.
+
+    hessian_cutoff : float, optional=1e-3
+        Magnitude (kcal/mol/A^2) below which off-diagonal Hessian
+        elements are dropped in ``sparse`` mode.
+
+    hessian_dir : str, optional
+        Directory of the ``memmap`` mode file. Defaults to the system
+        temporary directory (``$TMPDIR``), not the scratch workspace,
+        which is usually RAM-backed.
+
+    timings : str, optional
+        JSON-lines file where the wall and CPU times of each phase of
+        this call, and of each TINKER process, are appended. See
+        :mod:`garleek.timing`.
+
+    full_output : bool, optional=False
+        Also return a dict with details about the call.
+
+    return_path : bool, optional=False
+        Return the path to the EOu file instead of its contents. The file
+        is always streamed to disk in chunks; this saves reading it back,
+        which matters for large Hessians.
+
+    record : str, optional
+        Directory where a copy of the EIn file is kept, so the call
+        can be replayed later. See :mod:`garleek.replay`.
+
+    session : bool, optional=True
+        Save the setup of the first call of each layer (key file,
+        connectivity, preformatted XYZ fields...) in the scratch
+        workspace and reuse it in the following calls of the job.
+        See :mod:`garleek.session`.
+
     Returns
     -------
-    eou_data : str
-        Contents of the EOu file Gaussian expects back.
+    eou : str
+        Contents of the EOu file Gaussian expects back, or its path
+        if ``return_path`` is True (and ``write_file`` too).
+    info : dict
+        Only if ``full_output`` is True. ``cached`` tells whether the MM
+        results came from the results cache, and ``processes`` lists the
+        resource usage of each TINKER process (wall, user and system CPU
+        time, peak RSS, exit status); see :func:`garleek.mm.tinker.run_tinker`.
     """
+    from .qm.gaussian import (parse_gaussian_EIn, prepare_gaussian_EOu, write_gaussian_EOu,
+                              default_version as gaussian_default_version)
+    from .mm.tinker import (write_tinker_xyz, run_tinker, prepare_tinker_key, trim_tinker_prm,
+                            tinker_executable)
     if qm_version is None:
         qm_version = gaussian_default_version
     layer, ein_filename, eou_filename  = qmargs[:3]
     # In Gaussian 09d and above, two more arguments are passed
     # but we don't need them anyway
     # msg_file, fchk_file, matel_file = qmargs[3:6]
+    if record:
+        from .replay import record_ein
+        try:
+            record_ein(record, ein_filename, layer, qm_version=qm_version)
+        except (IOError, OSError) as e:  # never break a QM job because of this
+            print('Warning: could not record', ein_filename, '-', e)
     # Gaussian Input
-    ein = parse_gaussian_EIn(ein_filename, version=qm_version)
-    # TINKER inputs
-    xyz = prepare_tinker_xyz(ein['atoms'], ein['bonds'])
-    key = prepare_tinker_key(forcefield)
-    with_gradients = ein['derivatives'] > 0
-    with_hessian = ein['derivatives'] == 2
-    mm = run_tinker(xyz, n_atoms=ein['n_atoms'], key=key, energy=True, dipole_moment=True,
-                    gradients=with_gradients, hessian=with_hessian)
-    # Unit conversion from Tinker to Gaussian
-    mm['energy'] = mm['energy'] * u.KCALMOL_TO_HARTREE
-    mm['dipole_moment'] = mm['dipole_moment'] * u.DEBYES_TO_EBOHR
-    if with_gradients:
-        mm['gradients'] = mm['gradients'] * u.KCALMOLEANGSTROM_TO_HARTREEBOHR
-    if with_hessian:
-        mm['hessian'] = mm['hessian'][np.tril_indices(ein['n_atoms']*3)] \
-                        * u.KCALMOLEANGSTROMSQ_TO_HARTREEBOHRSQ
-    # Generate files requested by Gaussian
-    eou_data = prepare_gaussian_EOu(ein['n_atoms'], **mm)
-    if write_file:
-        if eou_filename is None:
-            eou_filename = os.path.splitext(ein_filename)[0] + '.EOu'
-        with open(eou_filename, mode='w') as f:
-            f.write(eou_data)
-    return eou_data
+    rec = timing.recorder(timings, layer=layer, ein=os.path.basename(ein_filename),
+                          job=scratch.job_id(ein_filename))
+    streamed = None
+    processes = []
+    try:
+        # Files exchanged with TINKER live in a fast, per-job scratch directory
+        workspace = scratch.workspace(ein_filename)
+        snapshot = settings = None
+        with rec.phase('parse_ein'):
+            if session:
+                from .session import Session, session_path, session_settings
+                settings = session_settings(forcefield, qm_version, tinker_keywords,
+                                            trim_forcefield)
+                snapshot = Session.load(session_path(workspace, layer), settings)
+            ein = parse_gaussian_EIn(ein_filename, version=qm_version, connectivity=snapshot,
+                                     hash_connectivity=session)
+        rec.update(n_atoms=ein['n_atoms'], derivatives=ein['derivatives'])
+        if snapshot is not None and not snapshot.matches(ein):
+            snapshot = None
+        rec.update(reused_session=snapshot is not None)
+        # TINKER inputs
+        with rec.phase('prepare_inputs'):
+            if snapshot is not None:
+                forcefield, key = snapshot.forcefield, snapshot.key
+                snapshot.restore_executables()
+            else:
+                if trim_forcefield and forcefield.lower().endswith('.prm'):
+                    try:
+                        types = set(int(t) for t in set(ein.types))
+                    except (TypeError, ValueError):
+                        print('Warning: non-numeric atom types found; using the full forcefield')
+                    else:
+                        forcefield = trim_tinker_prm(forcefield, types)
+                key = prepare_tinker_key(forcefield, extra_keywords=tinker_keywords,
+                                         directory=workspace.directory)
+                if session and ein.types is not None and ein.types.dtype.kind == 'U':
+                    snapshot = Session(settings, ein, forcefield, key,
+                                       executables=dict((p, tinker_executable(p)) for p in
+                                                        ('analyze', 'testgrad', 'testhess')))
+                    try:
+                        snapshot.save(session_path(workspace, layer))
+                    except (IOError, OSError) as e:  # not worth failing the step
+                        print('Warning: could not save the session -', e)
+        with_gradients = ein['derivatives'] > 0
+        with_hessian = ein['derivatives'] == 2
+        streamed_hessian = with_hessian and hessian_mode != 'memory'
+        mm = cache = None
+        if result_cache and not streamed_hessian:
+            from .cache import ResultCache, file_hash
+            with rec.phase('cache'):
+                cache = ResultCache(result_cache, max_size=result_cache_size * 2**20)
+                cache_key = cache.key(ein.xyz, ' '.join(str(t) for t in ein.types) if ein.types is not None else '',
+                                      ein.bond_indptr.tobytes(), ein.bond_indices.tobytes(),
+                                      ein.bond_orders.tobytes(), file_hash(key),
+                                      file_hash(forcefield), tinker_mode, dipole_moment,
+                                      'packed-hessian')
+                mm = cache.get(cache_key, ein['derivatives'])
+            if mm is not None:
+                print('Reusing cached MM results', cache_key)
+        cached = mm is not None
+        rec.update(cached=cached)
+        if mm is None:
+            with rec.phase('prepare_inputs'):
+                if snapshot is not None:
+                    xyz_file = snapshot.write_xyz(workspace.path('tinker.xyz'), ein.xyz)
+                else:
+                    xyz_file = write_tinker_xyz(workspace.path('tinker.xyz'), ein.elements,
+                                                ein.types, ein.xyz, ein.bond_indptr,
+                                                ein.bond_indices, ein.bond_orders)
+            with rec.phase('run_tinker'):
+                mm = run_tinker(None, n_atoms=ein['n_atoms'], key=key, energy=True,
+                                dipole_moment=dipole_moment, gradients=with_gradients,
+                                hessian=with_hessian, mode=tinker_mode, concurrency=tinker_jobs,
+                                threads=tinker_threads, xyz_file=xyz_file,
+                                hessian_mode=hessian_mode, max_memory=int(hessian_memory * 2**20),
+                                hessian_cutoff=hessian_cutoff, hessian_dir=hessian_dir,
+                                recorder=rec)
+            processes = mm.pop('processes')
+            if cache is not None:
+                with rec.phase('cache'):
+                    cache.put(cache_key, ein['derivatives'], mm)
+        # Unit conversion from Tinker to Gaussian
+        mm['energy'] = mm['energy'] * u.KCALMOL_TO_HARTREE
+        mm['dipole_moment'] = mm['dipole_moment'] * u.DEBYES_TO_EBOHR
+        if with_gradients:
+            mm['gradients'] = mm['gradients'] * u.KCALMOLEANGSTROM_TO_HARTREEBOHR
+        if streamed_hessian:  # scaled band by band while streaming
+            streamed = mm['hessian']
+            if hessian_mode == 'sparse':
+                print(streamed.report())
+            mm['hessian'] = streamed.packed_rows(scale=u.KCALMOLEANGSTROMSQ_TO_HARTREEBOHRSQ)
+        elif with_hessian:  # packed lower triangle, scaled in place
+            mm['hessian'] *= u.KCALMOLEANGSTROMSQ_TO_HARTREEBOHRSQ
+        # Generate files requested by Gaussian
+        with rec.phase('write_eou'):
+            if not write_file:
+                eou = prepare_gaussian_EOu(ein['n_atoms'], **mm)
+            else:
+                if eou_filename is None:
+                    eou_filename = os.path.splitext(ein_filename)[0] + '.EOu'
+                eou = write_gaussian_EOu(eou_filename, ein['n_atoms'], **mm)
+                if not return_path:
+                    with open(eou) as f:
+                        eou = f.read()
+        if full_output:
+            return eou, {'cached': cached, 'processes': processes}
+        return eou
+    finally:
+        if streamed is not None:
+            streamed.close()
+        rec.write()
+
+def patch_gaussian_input(*a, **kw):
+    """
+    Lazy wrapper around :func:`garleek.qm.gaussian.patch_gaussian_input`
+    """
+    from .qm.gaussian import patch_gaussian_input
+    return patch_gaussian_input(*a, **kw)
 
 
 CONNECTORS = {
@@ -113,4 +305,4 @@ QM_ENGINES = sorted(CONNECTORS.keys())
 MM_ENGINES = sorted([k for (qm, mm) in CONNECTORS.items() for k in mm])
 PATCHERS = {
     'gaussian': patch_gaussian_input
-}
\ No newline at end of file
+}
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+daemon.py
+=========
+
+Long-lived ``garleek-backend`` server.
+
+Each ONIOM step makes the QM engine launch ``garleek-backend`` as a
+brand new process, which means starting Python, importing NumPy and
+rebuilding every connector structure, again and again. For small MM
+regions this fixed cost easily dominates the MM work itself.
+
+``garleek-server`` avoids that by staying alive for the whole job and
+listening on a Unix socket. The patched QM input then calls the tiny
+``garleek-client`` program (see :mod:`garleek.client`), which forwards
+its arguments (normally ``--qm``, ``--mm``, ``--ff`` and the ``qmargs``
+triple) to the server and returns once the requested output file has
+been written.
+
+Protocol
+--------
+
+Both ends exchange a single JSON document per line (UTF-8 encoded).
+The client sends::
+
+    {"argv": [...], "cwd": "/path/to/job", "env": {...}}
+
+and the server answers with::
+
+    {"returncode": 0, "output": "..."}
+
+where ``output`` holds everything the backend printed, so the client can
+replay it in the QM engine log. A request with ``"command": "stop"``
+shuts the server down.
+
+``env`` holds the client's variables that change what the backend does
+(see :func:`forwarded_environment`). The server applies them for the
+duration of the request, and unsets its own ones the client does not
+have, so a call behaves the same with ``garleek-client`` as with
+``garleek-backend``.
+"""
+
+from __future__ import print_function, absolute_import, division
+import json
+import os
+import socket
+import sys
+import time
+import traceback
+
+try:
+    from StringIO import StringIO
+except ImportError:  # Python 3
+    from io import StringIO
+
+
+DEFAULT_SOCKET = 'garleek.sock'
+FORWARDED_PREFIXES = 'GARLEEK_', 'TINKER_'
+FORWARDED_VARIABLES = 'OMP_NUM_THREADS', 'TMPDIR'
+
+
+def _forwarded(name):
+    return name.startswith(FORWARDED_PREFIXES) or name in FORWARDED_VARIABLES
+
+
+def forwarded_environment(environ=None):
+    """
+    Environment variables a request carries to the server:
+    ``GARLEEK_*``, ``TINKER_*``, ``$OMP_NUM_THREADS`` and ``$TMPDIR``
+    """
+    environ = os.environ if environ is None else environ
+    return dict((k, v) for (k, v) in environ.items() if _forwarded(k))
+
+
+def socket_path(path=None):
+    """
+    Resolve the Unix socket path shared by ``garleek-server``
+    and ``garleek-client``: ``path`` if given, ``$GARLEEK_SOCKET``
+    if set or ``garleek.sock`` in the current working directory.
+    """
+    return path or os.environ.get('GARLEEK_SOCKET') or DEFAULT_SOCKET
+
+
+def send_message(sock, message):
+    sock.sendall(json.dumps(message).encode('utf-8') + b'\n')
+
+
+def receive_message(sock):
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        if chunk.endswith(b'\n'):
+            break
+    if not chunks:
+        return None
+    return json.loads(b''.join(chunks).decode('utf-8'))
+
+
+class BackendServer(object):
+
+    """
+    Serve ``garleek-backend`` requests over a Unix socket, one at a time.
+
+    Parameters
+    ----------
+    path : str
+        Path to the Unix socket. It will be created on ``serve`` and
+        removed on exit.
+    timeout : float, optional
+        Shut down after this many seconds without requests. ``None``
+        (or ``0``) means wait forever.
+    """
+
+    def __init__(self, path=None, timeout=None):
+        self.path = socket_path(path)
+        self.timeout = timeout or None
+        self.served = 0
+        self._forcefields = {}
+        self._running = False
+
+    def _resolve_forcefield(self, ff):
+        # Resolved paths never change during a job, so keep them warm
+        from .cli import _extant_file_prm
+        key = (os.getcwd(), ff)
+        if key not in self._forcefields:
+            self._forcefields[key] = _extant_file_prm(ff, abspath=True)
+        return self._forcefields[key]
+
+    def handle(self, message):
+        """
+        Run a single backend request and return the reply
+        for the client.
+        """
+        from .cli import _backend_args, backend_app
+        if message.get('command') == 'stop':
+            self._running = False
+            return {'returncode': 0, 'output': 'Garleek server stopped\n'}
+        cwd = os.getcwd()
+        environment = self._apply_environment(message.get('env'))
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = captured = StringIO()
+        returncode = 0
+        try:
+            os.chdir(message.get('cwd') or cwd)
+            args = vars(_backend_args(message.get('argv', [])))
+            args['ff'] = self._resolve_forcefield(args['ff'])
+            backend_app(return_path=True, **args)
+        except SystemExit as e:
+            if e.code not in (None, 0):
+                if not isinstance(e.code, int):
+                    print(e.code)
+                returncode = e.code if isinstance(e.code, int) else 1
+        except Exception:
+            traceback.print_exc()
+            returncode = 1
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+            os.chdir(cwd)
+            self._restore_environment(environment)
+        self.served += 1
+        return {'returncode': returncode, 'output': captured.getvalue()}
+
+    def _apply_environment(self, env):
+        """
+        Replace the forwarded variables of the server with ``env``.
+        Returns what ``_restore_environment`` needs to undo it.
+        """
+        import tempfile
+        from .mm import tinker
+        if env is None:  # older client
+            return None
+        saved = forwarded_environment()
+        executables = dict(tinker._tinker_executables)
+        for name in saved:
+            if name not in env:
+                del os.environ[name]
+        os.environ.update(env)
+        if any(env.get(k) != saved.get(k) for k in set(env) | set(saved) if k.startswith('TINKER_')):
+            tinker._tinker_executables.clear()  # looked up again with the client's variables
+        tempdir = tempfile.tempdir
+        if env.get('TMPDIR') != saved.get('TMPDIR'):
+            tempfile.tempdir = None  # gettempdir() looks at $TMPDIR again
+        return saved, executables, tempdir
+
+    def _restore_environment(self, environment):
+        import tempfile
+        from .mm import tinker
+        if environment is None:
+            return
+        saved, executables, tempdir = environment
+        for name in forwarded_environment():
+            if name not in saved:
+                del os.environ[name]
+        os.environ.update(saved)
+        tinker._tinker_executables.clear()
+        tinker._tinker_executables.update(executables)
+        tempfile.tempdir = tempdir
+
+    def serve(self):
+        """
+        Listen on ``self.path`` until a ``stop`` request arrives
+        or the idle timeout expires.
+        """
+        # Warm everything up before the first request arrives; engine
+        # modules are lazily imported by the connectors otherwise
+        import numpy  # noqa
+        from .qm import gaussian  # noqa
+        from .mm import tinker
+        for program in tinker._TINKER_PROGRAMS:
+            tinker.tinker_executable(program)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.path)
+        server.listen(8)
+        server.settimeout(self.timeout)
+        self._running = True
+        print('Garleek server listening on', self.path)
+        try:
+            while self._running:
+                try:
+                    conn, _ = server.accept()
+                except socket.timeout:
+                    print('Garleek server idle for {}s, exiting'.format(self.timeout))
+                    break
+                try:
+                    conn.settimeout(None)
+                    message = receive_message(conn)
+                    if message is None:
+                        continue
+                    t0 = time.time()
+                    reply = self.handle(message)
+                    send_message(conn, reply)
+                    print('Served request #{} in {:.3f}s (exit code {})'.format(
+                          self.served, time.time() - t0, reply['returncode']))
+                finally:
+                    conn.close()
+        finally:
+            server.close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            from .scratch import collect_garbage
+            collect_garbage()
+        return self.served
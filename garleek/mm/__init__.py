@@ -30,8 +30,10 @@ document those in the docstring!)
         Potential energy
     gradients : np.array with shape (3*n_atom,)
         Gradient on each tom
-    hessian : np.array with shape (9*n_atom,)
-        Flattened hessian matrix (force constants)
+    hessian : np.array with shape (3*n_atom*(3*n_atom+1)/2,)
+        Hessian matrix (force constants) in packed lower triangular
+        form: element (i, j), j <= i, at position i*(i+1)/2 + j.
+        The full square matrix is never needed.
     dipole_moment : np.array with shape (3,), optional
         Dipole X,Y,Z-Components
     polarizability : np.array with shape (6,), optional
@@ -9,20 +9,54 @@ Garleek - Tinker bridge
 """
 
 from __future__ import print_function, absolute_import, division
+import mmap
 import os
+import re
 import sys
-from distutils.spawn import find_executable
-from subprocess import check_output
+import time
+from collections import deque
+from subprocess import Popen, PIPE, CalledProcessError
 from tempfile import NamedTemporaryFile
 import numpy as np
 from  .. import units as u
+from ..timing import NULL_RECORDER
+try:
+    from shutil import which as find_executable
+except ImportError:  # Python 2
+    from distutils.spawn import find_executable
 
 supported_versions = '8.1',
 default_version = '8.1'
 
-tinker_testhess = os.environ.get('TINKER_TESTHESS') or find_executable('testhess')
-tinker_analyze = os.environ.get('TINKER_ANALYZE') or find_executable('analyze')
-tinker_testgrad = os.environ.get('TINKER_TESTGRAD') or find_executable('testgrad')
+_TINKER_PROGRAMS = 'analyze', 'testgrad', 'testhess'
+TINKER_MODES = 'separate', 'combined'
+HESSIAN_MODES = 'memory', 'memmap', 'sparse'
+_tinker_executables = {}
+
+
+def tinker_executable(program):
+    """
+    Locate a TINKER program (``analyze``, ``testgrad`` or ``testhess``).
+
+    ``$TINKER_<PROGRAM>`` takes precedence over ``$PATH``. The lookup
+    is only performed the first time each program is needed.
+    """
+    if program not in _tinker_executables:
+        _tinker_executables[program] = (os.environ.get('TINKER_' + program.upper())
+                                        or find_executable(program))
+    return _tinker_executables[program]
+
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        # Backwards compatibility for tinker_analyze & co
+        if name.startswith('tinker_') and name[7:] in _TINKER_PROGRAMS:
+            return tinker_executable(name[7:])
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+else:
+    tinker_testhess = tinker_executable('testhess')
+    tinker_analyze = tinker_executable('analyze')
+    tinker_testgrad = tinker_executable('testgrad')
 
 
 def prepare_tinker_xyz(atoms, bonds=None):
@@ -61,7 +95,113 @@ def prepare_tinker_xyz(atoms, bonds=None):
     return '\n'.join(out)
 
 
-def prepare_tinker_key(forcefield):
+def write_tinker_xyz(path, elements, types, xyz, bond_indptr=None, bond_indices=None,
+                     bond_orders=None, chunk_size=10000):
+    """
+    Write a TINKER-style XYZ file (see ``prepare_tinker_xyz``) straight
+    from per-atom arrays, like those in
+    :class:`garleek.qm.gaussian.GaussianEIn`.
+
+    Coordinates are converted to Angstrom in a single array operation
+    and lines are formatted ``chunk_size`` atoms at a time, so this
+    scales to large MM regions.
+
+    Parameters
+    ----------
+    path : str
+        Destination file
+    elements, types : sequence of str, shape (N,)
+        Element and MM type of each atom
+    xyz : np.array, shape (N, 3)
+        Cartesian coordinates, in bohr
+    bond_indptr, bond_indices, bond_orders : np.array, optional
+        Connectivity, in CSR form. Bonds with order below 0.5 are skipped.
+
+    Returns
+    -------
+    path : str
+    """
+    if types is None:
+        raise ValueError('TINKER needs an MM type for every atom')
+    n_atoms = len(elements)
+    coords = np.asarray(xyz, dtype=float).reshape(n_atoms, 3) * u.RBOHR_TO_ANGSTROM
+    bonds = _tinker_xyz_bonds(n_atoms, bond_indptr, bond_indices, bond_orders)
+    columns = (list(range(1, n_atoms + 1)), np.asarray(elements).tolist(), coords[:, 0].tolist(),
+               coords[:, 1].tolist(), coords[:, 2].tolist(), np.asarray(types).tolist(), bonds)
+    with open(path, 'w') as f:
+        f.write(str(n_atoms))
+        for start in range(0, n_atoms, chunk_size):
+            end = min(start + chunk_size, n_atoms)
+            # Interleave the columns with slice assignments, which run at C speed
+            fields = [None] * (7 * (end - start))
+            for i, column in enumerate(columns):
+                fields[i::7] = column[start:end]
+            f.write('\n%d E%s %.10f %.10f %.10f %s %s' * (end - start) % tuple(fields))
+    return path
+
+
+def _tinker_xyz_bonds(n_atoms, bond_indptr=None, bond_indices=None, bond_orders=None):
+    """
+    Bonded atoms field of each line of a TINKER XYZ file
+    """
+    if bond_indptr is None or not len(bond_indices):
+        return [''] * n_atoms
+    keep = np.asarray(bond_orders) >= 0.5
+    owners = np.repeat(np.arange(n_atoms), np.diff(bond_indptr))
+    counts = np.bincount(owners[keep], minlength=n_atoms)
+    bonded = list(map(str, np.asarray(bond_indices)[keep].tolist()))
+    ends = np.cumsum(counts).tolist()
+    starts = [0] + ends[:-1]
+    return [' '.join(bonded[a:b]) for (a, b) in zip(starts, ends)]
+
+
+def tinker_xyz_templates(elements, types, bond_indptr=None, bond_indices=None,
+                         bond_orders=None, chunk_size=10000):
+    """
+    Preformat everything but the coordinates of a TINKER XYZ file, which
+    stays the same in all the steps of an optimization. The result is a
+    list of ``%``-format templates, one per ``chunk_size`` atoms, for
+    :func:`write_tinker_xyz_templates`. Arguments are like in
+    :func:`write_tinker_xyz`.
+    """
+    if types is None:
+        raise ValueError('TINKER needs an MM type for every atom')
+    n_atoms = len(elements)
+    bonds = _tinker_xyz_bonds(n_atoms, bond_indptr, bond_indices, bond_orders)
+    columns = (list(range(1, n_atoms + 1)),
+               [e.replace('%', '%%') for e in np.asarray(elements).tolist()],
+               [t.replace('%', '%%') for t in np.asarray(types).tolist()], bonds)
+    templates = []
+    for start in range(0, n_atoms, chunk_size):
+        end = min(start + chunk_size, n_atoms)
+        fields = [None] * (4 * (end - start))
+        for i, column in enumerate(columns):
+            fields[i::4] = column[start:end]
+        templates.append('\n%d E%s %%.10f %%.10f %%.10f %s %s' * (end - start) % tuple(fields))
+    if templates:
+        templates[0] = str(n_atoms) + templates[0]
+    else:
+        templates.append(str(n_atoms))
+    return templates
+
+
+def write_tinker_xyz_templates(path, templates, xyz, chunk_size=10000):
+    """
+    Write a TINKER XYZ file from the templates returned by
+    :func:`tinker_xyz_templates` (with the same ``chunk_size``) and
+    the coordinates ``xyz``, in bohr. Only numbers are formatted, so
+    this is faster than :func:`write_tinker_xyz`, and the output is
+    identical.
+    """
+    coords = (np.asarray(xyz, dtype=float).reshape(-1, 3) * u.RBOHR_TO_ANGSTROM).ravel().tolist()
+    step = 3 * chunk_size
+    with open(path, 'w') as f:
+        for i, template in enumerate(templates):
+            f.write(template % tuple(coords[i * step:(i + 1) * step]))
+    return path
+
+
+def prepare_tinker_key(forcefield, extra_keywords=None, directory=None):
     """
     Prepare a file ready for TINKER's -k option.
 
@@ -72,21 +212,199 @@ def prepare_tinker_key(forcefield):
       add more parameters
 
     If a .prm file is provided, a .key file will be written to
-    accommodate the forcefield in a ``parameters *`` call.
+    accommodate the forcefield in a ``parameters *`` call. User-provided
+    key files are used as is, unless ``extra_keywords`` are requested:
+    then a copy with those keywords appended is written.
+
+    Generated key files are named after a hash of their contents, so
+    they are only written once, reused in later calls and never
+    overwritten by other jobs sharing the same directory.
+
+    Parameters
+    ----------
+    forcefield : str
+        Path to the forcefield (.prm) or key file (.key, .par)
+    extra_keywords : list of str, optional
+        Additional TINKER keywords (full lines, like ``openmp-threads 4``)
+    directory : str, optional
+        Where to store generated key files. Defaults to the ``keys``
+        subdirectory of Garleek's cache (see :mod:`garleek.cache`).
 
     Returns
     -------
     path: str
         Absolute path to the generated TINKER .key file
     """
-    if forcefield.lower().endswith('.prm'):
-        with open('garleek.key', 'w') as f:
-            print('parameters', os.path.abspath(forcefield), file=f)
-        return os.path.abspath('garleek.key')
-    elif os.path.splitext(forcefield)[1].lower() in ('.par', '.key'):
-        return os.path.abspath(forcefield)
+    extension = os.path.splitext(forcefield)[1].lower()
+    if extension == '.prm':
+        lines = ['parameters {}'.format(os.path.abspath(forcefield))]
+    elif extension in ('.par', '.key'):
+        if not extra_keywords:
+            return os.path.abspath(forcefield)
+        lines = []
+        keydir = os.path.dirname(os.path.abspath(forcefield))
+        with open(forcefield) as f:
+            for line in f:
+                line = line.rstrip()
+                fields = line.split(None, 1)
+                # The copy lives elsewhere: make relative parameters paths absolute
+                if len(fields) == 2 and fields[0].lower() == 'parameters' \
+                        and os.path.exists(os.path.join(keydir, fields[1])):
+                    line = 'parameters {}'.format(os.path.join(keydir, fields[1]))
+                lines.append(line)
     else:
         raise ValueError('TINKER key file must be .prm, .key or .par')
+    lines.extend(extra_keywords or ())
+    contents = '\n'.join(lines) + '\n'
+
+    from ..cache import cache_dir, hash_bytes, atomic_write
+    if directory is None:
+        directory = cache_dir('keys')
+    path = os.path.abspath(os.path.join(directory, 'garleek-{}.key'.format(hash_bytes(contents)[:16])))
+    if not os.path.isfile(path):
+        atomic_write(path, contents)
+    return path
+
+
+# Number of leading atom type/class fields in trimmable .prm entries.
+# None means "as many integer fields as found" (multipole frames).
+_PRM_INDEX_FIELDS = {
+    'vdw': 1, 'vdw14': 1, 'vdwpr': 2, 'hbond': 2, 'bond': 2, 'bond5': 2,
+    'bond4': 2, 'bond3': 2, 'electneg': 3, 'angle': 3, 'angle5': 3,
+    'angle4': 3, 'angle3': 3, 'anglef': 3, 'anglep': 3, 'strbnd': 3,
+    'ureybrad': 3, 'angang': 1, 'opbend': 4, 'opdist': 4, 'improper': 4,
+    'imptors': 4, 'torsion': 4, 'torsion5': 4, 'torsion4': 4,
+    'strtors': 4, 'angtors': 4, 'pitors': 2, 'tortors': 5, 'charge': 1,
+    'dipole': 2, 'dipole5': 2, 'dipole4': 2, 'dipole3': 2, 'piatom': 1,
+    'pibond': 2, 'pibond5': 2, 'pibond4': 2, 'polarize': 1, 'solute': 1,
+    'multipole': None, 'mmffvdw': 1, 'mmffbond': 2, 'mmffangle': 3,
+    'mmffstrbnd': 3, 'mmffopbend': 4, 'mmfftorsion': 4, 'mmffbci': 2,
+    'mmffpbci': 1,
+}
+# MMFF entries that also carry a bond/angle/torsion type index. TINKER's
+# own files list it after the classes; other sources put it first, which
+# shows as one more leading integer field. The offset skips it.
+_PRM_TYPE_INDEX_FIELDS = set(['mmffbond', 'mmffangle', 'mmffstrbnd', 'mmfftorsion', 'mmffbci'])
+
+
+def _prm_index_offset(keyword, fields, n_fields):
+    """
+    Position of the first atom type/class field in the .prm entry
+    ``fields`` (keyword included)
+    """
+    if (keyword in _PRM_TYPE_INDEX_FIELDS and len(fields) > n_fields + 1
+            and all(f.isdigit() for f in fields[1:n_fields+2])):
+        return 2
+    return 1
+
+
+def _is_number(word):
+    try:
+        float(word.replace('D', 'E').replace('d', 'e'))
+    except ValueError:
+        return False
+    return True
+
+
+def _trim_tinker_prm_lines(lines, types):
+    """
+    Keep the .prm ``lines`` that can be needed by a system containing
+    atom ``types`` only. Parameters are kept if all their atom
+    types/classes are used (or wildcards); unknown keywords are
+    always kept. For MMFF, step-down equivalences and aromatic types
+    are added to the used set, and their tables are kept untouched;
+    bond/angle/torsion type indices are skipped, leading or trailing.
+    """
+    types = set(types)
+    classes = set()
+    is_mmff = False
+    for line in lines:
+        fields = line.split()
+        if not fields:
+            continue
+        if fields[0] == 'atom' and int(fields[1]) in types:
+            classes.add(int(fields[2]) if fields[2].isdigit() else int(fields[1]))
+        elif fields[0].startswith('mmff'):
+            is_mmff = True
+    used = types | classes | set([0])
+    if is_mmff:
+        for line in lines:
+            fields = line.split('#', 1)[0].split()
+            if fields and fields[0] == 'mmffequiv' and int(fields[-1]) in types:
+                used.update(int(f) for f in fields[1:-1])
+            elif fields and fields[0] == 'mmffarom':
+                used.add(int(fields[1]))
+        types = types | used
+
+    trimmed, keep = [], True
+    for line in lines:
+        fields = line.split()
+        if not fields or fields[0].startswith('#'):
+            continue
+        keyword = fields[0].lower()
+        if _is_number(keyword):  # continuation of the previous entry
+            if keep:
+                trimmed.append(line)
+            continue
+        if keyword == 'atom':
+            keep = int(fields[1]) in types
+        elif keyword in _PRM_INDEX_FIELDS:
+            n_fields = _PRM_INDEX_FIELDS[keyword]
+            if n_fields is None:
+                indices = []
+                for field in fields[1:]:
+                    if not field.lstrip('-').isdigit():
+                        break
+                    indices.append(abs(int(field)))
+            else:
+                offset = _prm_index_offset(keyword, fields, n_fields)
+                indices = [int(f) for f in fields[offset:offset+n_fields]]
+            keep = all(i in used for i in indices)
+        else:
+            keep = True
+        if keep:
+            trimmed.append(line)
+    return trimmed
+
+
+def trim_tinker_prm(forcefield, types, directory=None):
+    """
+    Build a reduced copy of the ``forcefield`` .prm file, listing only
+    the atom types, classes and parameters relevant for a system made of
+    atom ``types``. Every TINKER process parses the whole parameter file,
+    so smaller files mean cheaper TINKER calls.
+
+    The result is cached on disk, named after a hash of the forcefield
+    contents and the set of types, so it can be reused across steps
+    and jobs.
+
+    Parameters
+    ----------
+    forcefield : str
+        Path to a TINKER ``*.prm`` file
+    types : iterable of int or str
+        TINKER atom types present in the system
+    directory : str, optional
+        Where to store the trimmed file. Defaults to the ``prm``
+        subdirectory of Garleek's cache (see :mod:`garleek.cache`).
+
+    Returns
+    -------
+    path : str
+        Absolute path to the trimmed .prm file
+    """
+    from ..cache import cache_dir, file_hash, hash_bytes, atomic_write
+    types = sorted(set(int(t) for t in types))
+    if directory is None:
+        directory = cache_dir('prm')
+    digest = hash_bytes(file_hash(forcefield), ' '.join(map(str, types)))
+    name = os.path.splitext(os.path.basename(forcefield))[0]
+    path = os.path.abspath(os.path.join(directory, '{}-{}.prm'.format(name, digest[:16])))
+    if not os.path.isfile(path):
+        with open(forcefield) as f:
+            lines = f.readlines()
+        atomic_write(path, ''.join(_trim_tinker_prm_lines(lines, types)))
+    return path
 
 
 def _decode(data):
@@ -96,126 +414,687 @@ def _decode(data):
         return data.decode('utf-8', 'ignore')
 
 
+def _lines(data):
+    """
+    Lines of a TINKER output, given as bytes, text or an iterable
+    of already split lines (e.g. a :class:`_TinkerOutput` stream).
+    """
+    if isinstance(data, bytes):
+        return _decode(data).splitlines()
+    if isinstance(data, str):
+        return data.splitlines()
+    return data
+
+
 def _parse_tinker_analyze(data):
     """
     Takes the output of TINKER's ``analyze`` program and obtain
     the potential energy (kcal/mole) and the dipole x, y, z
     components (debyes).
+
+    ``data`` can also be an iterable of lines; reading stops as
+    soon as the dipole is found. Values not found are returned as None.
     """
     energy, dipole = None, None
-    for line in _decode(data).splitlines():
+    for line in _lines(data):
         line = line.strip()
         if line.startswith('Total Potential Energy'):
             energy = float(line.split()[4])
         elif line.startswith('Dipole X,Y,Z-Components'):
             dipole = list(map(float, line.split()[3:6]))
             break
-    return energy, np.array(dipole)
+    return energy, None if dipole is None else np.array(dipole)
 
 
-def _parse_tinker_testgrad(data):
+def _parse_tinker_testgrad(data, n_atoms=None):
     """
+    Takes the output of TINKER's ``testgrad`` program and obtain
+    the potential energy (kcal/mole) and the analytical gradient
+    for each atom (kcal/mole/A). ``testgrad`` reports the energy
+    with more digits than ``analyze`` does by default.
 
+    ``data`` can also be an iterable of lines; reading stops right
+    after the gradient breakdown. If ``n_atoms`` is given, gradients
+    are written straight into a preallocated (N, 3) array, and a
+    ``ValueError`` is raised if the breakdown lists a different number
+    of atoms. Values not found are returned as None.
     """
-    gradients = []
-    lines = _decode(data).splitlines()
-    for i, line in enumerate(lines):
+    energy = None
+    lines = iter(_lines(data))
+    for line in lines:
         line = line.strip()
-        if line.startswith('Cartesian Gradient Breakdown over Individual Atoms'):
+        if line.startswith('Total Potential Energy'):
+            energy = float(line.split()[4])
+        elif line.startswith('Cartesian Gradient Breakdown over Individual Atoms'):
             break
+    else:
+        return energy, None
 
-    for line in lines[i+4:]:
-        line = line.strip()
-        if not line or line.startswith('Total Gradient'):
-            break
+    for _ in range(3):  # blank, column titles, blank
+        next(lines, None)
+    rows = []
+    gradients = None if n_atoms is None else np.empty((n_atoms, 3))
+    count = 0
+    for line in lines:
         fields = line.split()
-        gradients.append(list(map(float, fields[2:5])))
+        if not fields or fields[0] == 'Total':
+            break
+        if gradients is None:
+            rows.append(fields[2:5])
+        elif count < n_atoms:
+            gradients[count] = fields[2:5]
+        count += 1
+    if gradients is None:
+        return energy, np.array(rows, dtype=float)
+    if count != n_atoms:
+        raise ValueError('TINKER reported gradients for {} atoms, '
+                         'expected {}'.format(count, n_atoms))
+    return energy, gradients
 
-    return np.array(gradients)
 
+# Text decoded at once when reading .hes files in memory mode;
+# decoding needs about six times as much
+HES_DECODE_BYTES = 4 * 2**20
+_HES_HEADER = re.compile(br'Hessian Elements(?: for Atom\s+(\d+)\s+([XYZ]))?[^\n]*\n')
 
-def _parse_tinker_testhess(hesfile, n_atoms):
+
+def _parse_fixed_width(block):
+    """
+    Decode a block of Fortran ``Fw.d`` reals (like TINKER's ``6f12.4``)
+    with array operations on the raw bytes. Fixed-width fields are
+    decoded correctly even if large values leave no blank between them.
+    Returns None if the block does not look like fixed-width data.
     """
+    first = block[:1024].lstrip(b'\r\n').split(b'\n', 1)[0].rstrip(b'\r')
+    dot = first.find(b'.')
+    if dot < 0:
+        return None
+    decimals = len(first[dot+1:]) - len(first[dot+1:].lstrip(b'0123456789'))
+    width = dot + decimals + 1
+    chars = np.frombuffer(block, dtype=np.uint8)
+    chars = chars[(chars != 10) & (chars != 13)]
+    if not decimals or chars.size % width:
+        return None
+    fields = chars.reshape(-1, width)
+    if np.any(fields[:, width - decimals - 1] != ord('.')):
+        return None
+    negative = np.flatnonzero(chars == ord('-')) // width
+    digits = chars - np.uint8(ord('0'))  # anything but digits wraps around above 9
+    digits[digits > 9] = 0
+    digits = digits.reshape(-1, width)
+    whole = np.zeros(fields.shape[0], dtype=np.int64)
+    for column in range(width):
+        if column != width - decimals - 1:
+            whole *= 10
+            whole += digits[:, column]
+    values = whole / 10.0**decimals
+    values[negative] *= -1
+    return values
+
 
+def _hes_values(data, max_bytes=None):
     """
-    hessian = np.zeros((n_atoms * 3, n_atoms * 3))
-    xyz_to_int = {'X': 0, 'Y': 1, 'Z': 2}
-    with open(hesfile) as lines:
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-            elif line.startswith('Diagonal'):
-                _, line = next(lines), next(lines).strip()  # skip blank line
-                block = []
-                while line:
-                    block.append(line)
-                    line = next(lines).strip()
-                nums = list(map(float, ' '.join(block).split()))
-                for i, num in enumerate(nums):
-                    hessian[i, i] = num
-            elif line.startswith('Off-diagonal'):
-                fields = line.split()
-                atom_pos, axis_pos = int(fields[-2])-1, xyz_to_int[fields[-1]]
-                _, line = next(lines), next(lines).strip()  # skip blank line
-                block = []
-                while line:
-                    block.append(line)
-                    try:
-                        line = next(lines).strip()
-                    except StopIteration:
-                        break
-                nums = list(map(float, ' '.join(block).split()))
-                j = 3*atom_pos+axis_pos
-                for i, num in enumerate(nums):
-                    hessian[i+j+1, j] = num
+    Locate the blocks of a ``.hes`` file (any bytes-like object) and
+    decode their values in bulk. Yields ``(columns, values)`` for groups
+    of consecutive blocks spanning at most ``max_bytes`` of text (all of
+    them at once if None), where ``columns`` lists the Hessian column of
+    each block, in file order (None for the diagonal block).
+    """
+    headers = list(_HES_HEADER.finditer(data))
+    blocks, chunks, group_size = [], [], 0
+    for header, following in zip(headers, headers[1:] + [None]):
+        end = len(data) if following is None else data.rfind(b'\n', 0, following.start()) + 1
+        if max_bytes and chunks and group_size + end - header.end() > max_bytes:
+            yield blocks, _decode_hes_chunks(chunks)
+            blocks, chunks, group_size = [], [], 0
+        chunks.append(data[header.end():end])
+        group_size += end - header.end()
+        if header.group(1) is None:
+            blocks.append(None)
+        else:
+            blocks.append(3 * (int(header.group(1)) - 1) + 'XYZ'.index(header.group(2).decode()))
+    if chunks:
+        yield blocks, _decode_hes_chunks(chunks)
+
+
+def _decode_hes_chunks(chunks):
+    body = b''.join(chunks)
+    values = np.zeros(0) if body.isspace() or not body else _parse_fixed_width(body)
+    if values is None:
+        values = np.array(body.split(), dtype=float)
+    return values
+
+
+def _row_bands(size, max_bytes):
+    """
+    Split the rows of a ``size`` x ``size`` lower triangle into bands
+    whose (rectangular) working arrays fit in about ``max_bytes``.
+    Yields ``(first_row, n_rows)``.
+    """
+    # Each element in a band needs a value, an index and a mask entry
+    limit = max(max_bytes // 24, 1)
+    first = 0
+    while first < size:
+        rows = min(size - first, max(limit // (first + 1), 1))
+        while rows > 1 and rows * (first + rows) > limit:
+            rows //= 2
+        yield first, rows
+        first += rows
+
+
+class DiskHessian(object):
+
+    """
+    Packed Hessian stored in a temporary, disk-backed ``np.memmap``, for
+    systems whose Hessian does not fit comfortably in memory.
+
+    Values are stored column by column (lower triangle, column-major),
+    which is the order of TINKER's ``.hes`` file, and read back in
+    bands of rows by ``packed_rows``, in the lower triangular row-major
+    order Gaussian expects. No step holds more than about ``max_bytes``
+    of data in memory.
+
+    Parameters
+    ----------
+    size : int
+        Number of rows (3N)
+    directory : str, optional
+        Where to create the backing file. Defaults to the system
+        temporary directory.
+    max_bytes : int, optional
+        Memory budget for each read/write step. Defaults to 256 MB.
+    """
+
+    def __init__(self, size, directory=None, max_bytes=None):
+        self.size = size
+        self.max_bytes = max_bytes or 256 * 2**20
+        with NamedTemporaryFile(suffix='.hessian', dir=directory, delete=False) as f:
+            self.path = f.name
+        self.data = np.memmap(self.path, dtype=float, mode='w+',
+                              shape=(max(size * (size + 1) // 2, 1),))
+        columns = np.arange(size)
+        self._column_starts = columns * size - columns * (columns - 1) // 2
+
+    def store_block(self, column, values):
+        """
+        Store a ``.hes`` block: the diagonal if ``column`` is None,
+        or the elements under the diagonal of ``column`` otherwise.
+        """
+        if column is None:
+            self.data[self._column_starts[:values.size]] = values
+        else:
+            start = self._column_starts[column] + 1
+            self.data[start:start+values.size] = values
+
+    def packed_rows(self, scale=1.0):
+        """
+        Yield the lower triangle in row-major order, in bands of rows,
+        each multiplied by ``scale``.
+        """
+        for first, rows in _row_bands(self.size, self.max_bytes):
+            row = np.arange(first, first + rows)[:, None]
+            column = np.arange(first + rows)[None, :]
+            lower = column <= row
+            index = np.where(lower, self._column_starts[column] + row - column, 0)
+            yield self.data[index][lower] * scale
+
+    def close(self):
+        """
+        Release and remove the backing file
+        """
+        self.data = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class SparseHessian(object):
+
+    """
+    Hessian keeping only the diagonal and the off-diagonal elements
+    whose magnitude reaches ``cutoff``, which exploits the locality of
+    MM force constants. It is expanded to Gaussian's packed lower
+    triangular layout, band by band, only while streaming the EOu file.
+
+    Built by ``_parse_tinker_testhess`` in ``sparse`` mode, one
+    ``.hes`` block at a time with ``store_block``, then ``finalize``.
+
+    Attributes
+    ----------
+    diagonal : np.array, shape (3N,)
+    rows, columns : np.array of int
+        Position of the kept off-diagonal elements (row > column),
+        sorted in row-major order
+    values : np.array
+        Kept off-diagonal elements
+    discarded : dict
+        Statistics about the elements below ``cutoff``: ``count``,
+        ``max`` (largest magnitude), ``norm`` and ``relative_norm``
+        (Frobenius norms of the discarded part of the symmetric matrix,
+        absolute and relative to the whole matrix).
+    """
+
+    def __init__(self, size, cutoff, max_bytes=None):
+        self.size = size
+        self.cutoff = cutoff
+        self.max_bytes = max_bytes or 256 * 2**20
+        self.diagonal = np.zeros(size)
+        self._blocks = []
+        self._discarded = [0, 0.0, 0.0]  # count, max, sum of squares
+        self._total = 0.0  # sum of squares
+        self.rows = self.columns = self.values = None
+        self.discarded = None
+
+    def store_block(self, column, values):
+        if column is None:
+            self.diagonal[:values.size] = values
+            self._total += np.dot(values, values)
+            return
+        magnitude = np.abs(values)
+        keep = magnitude >= self.cutoff
+        dropped = values[~keep]
+        if dropped.size:
+            self._discarded[0] += dropped.size
+            self._discarded[1] = max(self._discarded[1], magnitude[~keep].max())
+            self._discarded[2] += 2 * np.dot(dropped, dropped)
+        self._total += 2 * np.dot(values, values)
+        rows = np.flatnonzero(keep) + column + 1
+        self._blocks.append((rows, np.full(rows.size, column), values[keep]))
+
+    def finalize(self):
+        if self._blocks:
+            rows, columns, values = [np.concatenate(x) for x in zip(*self._blocks)]
+        else:
+            rows, columns, values = np.zeros(0, int), np.zeros(0, int), np.zeros(0)
+        order = np.lexsort((columns, rows))
+        self.rows, self.columns, self.values = rows[order], columns[order], values[order]
+        self._row_starts = np.searchsorted(self.rows, np.arange(self.size + 1))
+        self._blocks = None
+        count, largest, squares = self._discarded
+        self.discarded = {'count': count, 'max': largest, 'norm': squares ** 0.5,
+                          'relative_norm': (squares / self._total) ** 0.5 if self._total else 0.0}
+        return self
+
+    def report(self):
+        """
+        One-line summary of the kept and discarded elements
+        """
+        off_diagonal = self.size * (self.size - 1) // 2
+        return ('Sparse Hessian: kept {} of {} off-diagonal elements (cutoff {:g}); '
+                'discarded max |H| = {:.4g}, norm = {:.4g} ({:.3g} of total)').format(
+                    self.values.size, off_diagonal, self.cutoff, self.discarded['max'],
+                    self.discarded['norm'], self.discarded['relative_norm'])
+
+    def packed_rows(self, scale=1.0):
+        """
+        Yield the lower triangle in row-major order, in bands of rows,
+        each multiplied by ``scale``.
+        """
+        for first, rows in _row_bands(self.size, self.max_bytes):
+            band = np.zeros((rows, first + rows))
+            start, end = self._row_starts[first], self._row_starts[first + rows]
+            band[self.rows[start:end] - first, self.columns[start:end]] = self.values[start:end]
+            diagonal = np.arange(rows)
+            band[diagonal, diagonal + first] = self.diagonal[first:first + rows]
+            lower = np.arange(first + rows)[None, :] <= np.arange(first, first + rows)[:, None]
+            yield band[lower] * scale
+
+    def close(self):
+        pass
+
+
+def _parse_tinker_testhess(hesfile, n_atoms, mode='memory', max_memory=None, cutoff=0.0,
+                           directory=None):
+    """
+    Read the Hessian written by ``testhess`` into packed lower triangular
+    storage: element (i, j), with j <= i, lives in position
+    ``i*(i+1)//2 + j`` of a flat array of size 3N(3N+1)/2. This is the
+    order Gaussian expects in the EOu file, and the square matrix is
+    never built.
+
+    The file is memory-mapped and its numeric blocks are decoded with
+    array operations (see ``_parse_fixed_width``), so the interpreter
+    does no per-line or per-value work. Blocks are decoded in groups of
+    about ``HES_DECODE_BYTES`` of text, so the memory needed on top of
+    the packed Hessian does not grow with the size of the file.
+
+    With ``mode='memmap'``, the Hessian is assembled on disk instead,
+    in ``directory`` (the system temporary directory by default), and a
+    :class:`DiskHessian` is returned. With ``mode='sparse'``, a
+    :class:`SparseHessian` keeping the elements above ``cutoff`` is
+    returned. In both cases the file is decoded in pieces of about
+    ``max_memory`` bytes.
+    """
+    size = n_atoms * 3
+    if mode == 'memmap':
+        hessian = DiskHessian(size, directory=directory, max_bytes=max_memory)
+        store_block = hessian.store_block
+        max_bytes = hessian.max_bytes // 4  # decoding needs a few copies of the text
+    elif mode == 'sparse':
+        hessian = SparseHessian(size, cutoff, max_bytes=max_memory)
+        store_block = hessian.store_block
+        max_bytes = hessian.max_bytes // 4
+    else:
+        hessian = np.zeros(size * (size + 1) // 2)
+        row_starts = np.arange(size) * (np.arange(size) + 1) // 2
+        max_bytes = HES_DECODE_BYTES
+
+        def store_block(column, values):
+            if column is None:
+                diagonal = np.arange(values.size)
+                hessian[row_starts[diagonal] + diagonal] = values
+            else:
+                hessian[row_starts[column+1:column+1+values.size] + column] = values
+
+    with open(hesfile, 'rb') as f:
+        if os.fstat(f.fileno()).st_size:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for columns, values in _hes_values(data, max_bytes=max_bytes):
+                    # Block sizes follow from the matrix layout: 3N diagonal elements,
+                    # then the 3N-j-1 elements under the diagonal of column j
+                    start = 0
+                    for column in columns:
+                        count = size if column is None else size - column - 1
+                        store_block(column, values[start:start+count])
+                        start += count
+            finally:
+                data.close()
     os.remove(hesfile)
+    if mode == 'sparse':
+        hessian.finalize()
     return hessian
 
 
+class _TinkerOutput(object):
+
+    """
+    Iterate over the decoded lines of a TINKER process stdout as they
+    arrive. Only the last ``keep`` lines are kept, for error reports.
+    """
+
+    def __init__(self, stream, keep=100):
+        self.stream = stream
+        self.tail = deque(maxlen=keep)
+
+    def __iter__(self):
+        for line in iter(self.stream.readline, b''):
+            self.tail.append(line)
+            yield _decode(line)
+
+    def drain(self):
+        """
+        Discard whatever the parser did not need, so the process can exit
+        """
+        leftover = b''
+        for chunk in iter(lambda: self.stream.read(65536), b''):
+            leftover = (leftover + chunk)[-8192:]
+        self.tail.extend(leftover.splitlines(True))
+
+    @property
+    def output(self):
+        return b''.join(self.tail)
+
+
+def _wait(process):
+    """
+    Wait for ``process`` to finish. Returns its exit code and, where
+    ``os.wait4`` is available, its resource usage (None otherwise).
+    """
+    if hasattr(os, 'wait4') and isinstance(getattr(process, 'pid', None), int):
+        _, status, rusage = os.wait4(process.pid, 0)
+        if os.WIFSIGNALED(status):
+            process.returncode = -os.WTERMSIG(status)
+        else:
+            process.returncode = os.WEXITSTATUS(status)
+        return process.returncode, rusage
+    return process.wait(), None
+
+
+def _usage(program, wall, returncode, rusage=None, env=None):
+    """
+    Resource usage of a finished TINKER process, as a dict with
+    ``program``, ``wall``, ``cpu``, ``user``, ``sys`` (seconds),
+    ``max_rss`` (peak resident memory, bytes), ``returncode`` and
+    ``threads`` (``$OMP_NUM_THREADS``). Values that are not available
+    are None.
+    """
+    usage = {'program': program, 'wall': wall, 'returncode': returncode,
+             'cpu': None, 'user': None, 'sys': None, 'max_rss': None,
+             'threads': (env if env is not None else os.environ).get('OMP_NUM_THREADS')}
+    if usage['threads']:
+        try:
+            usage['threads'] = int(usage['threads'])
+        except ValueError:
+            usage['threads'] = None
+    if rusage is not None:
+        usage.update(user=rusage.ru_utime, sys=rusage.ru_stime,
+                     cpu=rusage.ru_utime + rusage.ru_stime,
+                     # kilobytes on Linux, bytes on macOS
+                     max_rss=rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024))
+    return usage
+
+
+def _format_usage(usage):
+    line = 'TINKER {program}: wall {wall:.3f} s'.format(**usage)
+    if usage['cpu'] is not None:
+        line += ', cpu {cpu:.3f} s (user {user:.3f} s, sys {sys:.3f} s)'.format(**usage)
+    if usage['max_rss'] is not None:
+        line += ', peak RSS {:.1f} MB'.format(usage['max_rss'] / 2**20)
+    return line + ', exit status {}'.format(usage['returncode'])
+
+
+def _run_tinker_job(command, parser, env=None, name=None, recorder=NULL_RECORDER, after=None):
+    """
+    Run ``command``, parsing its stdout while it is produced. The parser
+    receives an iterable of lines and may return before consuming all
+    of them. Returns the last lines of output, the parsed value and the
+    resource usage of the process (see ``_usage``), which is also
+    reported to ``recorder`` (see :mod:`garleek.timing`).
+
+    Outputs written to files are only complete once the process is done:
+    ``after``, if given, is called with the parsed value after the
+    process exited successfully, and its result is returned instead.
+    """
+    print('Running TINKER:', *command)
+    t0 = time.time()
+    process = Popen(command, stdout=PIPE, env=env)
+    stdout = _TinkerOutput(process.stdout)
+    try:
+        parsed = parser(stdout)
+        stdout.drain()
+    finally:
+        process.stdout.close()
+        returncode, rusage = _wait(process)
+        usage = _usage(name or os.path.basename(command[0]), time.time() - t0,
+                       returncode, rusage, env)
+        print(_format_usage(usage))
+        recorder.subprocess(**usage)
+    if returncode:
+        raise CalledProcessError(returncode, command, output=stdout.output)
+    if after is not None:
+        parsed = after(parsed)
+    return stdout.output, parsed, usage
+
+
+def _run_tinker_jobs(jobs, concurrency=1, threads=None, recorder=NULL_RECORDER):
+    """
+    Run independent TINKER programs, optionally at the same time.
+
+    Parameters
+    ----------
+    jobs : list of (name, command, parser) or (name, command, parser, after)
+        ``parser`` is called with an iterable over the stdout lines of
+        ``command``, while it runs. ``after`` is called with its result
+        once ``command`` exited successfully (see ``_run_tinker_job``).
+    concurrency : int, optional=1
+        Maximum number of TINKER processes running at once.
+    threads : int, optional
+        Total number of OpenMP threads to share among the concurrent
+        TINKER processes, through ``$OMP_NUM_THREADS``. If not set,
+        the environment is left untouched.
+    recorder : garleek.timing.TimingRecorder, optional
+        Receives the timings of each TINKER process
+
+    Returns
+    -------
+    outputs : dict
+        Maps each job name to a ``(stdout, parsed, usage)`` tuple, where
+        ``stdout`` only holds the last lines of output and ``usage`` is
+        the resource usage of the process
+    """
+    concurrency = max(1, min(concurrency or 1, len(jobs)))
+    env = None
+    if threads:
+        env = os.environ.copy()
+        env['OMP_NUM_THREADS'] = str(max(1, threads // concurrency))
+    jobs = [tuple(job) + (None,) * (4 - len(job)) for job in jobs]
+    if concurrency == 1:
+        return dict((name, _run_tinker_job(command, parser, env, name, recorder, after))
+                    for (name, command, parser, after) in jobs)
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [(name, executor.submit(_run_tinker_job, command, parser, env, name, recorder,
+                                          after))
+                   for (name, command, parser, after) in jobs]
+        return dict((name, future.result()) for (name, future) in futures)
+
+
 def run_tinker(xyz_data, n_atoms, key, energy=True, dipole_moment=True,
-               gradients=True, hessian=True):
+               gradients=True, hessian=True, mode='separate', concurrency=1,
+               threads=None, xyz_file=None, hessian_mode='memory', max_memory=None,
+               hessian_cutoff=0.0, hessian_dir=None, recorder=NULL_RECORDER):
+    """
+    Run the TINKER programs needed to obtain the requested quantities.
+
+    ``analyze``, ``testgrad`` and ``testhess`` do not depend on each
+    other, so they can run concurrently (see ``concurrency``); wall time
+    is then that of the slowest program instead of their sum.
+
+    Parameters
+    ----------
+    xyz_data : str
+        Contents of the TINKER XYZ file, as returned by ``prepare_tinker_xyz``.
+        Ignored if ``xyz_file`` is given.
+    n_atoms : int
+        Number of atoms in the system
+    key : str
+        Path to the TINKER key file, as returned by ``prepare_tinker_key``
+    energy, dipole_moment, gradients, hessian : bool
+        Quantities to compute
+    mode : str, optional=separate
+        How to split the work among TINKER programs when gradients are requested:
+
+        - ``separate``: ``analyze`` reports energy and dipole, ``testgrad``
+          reports the gradients.
+        - ``combined``: ``testgrad`` reports both energy and gradients.
+          ``analyze`` only runs if the dipole moment is requested, which
+          saves one TINKER process otherwise.
+    concurrency : int, optional=1
+        Maximum number of TINKER programs running at the same time
+    threads : int, optional
+        OpenMP threads budget, split evenly among concurrent programs.
+        If not set, ``$OMP_NUM_THREADS`` is left untouched.
+    xyz_file : str, optional
+        Path to an already written TINKER XYZ file (see ``write_tinker_xyz``).
+        It is left in place; the caller is responsible for removing it.
+    hessian_mode : str, optional=memory
+        ``memory`` returns the packed Hessian as an array; ``memmap``
+        assembles it on disk and returns a :class:`DiskHessian`, which
+        the caller must ``close``. ``sparse`` returns a :class:`SparseHessian`.
+    max_memory : int, optional
+        Memory budget (bytes) for ``memmap`` and ``sparse`` modes.
+    hessian_cutoff : float, optional=0
+        Off-diagonal elements below this magnitude (kcal/mol/A^2) are
+        dropped in ``sparse`` mode.
+    hessian_dir : str, optional
+        Where ``memmap`` mode creates its file. Defaults to the system
+        temporary directory.
+    recorder : garleek.timing.TimingRecorder, optional
+        Receives the resource usage of each TINKER process
+
+    Returns
+    -------
+    results : dict
+        Requested values, in TINKER units (see :mod:`garleek.mm`). If the
+        dipole moment was not requested, it is reported as zeros. The
+        resource usage of each TINKER process (wall, user and system
+        CPU time, peak RSS, exit status) is listed under ``processes``.
+    """
+    if mode not in TINKER_MODES:
+        raise ValueError('`mode` must be one of {}'.format(', '.join(TINKER_MODES)))
+    if hessian_mode not in HESSIAN_MODES:
+        raise ValueError('`hessian_mode` must be one of {}'.format(', '.join(HESSIAN_MODES)))
+    tinker_analyze, tinker_testgrad, tinker_testhess = map(tinker_executable, _TINKER_PROGRAMS)
     if not all([tinker_testhess, tinker_analyze, tinker_testgrad]):
         raise RuntimeError('TINKER executables could not be found in $PATH')
 
     error = 'Could not obtain {}! Command run:\n  {}\n\nTINKER output:\n{}'
 
-    with NamedTemporaryFile(suffix='.xyz', delete=False, mode='w') as f_xyz:
-        f_xyz.write(xyz_data)
-        xyz = f_xyz.name
+    if xyz_file is None:
+        with NamedTemporaryFile(suffix='.xyz', delete=False, mode='w') as f_xyz:
+            f_xyz.write(xyz_data)
+            xyz = f_xyz.name
+    else:
+        xyz = xyz_file
+    hesfile = os.path.splitext(xyz)[0] + '.hes'
 
-    results = {}
+    # In combined mode, testgrad reports the energy too
+    energy_from_testgrad = energy and gradients and mode == 'combined'
+    if energy_from_testgrad:
+        energy = False
+    jobs = []
     if energy or dipole_moment:
         args = ','.join(['E' if energy else '', 'M' if dipole_moment else ''])
-        command = [tinker_analyze, xyz, '-k', key, args]
-        print('Running TINKER:', *command)
-        output = check_output(command)
-        energy, dipole = _parse_tinker_analyze(output)
-        if energy is None:
-            raise ValueError(error.format('energy', ' '.join(command), _decode(output)))
-        results['energy'] = energy
-        if dipole is None:
-            raise ValueError(error.format('dipole', ' '.join(command), _decode(output)))
-        results['dipole_moment'] = dipole
-
+        jobs.append(('analyze', [tinker_analyze, xyz, '-k', key, args],
+                     _parse_tinker_analyze))
     if gradients:
-        command = [tinker_testgrad, xyz, '-k', key,  'y', 'n', '0.1D-04']
-        print('Running TINKER:', *command)
-        output = check_output(command)
-        gradients = _parse_tinker_testgrad(output)
+        jobs.append(('testgrad', [tinker_testgrad, xyz, '-k', key,  'y', 'n', '0.1D-04'],
+                     lambda output: _parse_tinker_testgrad(output, n_atoms)))
+    if hessian:
+        # The .hes file is only complete (or there at all) once testhess succeeded
+        jobs.append(('testhess', [tinker_testhess, xyz, '-k', key, 'y', 'n'],
+                     lambda output: None,
+                     lambda _: _parse_tinker_testhess(hesfile, n_atoms, mode=hessian_mode,
+                                                      max_memory=max_memory,
+                                                      cutoff=hessian_cutoff,
+                                                      directory=hessian_dir)))
+    commands = dict((job[0], ' '.join(job[1])) for job in jobs)
+
+    try:
+        outputs = _run_tinker_jobs(jobs, concurrency=concurrency, threads=threads,
+                                   recorder=recorder)
+    finally:
+        if xyz_file is None:
+            os.remove(xyz)
+
+    results = {'processes': [outputs[job[0]][2] for job in jobs]}
+    if 'analyze' in outputs:
+        output, (analyze_energy, dipole), _ = outputs['analyze']
+        if energy:
+            if analyze_energy is None:
+                raise ValueError(error.format('energy', commands['analyze'], _decode(output)))
+            results['energy'] = analyze_energy
+        if dipole_moment:
+            if dipole is None:
+                raise ValueError(error.format('dipole', commands['analyze'], _decode(output)))
+            results['dipole_moment'] = dipole
+    if not dipole_moment:
+        results['dipole_moment'] = np.zeros(3)
+
+    if 'testgrad' in outputs:
+        output, (testgrad_energy, gradients), _ = outputs['testgrad']
         if gradients is None:
-            raise ValueError(error.format('gradients', ' '.join(command), _decode(output)))
+            raise ValueError(error.format('gradients', commands['testgrad'], _decode(output)))
         results['gradients'] = gradients
+        if energy_from_testgrad:
+            if testgrad_energy is None:
+                raise ValueError(error.format('energy', commands['testgrad'], _decode(output)))
+            results['energy'] = testgrad_energy
 
-    if hessian:
-        command = [tinker_testhess, xyz, '-k', key, 'y', 'n']
-        print('Running TINKER:', *command)
-        output = check_output(command)
-        hesfile = os.path.splitext(xyz)[0] + '.hes'
-        hessian = _parse_tinker_testhess(hesfile, n_atoms)
+    if 'testhess' in outputs:
+        output, hessian, _ = outputs['testhess']
         if hessian is None:
-            raise ValueError(error.format('hessian', ' '.join(command), _decode(output)))
+            raise ValueError(error.format('hessian', commands['testhess'], _decode(output)))
         results['hessian'] = hessian
 
-    os.remove(xyz)
     return results
@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+mm.tinker_standin.py
+====================
+
+Deterministic stand-in for TINKER's ``analyze``, ``testgrad`` and
+``testhess`` programs, for testing and benchmarking the rest of the
+pipeline on machines without TINKER.
+
+The stand-in reads the same TINKER XYZ files and command lines, and
+writes the same output (TINKER 8.1 layout, including the ``.hes``
+file), but the values come from a toy forcefield: a harmonic spring
+along each bond plus fixed partial charges for the dipole moment. Results
+depend only on the input, so they are reproducible anywhere.
+
+Install it in a directory with::
+
+    python -m garleek.mm.tinker_standin install DIRECTORY
+
+which writes ``analyze``, ``testgrad`` and ``testhess`` executables there
+and prints the ``TINKER_*`` variables pointing to them (prepending the
+directory to ``$PATH`` works too).
+
+The time each program takes follows a synthetic cost model, configured
+through environment variables (all in seconds, 0 by default):
+
+- ``$GARLEEK_STANDIN_STARTUP``: fixed cost of every run
+- ``$GARLEEK_STANDIN_PER_ATOM``: cost per atom
+- ``$GARLEEK_STANDIN_PER_HESSIAN_ELEMENT``: cost per element of the
+  packed Hessian, ``3N(3N+1)/2`` (``testhess`` only)
+
+The cost is spent sleeping, unless ``$GARLEEK_STANDIN_BUSY`` is set, in
+which case a CPU is kept busy instead. The stand-in itself is
+vectorized, so energies and gradients of 100k-atom systems take about a
+second. Like TINKER's, the ``.hes`` file is dense, so its size grows
+with the square of the number of atoms.
+
+The toy Hessian only couples bonded atoms, which is much sparser than a
+real MM Hessian (``$GARLEEK_STANDIN_HESSIAN=bonds``, the default). Set
+``$GARLEEK_STANDIN_HESSIAN=band:<width>`` to also
+couple every atom with the next ``width`` atoms (in file order), with
+force constants decaying with the index distance and zeros elsewhere.
+Those elements are not derivatives of the toy energy; they exist to
+benchmark the ``sparse`` and ``memmap`` Hessian modes with a realistic
+number of non-zero elements. Only the lines holding them are formatted,
+so large banded files are written at I/O speed.
+"""
+
+from __future__ import print_function, absolute_import, division
+import os
+import stat
+import sys
+import time
+import numpy as np
+
+PROGRAMS = 'analyze', 'testgrad', 'testhess'
+BOND_K = 300.0  # kcal/mol/A^2
+BOND_R0 = 1.1  # A
+DEBYE_PER_EA = 4.80320
+BAND_K = 10.0  # kcal/mol/A^2, coupling of consecutive atoms in banded Hessians
+_BANNER = """
+     ######################################################################
+   ##########################################################################
+  ###                                                                      ###
+ ###            TINKER  ---  Software Tools for Molecular Design            ###
+ ##                                                                          ##
+ ##                   Version 8.1  (Garleek stand-in)                        ##
+ ##                                                                          ##
+   ##########################################################################
+     ######################################################################
+
+"""
+
+
+def read_tinker_xyz(path):
+    """
+    Parse a TINKER XYZ file.
+
+    Returns
+    -------
+    xyz : np.ndarray, shape=(N, 3)
+    types : np.ndarray of int, shape=(N,)
+    bonds : np.ndarray of int, shape=(B, 2)
+        0-based atom indices, each bond listed once (first < second)
+    """
+    with open(path) as f:
+        n_atoms = int(f.readline().split()[0])
+        xyz = np.empty((n_atoms, 3))
+        types = np.zeros(n_atoms, dtype=int)
+        bonds = []
+        for i in range(n_atoms):
+            fields = f.readline().split()
+            xyz[i] = fields[2:5]
+            try:
+                types[i] = int(fields[5])
+            except (IndexError, ValueError):  # non-numeric types are accepted
+                pass
+            bonds.extend((i, int(j) - 1) for j in fields[6:] if int(j) - 1 > i)
+    return xyz, types, np.array(bonds, dtype=int).reshape(-1, 2)
+
+
+def model(xyz, types, bonds):
+    """
+    Energy (kcal/mol), gradients (kcal/mol/A) and dipole moment
+    (Debye) of the toy forcefield
+    """
+    d = xyz[bonds[:, 1]] - xyz[bonds[:, 0]]
+    r = np.sqrt((d * d).sum(axis=1))
+    stretch = r - BOND_R0
+    energy = 0.5 * BOND_K * (stretch * stretch).sum()
+    force = (BOND_K * stretch / np.where(r > 0, r, 1))[:, None] * d
+    gradients = np.zeros_like(xyz)
+    np.add.at(gradients, bonds[:, 1], force)
+    np.subtract.at(gradients, bonds[:, 0], force)
+    charges = 0.05 * (types % 3 - 1)
+    charges -= charges.mean()
+    dipole = DEBYE_PER_EA * (charges[:, None] * xyz).sum(axis=0)
+    return energy, gradients, dipole
+
+
+def _bond_blocks(xyz, bonds):
+    # d2E/dxb dxb for each bond; dxa dxa is the same and dxa dxb its opposite
+    d = xyz[bonds[:, 1]] - xyz[bonds[:, 0]]
+    r = np.sqrt((d * d).sum(axis=1))
+    r = np.where(r > 0, r, 1)
+    uu = np.einsum('bi,bj->bij', d / r[:, None], d / r[:, None])
+    eye = np.eye(3)[None]
+    return BOND_K * (uu + (1 - BOND_R0 / r)[:, None, None] * (eye - uu))
+
+
+def hessian_blocks(xyz, bonds):
+    """
+    Hessian of the toy forcefield as 3x3 blocks: ``diagonal`` (N, 3, 3)
+    and ``off`` (B, 3, 3), the block coupling the two atoms of each bond.
+    """
+    blocks = _bond_blocks(xyz, bonds)
+    diagonal = np.zeros((len(xyz), 3, 3))
+    np.add.at(diagonal, bonds[:, 0], blocks)
+    np.add.at(diagonal, bonds[:, 1], blocks)
+    return diagonal, -blocks
+
+
+def _format_values(values):
+    return ''.join('%12.4f' % v + ('\n' if i % 6 == 5 else '')
+                   for i, v in enumerate(values)).rstrip('\n') + '\n'
+
+
+def hessian_band(value=None):
+    """
+    Width of the band of the banded Hessian set in
+    ``$GARLEEK_STANDIN_HESSIAN`` (``band:<width>``), or 0 if unset
+    """
+    if value is None:
+        value = os.environ.get('GARLEEK_STANDIN_HESSIAN') or ''
+    if not value or value == 'bonds':
+        return 0
+    kind, _, width = value.partition(':')
+    if kind != 'band' or not width.isdigit():
+        raise ValueError('$GARLEEK_STANDIN_HESSIAN must be `bonds` or `band:<width>`, '
+                         'not `{}`'.format(value))
+    return int(width)
+
+
+def write_hes(path, xyz, bonds, band=0):
+    """
+    Write the Hessian of the toy forcefield like ``testhess`` does: the
+    diagonal, then the elements below it, column by column, in
+    ``6f12.4`` lines. Most of them are zero; those lines are not
+    formatted one by one, so writing is dominated by I/O.
+
+    With ``band`` > 0, each atom is also coupled to the next ``band``
+    atoms, with ``BAND_K / distance`` (distance between atom indices)
+    on all three axes (see :func:`hessian_band`).
+    """
+    diagonal, off = hessian_blocks(xyz, bonds)
+    size = 3 * len(xyz)
+    zero = '%12.4f' % 0
+    zero_line = zero * 6 + '\n'
+    # Off-diagonal blocks reachable from each atom, as (rows, block) of
+    # atoms with larger index: their columns hold the lower triangle
+    neighbours = [[] for _ in range(len(xyz))]
+    for (a, b), block in zip(bonds, off):
+        neighbours[a].append((3 * b, block))
+    with open(path, 'w') as f:
+        f.write('\n Diagonal Hessian Elements  (3 per Atom)\n\n')
+        f.write(_format_values(diagonal[:, [0, 1, 2], [0, 1, 2]].ravel()))
+        for j in range(size - 1):
+            atom, axis = divmod(j, 3)
+            f.write('\n Off-diagonal Hessian Elements for Atom%6d %s\n\n' % (atom + 1, 'XYZ'[axis]))
+            length = size - j - 1
+            full, rest = divmod(length, 6)
+            lines = [zero_line] * full
+            if rest:
+                lines.append(zero * rest + '\n')
+            values = {}
+            for row in range(j + 1, 3 * atom + 3):
+                values[row - j - 1] = diagonal[atom, row - 3 * atom, axis]
+            for first, block in neighbours[atom]:
+                for k in range(3):
+                    values[first + k - j - 1] = block[axis, k]
+            for row in range(3 * atom + 3, min(size, 3 * (atom + band + 1))):
+                values[row - j - 1] = (values.get(row - j - 1, 0.0)
+                                       + BAND_K / (row // 3 - atom))
+            for line in set(p // 6 for p in values):
+                start = 6 * line
+                width = min(6, length - start)
+                lines[line] = ('%12.4f' * width + '\n') % tuple(values.get(start + k, 0.0)
+                                                                for k in range(width))
+            f.write(''.join(lines))
+    return path
+
+
+def _spend(seconds):
+    if seconds <= 0:
+        return
+    if os.environ.get('GARLEEK_STANDIN_BUSY'):
+        end = time.time() + seconds
+        while time.time() < end:
+            pass
+    else:
+        time.sleep(seconds)
+
+
+def _cost(name):
+    return float(os.environ.get('GARLEEK_STANDIN_' + name) or 0)
+
+
+def _gradient_lines(gradients):
+    norms = np.sqrt((gradients * gradients).sum(axis=1))
+    lines = [' Cartesian Gradient Breakdown over Individual Atoms :\n\n',
+             '  Type      Atom              dE/dX       dE/dY       dE/dZ          Norm\n\n']
+    lines += [' Anlyt%10d %19.4f%12.4f%12.4f%14.4f\n' % (i + 1, g[0], g[1], g[2], n)
+              for i, (g, n) in enumerate(zip(gradients, norms))]
+    total = np.sqrt((norms * norms).sum())
+    lines += ['\n Total Gradient Norm and RMS Gradient per Atom :\n\n',
+              ' Anlyt      Total Gradient Norm Value      %16.4f\n\n' % total,
+              ' Anlyt      RMS Gradient over All Atoms    %16.4f\n' % (total / np.sqrt(max(len(norms), 1)))]
+    return lines
+
+
+def run(program, args, stdout=None):
+    """
+    Emulate ``program`` called with ``args`` (the TINKER command line,
+    without the program). Returns the exit code.
+    """
+    stdout = stdout or sys.stdout
+    _spend(_cost('STARTUP'))
+    if not args or not os.path.isfile(args[0]):
+        stdout.write(_BANNER + ' Enter Cartesian Coordinate File Name :\n'
+                     ' TINKER is Unable to Find the Requested File\n')
+        return 1
+    xyz_file = args[0]
+    xyz, types, bonds = read_tinker_xyz(xyz_file)
+    n_atoms = len(xyz)
+    cost = _cost('PER_ATOM') * n_atoms
+    if program == 'testhess':
+        cost += _cost('PER_HESSIAN_ELEMENT') * (3 * n_atoms) * (3 * n_atoms + 1) // 2
+    _spend(cost)
+    energy, gradients, dipole = model(xyz, types, bonds)
+    out = [_BANNER]
+    if program == 'analyze':
+        options = args[3].upper() if len(args) > 3 else 'E'
+        if 'E' in options:
+            out += ['\n Total Potential Energy :%24.4f Kcal/mole\n\n' % energy,
+                    ' Energy Component Breakdown :           Kcal/mole      Interactions\n\n',
+                    ' Bond Stretching          %24.4f%15d\n' % (energy, len(bonds))]
+        if 'M' in options:
+            out += ['\n Total Electric Charge :%25.5f Electrons\n\n' % 0.0,
+                    ' Dipole Moment Magnitude :%24.3f Debyes\n\n' % np.sqrt((dipole * dipole).sum()),
+                    ' Dipole X,Y,Z-Components :%23.3f%12.3f%12.3f\n' % tuple(dipole)]
+    elif program == 'testgrad':
+        out += ['\n Total Potential Energy :%24.8f Kcal/mole\n\n' % energy]
+        out += _gradient_lines(gradients)
+    elif program == 'testhess':
+        hesfile = os.path.splitext(xyz_file)[0] + '.hes'
+        write_hes(hesfile, xyz, bonds, band=hessian_band())
+        out += ['\n Hessian Matrix written to File :  %s\n' % hesfile]
+    stdout.write(''.join(out))
+    stdout.flush()
+    return 0
+
+
+def install(directory):
+    """
+    Write ``analyze``, ``testgrad`` and ``testhess`` executables running
+    the stand-in to ``directory``. Returns a dict of paths.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    paths = {}
+    for program in PROGRAMS:
+        path = paths[program] = os.path.join(os.path.abspath(directory), program)
+        with open(path, 'w') as f:
+            f.write('#!{}\n'
+                    'import sys\n'
+                    'sys.path.insert(0, {!r})\n'
+                    'from garleek.mm.tinker_standin import run\n'
+                    'sys.exit(run({!r}, sys.argv[1:]))\n'.format(sys.executable, root, program))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return paths
+
+
+def main(argv=None):
+    """
+    ``python -m garleek.mm.tinker_standin install DIRECTORY`` or
+    ``python -m garleek.mm.tinker_standin PROGRAM ARGS...``
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) == 2 and argv[0] == 'install':
+        for program, path in sorted(install(argv[1]).items()):
+            print('export TINKER_{}={}'.format(program.upper(), path))
+        return 0
+    if not argv or argv[0] not in PROGRAMS:
+        print('Usage: python -m garleek.mm.tinker_standin install DIRECTORY\n'
+              '       python -m garleek.mm.tinker_standin {{{}}} ARGS...'.format(
+                  ','.join(PROGRAMS)))
+        return 2
+    return run(argv[0], argv[1:])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+profiling.py
+============
+
+Opt-in profiling of real ``garleek-backend`` calls.
+
+The QM engine launches ``garleek-backend`` by itself, so slow calls
+cannot easily be rerun under a profiler. Instead, set
+``$GARLEEK_PROFILE`` to a directory before submitting the job and every
+backend call (also those handled by ``garleek-server``) is run under
+:mod:`cProfile` and :mod:`tracemalloc`. Each call leaves two files
+there, named after the job and the order and layer of the call:
+
+- ``garleek-<job>-<call>-<layer>.prof``: :mod:`cProfile` statistics,
+  to be inspected with :mod:`pstats` or tools like ``snakeviz``.
+- ``garleek-<job>-<call>-<layer>.alloc.txt``: peak traced memory and
+  the source lines that allocated the most memory still alive at the
+  end of the call.
+
+``<job>`` is the Gaussian process ID (see :func:`garleek.scratch.job_id`),
+``<call>`` counts the calls of that job from 1, and ``<layer>`` is the
+ONIOM layer letter passed by Gaussian (``R``, ``M``...).
+
+Both tools slow the backend down noticeably, ``tracemalloc`` in
+particular, so keep this for diagnostic runs. The patched input file
+does not need to change.
+"""
+
+from __future__ import print_function, absolute_import, division
+import errno
+import os
+from .scratch import job_id
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+
+def _reserve(directory, job, layer):
+    """
+    Claim the next free ``garleek-<job>-<call>-<layer>`` name,
+    safely across concurrent processes.
+    """
+    prefix = 'garleek-{}-'.format(job)
+    call = 1 + sum(1 for name in os.listdir(directory)
+                   if name.startswith(prefix) and name.endswith('.prof'))
+    while True:
+        base = os.path.join(directory, '{}{:04d}-{}'.format(prefix, call, layer))
+        try:
+            os.close(os.open(base + '.prof', os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            call += 1
+        else:
+            return base
+
+
+class Profiled(object):
+
+    """
+    Context manager running its block under :mod:`cProfile` and
+    :mod:`tracemalloc`, and dumping the results to ``directory``.
+
+    Parameters
+    ----------
+    directory : str
+        Output directory. It is created if needed.
+    qmargs : list of str
+        Arguments passed by the QM engine, used to name the files
+    top : int, optional=25
+        Number of allocation sites listed
+    """
+
+    def __init__(self, directory, qmargs, top=25):
+        self.directory = directory
+        self.qmargs = qmargs
+        self.top = top
+        self.base = None
+
+    def __enter__(self):
+        import cProfile
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:  # created by a concurrent job
+                if not os.path.isdir(self.directory):
+                    raise
+        layer = self.qmargs[0] if self.qmargs else 'X'
+        ein = self.qmargs[1] if len(self.qmargs) > 1 else None
+        self.base = _reserve(self.directory, job_id(ein), layer)
+        self._tracing = tracemalloc is not None and not tracemalloc.is_tracing()
+        if self._tracing:
+            tracemalloc.start()
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+        return self
+
+    def __exit__(self, *exc):
+        self._profile.disable()
+        snapshot = None
+        if self._tracing:  # before anything else allocates
+            snapshot = tracemalloc.take_snapshot()
+            memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        try:
+            self._profile.dump_stats(self.base + '.prof')
+            if snapshot is not None:
+                self._dump_allocations(snapshot, *memory)
+        except (IOError, OSError) as e:  # never break a QM job because of this
+            print('Warning: could not write profile', self.base, '-', e)
+        else:
+            print('Profile written to', self.base + '.prof')
+        return False
+
+    def _dump_allocations(self, snapshot, current, peak):
+        stats = snapshot.filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),)
+                                       ).statistics('lineno')
+        with open(self.base + '.alloc.txt', 'w') as f:
+            f.write('# {}\n'.format(' '.join(self.qmargs)))
+            f.write('Traced memory: {:.1f} KiB at exit, {:.1f} KiB peak\n'.format(
+                    current / 1024, peak / 1024))
+            f.write('Top {} allocation sites (memory alive at exit):\n'.format(self.top))
+            for stat in stats[:self.top]:
+                frame = stat.traceback[0]
+                f.write('{:>12.1f} KiB {:>8} blocks  {}:{}\n'.format(
+                        stat.size / 1024, stat.count, frame.filename, frame.lineno))
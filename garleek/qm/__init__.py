@@ -53,4 +53,12 @@ keys and values:
         2-tuples containing bonded atom index (int) and
         bond order (float)
 
+Parsers may return a richer object as long as it supports item
+access for these keys. For example, the Gaussian parser returns a
+:class:`garleek.qm.gaussian.GaussianEIn`, which keeps coordinates,
+types and charges in NumPy arrays and the connectivity in CSR form,
+and only builds the ``atoms`` and ``bonds`` dicts when requested.
+Engines that can work on arrays directly should prefer them for
+large systems.
+
 """
\ No newline at end of file
@@ -12,7 +12,11 @@ from __future__ import print_function, absolute_import, division
 from collections import OrderedDict
 import re
 import numpy as np
-from .. import __version__
+try:
+    from StringIO import StringIO
+except ImportError:  # Python 3
+    from io import StringIO
+from .. import _get_version
 from ..atom_types import ELEMENTS
 
 
@@ -22,13 +26,15 @@ default_version = '16'
 
 class GaussianPatcher(object):
 
-    def __init__(self, filename, atom_types, mm='tinker', qm='gaussian', forcefield=None, version=default_version):
+    def __init__(self, filename, atom_types, mm='tinker', qm='gaussian', forcefield=None,
+                 version=default_version, backend='garleek-backend'):
         self.filename = filename
         self.atom_types = atom_types
         self.mm = mm
         self.qm = qm
         self.forcefield = forcefield
         self.version = version
+        self.backend = backend
         self.basis_patch = None
     
     def _is_route(self, line):
@@ -42,7 +48,7 @@ class GaussianPatcher(object):
         if basis_patch:
             gen = '/gen' if basis_patch.lower() in ('gen', 'genecp') else '/' + basis_patch
             self.basis_patch = basis_patch.lower()
-        command = 'garleek-backend --qm {} --mm {}'.format(self.qm, self.mm)
+        command = '{} --qm {} --mm {}'.format(self.backend, self.qm, self.mm)
         if self.forcefield:
             command += " --ff '{}'".format(self.forcefield)
         return line.replace(matches.group(2), 'external="{}"{}'.format(command, gen))
@@ -104,7 +110,7 @@ class GaussianPatcher(object):
     
     def patch(self):
         skipped_mult_charges = False
-        blocks = [['! Created with Garleek v{}\n'.format(__version__)]]
+        blocks = [['! Created with Garleek v{}\n'.format(_get_version())]]
         basis_index = []
         with open(self.filename) as f:
             for line in f:
@@ -148,7 +154,192 @@ def patch_gaussian_input(*a, **kw):
     return patcher.patch()
 
 
-def parse_gaussian_EIn(ein_filename, version=default_version):
+class GaussianEIn(object):
+
+    """
+    Compact, array-backed contents of a Gaussian ``*.EIn`` file, as
+    returned by :func:`parse_gaussian_EIn`.
+
+    Per-atom data is stored column-wise in NumPy arrays and the
+    connectivity in CSR form, which scales to systems with hundreds of
+    thousands of atoms. For callers expecting the standardized dict
+    described in :mod:`garleek.qm`, item access (``ein['atoms']``,
+    ``ein['bonds']``, ...) builds the equivalent dict representation
+    on demand.
+
+    Attributes
+    ----------
+    n_atoms, derivatives, charge, spin : int
+        Header values
+    elements : np.array of str, shape (N,)
+        Element field of each atom (atomic number, as written by Gaussian)
+    types : np.array, shape (N,), or None
+        MM atom types (str), or None if not present in the file. Atoms
+        without type are None if only some of them have one.
+    xyz : np.array of float, shape (N, 3)
+        Cartesian coordinates (bohr)
+    mm_charges : np.array of float, shape (N,)
+        MM point charges
+    has_bonds : bool
+        Whether the file contains connectivity information
+    bond_indptr : np.array of int, shape (N+1,)
+        Bonds of atom ``i`` (0-based) are stored in positions
+        ``bond_indptr[i]:bond_indptr[i+1]`` of the next two arrays
+    bond_indices : np.array of int
+        Bonded atom (1-based index, like in the EIn file)
+    bond_orders : np.array of float
+        Bond order
+    connectivity_hash : str or None
+        Hash of the connectivity block, if requested (see
+        :func:`parse_gaussian_EIn`)
+    """
+
+    _KEYS = 'n_atoms', 'derivatives', 'charge', 'spin', 'atoms', 'bonds'
+
+    def __init__(self, n_atoms, derivatives, charge, spin, elements, types, xyz,
+                 mm_charges, bond_indptr, bond_indices, bond_orders, has_bonds=True):
+        self.n_atoms = n_atoms
+        self.derivatives = derivatives
+        self.charge = charge
+        self.spin = spin
+        self.elements = elements
+        self.types = types
+        self.xyz = xyz
+        self.mm_charges = mm_charges
+        self.bond_indptr = bond_indptr
+        self.bond_indices = bond_indices
+        self.bond_orders = bond_orders
+        self.has_bonds = has_bonds
+        self.connectivity_hash = None
+        self._atoms = self._bonds = None
+
+    def bonds_of(self, index):
+        """
+        List of ``(bonded_atom, bond_order)`` tuples for the atom with
+        1-based ``index``
+        """
+        start, end = self.bond_indptr[index-1], self.bond_indptr[index]
+        return list(zip(self.bond_indices[start:end].tolist(),
+                        self.bond_orders[start:end].tolist()))
+
+    @property
+    def atoms(self):
+        """ Atoms, as an OrderedDict of dicts (see :mod:`garleek.qm`) """
+        if self._atoms is None:
+            types = [None] * self.n_atoms if self.types is None else self.types.tolist()
+            self._atoms = OrderedDict(
+                (i+1, {'element': element, 'type': atom_type, 'xyz': xyz, 'mm_charge': charge})
+                for (i, (element, atom_type, xyz, charge))
+                in enumerate(zip(self.elements.tolist(), types, self.xyz.copy(),
+                                 self.mm_charges.tolist())))
+        return self._atoms
+
+    @property
+    def bonds(self):
+        """ Connectivity, as an OrderedDict of lists (see :mod:`garleek.qm`) """
+        if self._bonds is None:
+            self._bonds = OrderedDict()
+            if self.has_bonds:
+                for i in range(1, self.n_atoms + 1):
+                    self._bonds[i] = self.bonds_of(i)
+        return self._bonds
+
+    def keys(self):
+        return list(self._KEYS)
+
+    def __iter__(self):
+        return iter(self._KEYS)
+
+    def __contains__(self, key):
+        return key in self._KEYS
+
+    def __getitem__(self, key):
+        if key not in self._KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return self[key] if key in self._KEYS else default
+
+    def as_dict(self):
+        """ Standardized dict representation (see :mod:`garleek.qm`) """
+        return dict((key, self[key]) for key in self._KEYS)
+
+
+def _parse_EIn_atoms(lines, n_atoms):
+    """
+    Parse the atom block in bulk. Returns elements, types, xyz, charges.
+    """
+    tokens = ' '.join(lines).split()
+    # Each line has 5 or 6 fields, so only uniform blocks can add up to N*5 or N*6
+    if len(tokens) == n_atoms * 6:
+        types = np.array(tokens[5::6])
+    elif len(tokens) == n_atoms * 5:
+        types = None
+    else:  # Some atoms have types, some don't
+        tokens = [field for line in lines
+                  for field in (line.split() + [None])[:6]]
+        types = np.array(tokens[5::6], dtype=object)
+    n_fields = 5 if types is None else 6
+    elements = np.array(tokens[0::n_fields])
+    numbers = np.array([list(map(float, tokens[i::n_fields])) for i in range(1, 5)])
+    return elements, types, np.ascontiguousarray(numbers[:3].T), numbers[3]
+
+
+def _float_or_nan(word):
+    try:
+        return float(word)
+    except ValueError:
+        return np.nan
+
+
+def _parse_EIn_bonds(lines, n_atoms, bond_index_pos, bond_list_pos):
+    """
+    Parse the connectivity block in bulk into CSR arrays
+    (indptr, bonded atom indices, bond orders).
+    """
+    end = next((i for (i, line) in enumerate(lines) if not line.strip()), len(lines))
+    lines = lines[:end]
+    # All lines are parsed at once, with -1 marking the end of each line
+    try:
+        values = np.fromstring(' -1 '.join(lines) + ' -1', sep=' ') if lines else np.zeros(0)
+    except ValueError:  # non-numeric fields around
+        values = None
+    if values is None or np.count_nonzero(values == -1) != len(lines):
+        values = np.array([v for line in lines
+                           for v in [_float_or_nan(w) for w in line.split()] + [-1]])
+    ends = np.flatnonzero(values == -1)
+    starts = np.zeros(len(lines), dtype=int)
+    starts[1:] = ends[:-1] + 1
+    counts = ends - starts
+    # A wrong layout (e.g. wrong Gaussian version) gives odd pair counts,
+    # or non-numeric or out of range atom indices
+    row_values = values[starts + bond_index_pos]
+    bad = ((counts < bond_list_pos) | ((counts - bond_list_pos) % 2 == 1) |
+           ~((row_values >= 1) & (row_values <= n_atoms)))
+    if np.any(bad):
+        raise ValueError('Unexpected connectivity line `{}`'.format(lines[np.argmax(bad)].strip()))
+    position = np.arange(values.size) - np.repeat(starts, counts + 1)
+    is_pair = (position >= bond_list_pos) & (values != -1)
+    is_atom = is_pair & ((position - bond_list_pos) % 2 == 0)
+    is_order = is_pair & ~is_atom
+    n_pairs = np.maximum(counts - bond_list_pos, 0) // 2
+    if not (np.all((values[is_atom] >= 1) & (values[is_atom] <= n_atoms))
+            and np.all(np.isfinite(values[is_order]))):
+        raise ValueError('Unexpected bonded atoms or bond orders in the connectivity block')
+    rows = np.repeat(row_values.astype(int), n_pairs)
+    bond_indices = values[is_atom].astype(int)
+    bond_orders = values[is_order]
+    if rows.size and np.any(rows[1:] < rows[:-1]):
+        order = np.argsort(rows, kind='mergesort')
+        rows, bond_indices, bond_orders = rows[order], bond_indices[order], bond_orders[order]
+    bond_indptr = np.zeros(n_atoms + 1, dtype=int)
+    np.cumsum(np.bincount(rows - 1, minlength=n_atoms)[:n_atoms], out=bond_indptr[1:])
+    return bond_indptr, bond_indices, bond_orders, bool(lines)
+
+
+def parse_gaussian_EIn(ein_filename, version=default_version, connectivity=None,
+                       hash_connectivity=False):
     """
     Parse the ``*.EIn`` file produced by Gaussian ``external`` keyword.
 
@@ -165,47 +356,61 @@ def parse_gaussian_EIn(ein_filename, version=default_version):
     - ``derivatives-requested`` can be ``0`` (energy only), ``1`` (first derivatives)
       or ``2`` (second derivatives).
     - ``version`` must be one of ``garleek.qm.gaussian.supported_versions``
+    - ``connectivity`` can be the result of an earlier call for the same
+      system (or any object with its ``bond_*``, ``has_bonds`` and
+      ``connectivity_hash`` attributes). If the connectivity block did not
+      change, its arrays are reused instead of parsed again.
+    - If ``connectivity`` or ``hash_connectivity`` are given, a hash of the
+      connectivity block is stored in ``ein.connectivity_hash``.
+
+    Returns
+    -------
+    ein : GaussianEIn
+        Array-backed representation, which also supports the dict
+        API described in :mod:`garleek.qm` (``ein['atoms']``, etc).
     """
     with open(ein_filename) as f:
-        n_atoms, derivatives, charge, spin = list(map(int, next(f).split()))
-        atoms = OrderedDict()
-        for i in range(n_atoms):
-            fields = next(f).strip().split()
-            atom_element = fields[0]
-            atom_type = fields[5] if len(fields) == 6 else None
-            x, y, z, mm_charge = list(map(float, fields[1:5]))
-            atoms[i+1] = {'element': atom_element,
-                          'type': atom_type,
-                          'xyz': np.array([x, y, z]),
-                          'mm_charge': mm_charge}
-
-        line = next(f)  # Skip the "connectivity" header
+        lines = f.read().splitlines()
+    n_atoms, derivatives, charge, spin = list(map(int, lines[0].split()))
+    elements, types, xyz, mm_charges = _parse_EIn_atoms(lines[1:n_atoms+1], n_atoms)
+
+    if version in ('09d', '16'):
+        bond_index_pos = 0
+        bond_list_pos = 1
+    elif version in ('03', '09a', '09b', '09c'):
+        bond_index_pos = 1
+        bond_list_pos = 6
+    else:
+        raise ValueError('`version` must be one of {}'.format(', '.join(supported_versions)))
+
+    bond_lines = lines[n_atoms+1:]
+    digest = None
+    if connectivity is not None or hash_connectivity:
+        from ..cache import hash_bytes
+        digest = hash_bytes(version, '\n'.join(bond_lines))
+    if connectivity is not None and digest == connectivity.connectivity_hash \
+            and len(connectivity.bond_indptr) == n_atoms + 1:
+        bond_indptr, bond_indices, bond_orders, has_bonds = (
+            connectivity.bond_indptr, connectivity.bond_indices, connectivity.bond_orders,
+            connectivity.has_bonds)
+    else:
         has_bonds = False
-        if 'connectivity' in line.strip().lower():
-            line = next(f)
+        if bond_lines and 'connectivity' in bond_lines[0].strip().lower():  # Skip the header
+            bond_lines = bond_lines[1:]
             has_bonds = True
-        bonds = OrderedDict()
-        if version in ('09d', '16'):
-            bond_index_pos = 0
-            bond_list_pos = 1
-        elif version in ('03', '09a', '09b', '09c'):
-            bond_index_pos = 1
-            bond_list_pos = 6
-        else:
-            raise ValueError('`version` must be one of {}'.format(', '.join(supported_versions)))
-        while line.strip():
-            fields = line.strip().split()
-            bonds[int(fields[bond_index_pos])] = bond_list = []
-            for to_atom, bond_index in zip(fields[bond_list_pos::2], fields[bond_list_pos+1::2]):
-                bond_list.append((int(to_atom), float(bond_index)))
-            line = next(f, '')
-
-    return {'n_atoms': n_atoms,
-            'derivatives': derivatives,
-            'charge': charge,
-            'spin': spin,
-            'atoms': atoms,
-            'bonds': bonds}
+        try:
+            bond_indptr, bond_indices, bond_orders, bond_lines_found = _parse_EIn_bonds(
+                bond_lines, n_atoms, bond_index_pos, bond_list_pos)
+        except ValueError as e:
+            raise ValueError('{}. Is this a Gaussian {} EIn file?'.format(e, version))
+        has_bonds = has_bonds or bond_lines_found
+
+    ein = GaussianEIn(n_atoms=n_atoms, derivatives=derivatives, charge=charge, spin=spin,
+                      elements=elements, types=types, xyz=xyz, mm_charges=mm_charges,
+                      bond_indptr=bond_indptr, bond_indices=bond_indices,
+                      bond_orders=bond_orders, has_bonds=has_bonds)
+    ein.connectivity_hash = digest
+    return ein
 
 
 def prepare_gaussian_EOu(n_atoms, energy, dipole_moment, gradients=None, hessian=None,
@@ -237,22 +442,79 @@ def prepare_gaussian_EOu(n_atoms, energy, dipole_moment, gradients=None, hessian
     N, j=1 to i. The dipole moment, polarizability, and dipole derivatives can be
     zero if none are available.
     """
-    lines = [[energy] + list(dipole_moment)]
-    template = '{: 20.12e}'
+    output = StringIO()
+    write_gaussian_EOu(output, n_atoms, energy, dipole_moment, gradients=gradients,
+                       hessian=hessian, polarizability=polarizability,
+                       dipole_polarizability=dipole_polarizability)
+    return output.getvalue()
+
+
+_EOU_FIELD = '% 20.12e'
+_EOU_ROW = _EOU_FIELD * 3 + '\n'
+
+
+def _write_EOu_values(f, chunks, leftover=(), chunk_size=30000):
+    """
+    Format the values in ``chunks`` (an iterable of arrays) in rows of
+    three, ``chunk_size`` values per write. Values that do not fill a
+    row are carried over to the next chunk and returned at the end.
+    """
+    leftover = list(leftover)
+    for chunk in chunks:
+        values = np.ravel(chunk)
+        for start in range(0, values.size, chunk_size):
+            block = leftover + values[start:start+chunk_size].tolist()
+            n_rows = len(block) // 3
+            f.write(_EOU_ROW * n_rows % tuple(block[:3*n_rows]))
+            leftover = block[3*n_rows:]
+    return leftover
+
+
+def write_gaussian_EOu(f, n_atoms, energy, dipole_moment, gradients=None, hessian=None,
+                       polarizability=None, dipole_polarizability=None, chunk_size=30000):
+    """
+    Write the ``*.EOu`` file Gaussian expects after ``external`` launch,
+    with the same contents ``prepare_gaussian_EOu`` returns.
+
+    Numbers are formatted in bulk and written ``chunk_size`` values at a
+    time, so the whole file is never held in memory. This matters for
+    Hessians, which have (3N)(3N+1)/2 elements.
+
+    Parameters
+    ----------
+    f : str or file-like
+        Path to the EOu file, or an open text stream
+    hessian : np.array or iterable of np.array, optional
+        Lower triangular Hessian, row-major. It can also be given as
+        consecutive chunks (e.g. rows), which are streamed as they come.
+
+    Other parameters are described in ``prepare_gaussian_EOu``.
+    """
+    if not hasattr(f, 'write'):
+        with open(f, 'w') as fh:
+            write_gaussian_EOu(fh, n_atoms, energy, dipole_moment, gradients=gradients,
+                               hessian=hessian, polarizability=polarizability,
+                               dipole_polarizability=dipole_polarizability,
+                               chunk_size=chunk_size)
+        return f
+    header = [float(energy)] + np.ravel(dipole_moment).tolist()
+    f.write(_EOU_FIELD * len(header) % tuple(header) + '\n')
     if gradients is not None:
-        for gradient in gradients:
-            lines.append(gradient)
+        _write_EOu_row_tail(f, _write_EOu_values(f, [gradients], chunk_size=chunk_size))
     if hessian is not None:
         if polarizability is None:
             polarizability = np.zeros(6)
         if dipole_polarizability is None:
             dipole_polarizability = np.zeros(9*n_atoms)
-        for i in range(0, polarizability.size, 3):
-            lines.append(polarizability[i:i+3])
-        for i in range(0, dipole_polarizability.size, 3):
-            lines.append(dipole_polarizability[i:i+3])
-
-        for i in range(0, hessian.size, 3):
-            lines.append(hessian[i:i+3])
-    lines.append([])  # Gaussian is very peculiar about blank lines
-    return '\n'.join([(template*len(line)).format(*line) for line in lines])
+        _write_EOu_row_tail(f, _write_EOu_values(f, [polarizability], chunk_size=chunk_size))
+        _write_EOu_row_tail(f, _write_EOu_values(f, [dipole_polarizability],
+                                                 chunk_size=chunk_size))
+        chunks = [hessian] if isinstance(hessian, np.ndarray) else hessian
+        _write_EOu_row_tail(f, _write_EOu_values(f, chunks, chunk_size=chunk_size))
+    return f
+
+
+def _write_EOu_row_tail(f, leftover):
+    # Sections not filling the last row end with a shorter line
+    if leftover:
+        f.write(_EOU_FIELD * len(leftover) % tuple(leftover) + '\n')
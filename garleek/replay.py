@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+replay.py
+=========
+
+Record the inputs of live jobs and replay them as benchmarks.
+
+Recording
+---------
+
+With ``--record DIRECTORY`` (or ``$GARLEEK_RECORD_DIR``), each backend
+call copies the EIn file Gaussian wrote to ``DIRECTORY/<job>/`` before
+handling it, as ``<call>-<layer>.EIn``, and appends a line describing it
+to ``DIRECTORY/<job>/manifest.jsonl``::
+
+    {"call": 3, "file": "0003-R.EIn", "layer": "R", "qm_version": "16",
+     "ein": "Gau-5678.EIn", "time": 1700000000.0}
+
+``<job>`` is the Gaussian process ID (see :func:`garleek.scratch.job_id`)
+and ``<call>`` counts the calls of that job from 1.
+
+Replaying
+---------
+
+``garleek-replay DIRECTORY --ff FORCEFIELD`` pushes every EIn file in
+``DIRECTORY`` through the full ``garleek-backend`` path, in the order
+given by the manifest (or in natural file name order if there is none,
+so ``C_10.EIn`` comes after ``C_9.EIn``), and reports per-call latency
+percentiles, throughput, per-phase timings (see :mod:`garleek.timing`)
+and TINKER totals. Any ``garleek-backend`` option can be given too.
+
+Each replay runs with its own, temporary, scratch root (see
+:mod:`garleek.scratch`), so it never shares workspaces or session
+snapshots with other replays or with live jobs.
+
+EIn files written for a plain ONIOM input, like those in
+``tests/moredata/EIns``, carry QM atom types; pass an atom types mapping
+with ``--types`` to translate them to MM types before replaying.
+"""
+
+from __future__ import print_function, absolute_import, division
+import errno
+import json
+import os
+import re
+import shutil
+import sys
+import time
+from tempfile import mkdtemp
+from . import scratch
+from .scratch import job_id
+
+try:
+    from StringIO import StringIO
+except ImportError:  # Python 3
+    from io import StringIO
+
+
+MANIFEST = 'manifest.jsonl'
+PERCENTILES = 50, 90, 95, 99
+
+
+def record_ein(directory, ein_filename, layer, **fields):
+    """
+    Copy ``ein_filename`` into the recording ``directory`` of its job
+    and describe it in the job manifest. Returns the path to the copy.
+    """
+    job_dir = os.path.join(directory, str(job_id(ein_filename)))
+    if not os.path.isdir(job_dir):
+        try:
+            os.makedirs(job_dir)
+        except OSError:  # created by a concurrent call
+            if not os.path.isdir(job_dir):
+                raise
+    call = 1 + sum(1 for name in os.listdir(job_dir) if name.endswith('.EIn'))
+    while True:  # claim the next free call number
+        name = '{:04d}-{}.EIn'.format(call, layer)
+        path = os.path.join(job_dir, name)
+        try:
+            os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            call += 1
+        else:
+            break
+    shutil.copyfile(ein_filename, path)
+    entry = dict(fields, call=call, file=name, layer=layer,
+                 ein=os.path.basename(ein_filename), time=time.time())
+    fd = os.open(os.path.join(job_dir, MANIFEST), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (json.dumps(entry, sort_keys=True) + '\n').encode('utf-8'))
+    finally:
+        os.close(fd)
+    return path
+
+
+def _natural_key(name):
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', name)]
+
+
+def replay_entries(directory):
+    """
+    List the EIn files of ``directory`` in replay order, as dicts with
+    ``path``, ``layer`` and ``qm_version`` (None if unknown).
+    """
+    manifest = os.path.join(directory, MANIFEST)
+    entries = []
+    if os.path.isfile(manifest):
+        with open(manifest) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:  # truncated by a killed job
+                    continue
+                entries.append((entry.get('time', 0), entry['call'], entry))
+        return [{'path': os.path.join(directory, e['file']), 'layer': e.get('layer') or 'R',
+                 'qm_version': e.get('qm_version')} for (_, _, e) in sorted(entries)]
+    names = sorted((n for n in os.listdir(directory) if n.endswith('.EIn')), key=_natural_key)
+    return [{'path': os.path.join(directory, n), 'layer': 'R', 'qm_version': None}
+            for n in names]
+
+
+def translate_types(source, destination, mapping):
+    """
+    Copy an EIn file replacing the atom types (case insensitive) of
+    its atom lines with those in ``mapping``.
+    """
+    with open(source) as f:
+        lines = f.read().splitlines()
+    n_atoms = int(lines[0].split()[0])
+    for i in range(1, n_atoms + 1):
+        fields = lines[i].split()
+        if len(fields) > 5:
+            try:
+                fields[5] = mapping[fields[5].upper()]
+            except KeyError:
+                raise ValueError('Atom type {} in {} is not in the types mapping'.format(
+                                 fields[5], source))
+            lines[i] = ' '.join(fields)
+    with open(destination, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return destination
+
+
+def _percentile(values, q):
+    import numpy as np
+    return float(np.percentile(values, q)) if values else None
+
+
+def _stats(values):
+    if not values:
+        return None
+    stats = {'count': len(values), 'total': sum(values), 'mean': sum(values) / len(values),
+             'min': min(values), 'max': max(values)}
+    for q in PERCENTILES:
+        stats['p{}'.format(q)] = _percentile(values, q)
+    return stats
+
+
+def replay(directory, backend_kwargs=None, types=None, repeat=1, warmup=0, verbose=False):
+    """
+    Replay the recorded EIn files in ``directory`` through ``backend_app``.
+
+    Parameters
+    ----------
+    directory : str
+        Directory with EIn files and, optionally, a manifest
+    backend_kwargs : dict, optional
+        Keyword arguments for :func:`garleek.cli.backend_app`
+        (``ff``, ``qm``, ``tinker_mode``...)
+    types : dict, optional
+        QM to MM atom types mapping applied to the EIn files first
+    repeat : int, optional=1
+        Number of measured passes over the whole directory
+    warmup : int, optional=0
+        Number of unmeasured calls run first, to warm up caches
+    verbose : bool, optional=False
+        Let the backend output through. It is discarded otherwise.
+
+    Returns
+    -------
+    summary : dict
+        See :func:`format_replay`
+    """
+    from .cli import backend_app
+    from .report import read_timings
+    entries = replay_entries(directory)
+    if not entries:
+        raise ValueError('No EIn files found in {}'.format(directory))
+    kwargs = dict(backend_kwargs or {})
+    kwargs['record'] = None  # never record a replay
+    default_qm = kwargs.pop('qm', None) or 'gaussian'
+    workdir = mkdtemp(prefix='garleek-replay-')
+    timings = os.path.join(workdir, 'timings.jsonl')
+    latencies = []
+    replay_scratch = os.path.join(workdir, 'scratch')
+    os.mkdir(replay_scratch)
+    previous_scratch = os.environ.get('GARLEEK_SCRATCH')
+    os.environ['GARLEEK_SCRATCH'] = replay_scratch
+    try:
+        # Inputs are prepared (and translated) up front, outside the measurements
+        for i, entry in enumerate(entries):
+            ein = os.path.join(workdir, '{:04d}.EIn'.format(i + 1))
+            if types:
+                translate_types(entry['path'], ein, types)
+            else:
+                shutil.copyfile(entry['path'], ein)
+            entry['ein'] = ein
+        schedule = [entries[i % len(entries)] for i in range(warmup)]
+        schedule += entries * repeat
+        started = time.time()
+        for i, entry in enumerate(schedule):
+            measured = i >= warmup
+            if i == warmup:
+                started = time.time()
+            qm = default_qm
+            if entry['qm_version'] and '_' not in default_qm:
+                qm = '{}_{}'.format(default_qm, entry['qm_version'])
+            stdout = sys.stdout
+            if not verbose:
+                sys.stdout = StringIO()
+            try:
+                t0 = time.time()
+                backend_app([entry['layer'], entry['ein'], entry['ein'][:-4] + '.EOu'], qm=qm,
+                            timings=timings if measured else None, return_path=True,
+                            **kwargs)
+                elapsed = time.time() - t0
+            finally:
+                sys.stdout = stdout
+            if measured:
+                latencies.append(elapsed)
+        total = time.time() - started
+        records = read_timings(timings) if os.path.isfile(timings) else []
+    finally:
+        if previous_scratch is None:
+            del os.environ['GARLEEK_SCRATCH']
+        else:
+            os.environ['GARLEEK_SCRATCH'] = previous_scratch
+        for key in [k for k in scratch._workspaces if k[0] == replay_scratch]:
+            del scratch._workspaces[key]
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    phases, programs = {}, {}
+    for record in records:
+        for name, phase in record.get('phases', {}).items():
+            phases.setdefault(name, []).append(phase['wall'])
+        for sub in record.get('subprocesses', ()):
+            programs.setdefault(sub['program'], []).append(sub['wall'])
+    atoms = sum(r.get('n_atoms') or 0 for r in records)
+    return {
+        'directory': directory,
+        'inputs': len(entries),
+        'calls': len(latencies),
+        'warmup': warmup,
+        'wall': total,
+        'throughput': len(latencies) / total if total else None,
+        'atoms_per_second': atoms / total if total and atoms else None,
+        'latency': _stats(latencies),
+        'phases': dict((name, _stats(values)) for (name, values) in phases.items()),
+        'programs': dict((name, _stats(values)) for (name, values) in programs.items()),
+    }
+
+
+def format_replay(summary):
+    """
+    Human-readable version of :func:`replay`'s output
+    """
+    def ms(value):
+        return '-' if value is None else '{:.1f}'.format(1000 * value)
+
+    columns = ['mean'] + ['p{}'.format(q) for q in PERCENTILES] + ['max']
+    header = '{:<16} {:>6} ' + ' '.join('{:>9}' for _ in columns)
+    out = ['Replayed {} calls ({} inputs{}) from {}'.format(
+           summary['calls'], summary['inputs'],
+           ', {} warm-up calls'.format(summary['warmup']) if summary['warmup'] else '',
+           summary['directory']), '']
+    out.append('Wall time    {:>10.3f} s'.format(summary['wall']))
+    if summary['throughput'] is not None:
+        out.append('Throughput   {:>10.2f} calls/s'.format(summary['throughput']))
+    if summary['atoms_per_second'] is not None:
+        out.append('             {:>10.0f} atoms/s'.format(summary['atoms_per_second']))
+    out += ['', 'Times in ms', header.format('', 'count', *columns)]
+    rows = [('latency', summary['latency'])]
+    rows += sorted(summary['phases'].items(), key=lambda kv: -kv[1]['total'])
+    rows += [('tinker ' + name, stats) for (name, stats) in sorted(summary['programs'].items())]
+    for name, stats in rows:
+        if stats:
+            out.append(header.format(name, stats['count'], *[ms(stats[c]) for c in columns]))
+    return '\n'.join(out)
@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+report.py
+=========
+
+Run-level performance reports for ONIOM jobs.
+
+``garleek-report`` combines the timing records written by the backend
+(see :mod:`garleek.timing`) with the Gaussian log of the same job to
+tell how its wall time splits between the QM engine and the MM part
+handled by Garleek and TINKER::
+
+    garleek-report job.log --timings timings.jsonl
+
+Either source can be omitted. The Gaussian log provides the total wall
+time of the job, the optimization step each external call belongs to
+and, if the job was run with ``#P``, the time spent in each external
+call as seen by Gaussian (``Leave Link`` timestamps, with a resolution
+of one second). The difference between that and the time measured by
+Garleek itself is the cost of launching the backend.
+
+Timing records are matched to the job through the process ID Gaussian
+embeds in the ``Gau-<PID>.EIn`` file names, and to the external calls
+of the log in chronological order.
+"""
+
+from __future__ import print_function, absolute_import, division
+import json
+import re
+import time
+
+
+_LEAVE_LINK = re.compile(r'Leave Link\s+(\d+) at \w{3} (\w{3})\s+(\d+) (\d+):(\d+):(\d+) (\d{4})')
+_EXTERNAL = re.compile(r'Running external command "(.*)"')
+_INPUT_FILE = re.compile(r'input file\s+"(.*)"')
+_DURATION = re.compile(r'(Job cpu time|Elapsed time):\s+(\d+) days\s+(\d+) hours\s+'
+                       r'(\d+) minutes\s+([\d.]+) seconds')
+_GAU_JOB = re.compile(r'Gau-(\d+)')
+_MONTHS = dict((m, i + 1) for i, m in enumerate(
+    'Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec'.split()))
+
+
+def _timestamp(match):
+    month, day, hour, minute, second, year = match.groups()[1:]
+    return time.mktime((int(year), _MONTHS[month], int(day), int(hour), int(minute),
+                        int(second), 0, 0, -1))
+
+
+def parse_gaussian_log(path):
+    """
+    Extract the timing-related information of a Gaussian log file.
+
+    Returns
+    -------
+    log : dict
+        ``job`` (PID from the ``Gau-<PID>`` scratch files, or None),
+        ``wall`` (total wall time, or None if it cannot be known),
+        ``cpu`` (``Job cpu time``), ``normal_termination``, ``steps``
+        (list of dicts with ``label`` and ``wall``) and ``calls``, one
+        dict per external call with ``step`` (label of its step),
+        ``layer``, ``ein`` and ``wall`` (None without ``#P``).
+    """
+    calls, steps = [], []
+    job = None
+    elapsed = cpu = 0.0
+    has_elapsed = normal_termination = False
+    first_stamp = last_stamp = step_start = None
+    job_step, step = 1, 1
+    pending = None  # external call waiting for its Leave Link 402
+
+    def label():
+        return str(step) if job_step == 1 else '{}.{}'.format(job_step, step)
+
+    def close_step():
+        wall = None
+        if step_start is not None and last_stamp is not None:
+            wall = last_stamp - step_start
+        if any(c['step'] == label() for c in calls):
+            steps.append({'label': label(), 'wall': wall})
+        return last_stamp
+
+    with open(path) as f:
+        for line in f:
+            if 'Leave Link' in line:
+                match = _LEAVE_LINK.search(line)
+                if match:
+                    stamp = _timestamp(match)
+                    if first_stamp is None:
+                        first_stamp = step_start = stamp
+                    if pending is not None and match.group(1) == '402':
+                        if pending['start'] is not None:
+                            pending['wall'] = stamp - pending['start']
+                        pending = None
+                    last_stamp = stamp
+            elif 'Running external command' in line:
+                match = _EXTERNAL.search(line)
+                command = match.group(1).split() if match else []
+                pending = {'step': label(), 'layer': command[-1] if command else None,
+                           'ein': None, 'start': last_stamp, 'wall': None}
+                calls.append(pending)
+            elif 'input file' in line and pending is not None and pending['ein'] is None:
+                match = _INPUT_FILE.search(line)
+                if match:
+                    pending['ein'] = match.group(1).replace('\\', '/').split('/')[-1]
+                    gau = _GAU_JOB.search(pending['ein'])
+                    if gau and job is None:
+                        job = int(gau.group(1))
+            elif line.startswith(' Step number'):
+                step_start = close_step()
+                step += 1
+            elif 'Proceeding to internal job step number' in line:
+                step_start = close_step()
+                job_step, step = job_step + 1, 1
+            elif 'Job cpu time' in line or 'Elapsed time' in line:
+                match = _DURATION.search(line)
+                if match:
+                    days, hours, minutes, seconds = match.groups()[1:]
+                    value = ((int(days) * 24 + int(hours)) * 60 + int(minutes)) * 60 + float(seconds)
+                    if match.group(1) == 'Elapsed time':
+                        elapsed += value
+                        has_elapsed = True
+                    else:
+                        cpu += value
+            elif 'Normal termination' in line:
+                normal_termination = True
+    close_step()
+    for call in calls:
+        del call['start']
+    if has_elapsed:
+        wall = elapsed
+    elif first_stamp is not None:
+        wall = last_stamp - first_stamp
+    else:
+        wall = None
+    return {'job': job, 'wall': wall, 'cpu': cpu or None, 'steps': steps, 'calls': calls,
+            'normal_termination': normal_termination}
+
+
+def read_timings(path, job=None):
+    """
+    Load the records of a :mod:`garleek.timing` JSON-lines file, sorted
+    by time. If ``job`` is given, only the records of that job are kept.
+    Unreadable lines (e.g. truncated by a killed job) are skipped.
+    """
+    records = []
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if job is None or record.get('job') == job:
+                records.append(record)
+    records.sort(key=lambda r: r.get('time', 0))
+    return records
+
+
+def _slope(values):
+    """
+    Least-squares slope of ``values`` against their position
+    """
+    n = len(values)
+    if n < 2:
+        return None
+    mean_x, mean_y = (n - 1) / 2, sum(values) / n
+    num = sum((i - mean_x) * (v - mean_y) for i, v in enumerate(values))
+    den = sum((i - mean_x) ** 2 for i in range(n))
+    return num / den
+
+
+def build_report(log=None, timings=None, job=None, top=10):
+    """
+    Combine a Gaussian log and a timings file into a report.
+
+    Parameters
+    ----------
+    log : str, optional
+        Path to the Gaussian log file
+    timings : str, optional
+        Path to the JSON-lines file written with ``--timings``
+    job : int, optional
+        Only use the timing records of this job. Defaults to the job
+        found in the log, if any.
+    top : int, optional=10
+        Number of slowest calls to report
+
+    Returns
+    -------
+    report : dict
+        See :func:`format_report`
+    """
+    if log is None and timings is None:
+        raise ValueError('A Gaussian log, a timings file or both are needed')
+    notes = []
+    parsed = parse_gaussian_log(log) if log else None
+    if job is None and parsed is not None:
+        job = parsed['job']
+    records = read_timings(timings, job) if timings else []
+    if parsed is not None:
+        calls = [dict(c, launch=c['wall'], wall=None, record=None) for c in parsed['calls']]
+        if timings and len(records) != len(calls):
+            notes.append('{} timing records for {} external calls in the log; '
+                         'paired in order'.format(len(records), len(calls)))
+        for call, record in zip(calls, records):
+            call['record'] = record
+            call['wall'] = record.get('wall')
+    else:
+        calls = [{'step': None, 'layer': r.get('layer'), 'ein': r.get('ein'), 'launch': None,
+                  'wall': r.get('wall'), 'record': r} for r in records]
+    for call in calls:  # without timings, Gaussian's view is the best estimate
+        if call['wall'] is None:
+            call['wall'] = call['launch']
+
+    mm_wall = sum(c['wall'] for c in calls if c['wall'] is not None)
+    total_wall = parsed['wall'] if parsed is not None else None
+    if total_wall is None and records:
+        total_wall = (records[-1]['time'] + records[-1].get('wall', 0)) - records[0]['time']
+        notes.append('No timestamps in the log; the job wall time spans the timing records only')
+    launch = [c['launch'] - c['wall'] for c in calls
+              if c['record'] is not None and c['launch'] is not None]
+
+    # TINKER programs and backend phases
+    programs, phases = {}, {}
+    for call in calls:
+        record = call['record'] or {}
+        for sub in record.get('subprocesses', ()):
+            entry = programs.setdefault(sub['program'], {'calls': 0, 'wall': 0.0, 'cpu': 0.0,
+                                                         'max': 0.0, 'max_rss': None,
+                                                         'failed': 0})
+            entry['calls'] += 1
+            entry['wall'] += sub['wall']
+            entry['cpu'] += sub.get('cpu') or 0.0
+            entry['max'] = max(entry['max'], sub['wall'])
+            if sub.get('max_rss') is not None:
+                entry['max_rss'] = max(entry['max_rss'] or 0, sub['max_rss'])
+            if sub.get('returncode'):
+                entry['failed'] += 1
+        for name, phase in record.get('phases', {}).items():
+            entry = phases.setdefault(name, {'wall': 0.0, 'cpu': 0.0})
+            entry['wall'] += phase['wall']
+            entry['cpu'] += phase['cpu']
+
+    # Per step breakdown
+    steps = []
+    if parsed is not None:
+        for step in parsed['steps']:
+            members = [c for c in calls if c['step'] == step['label']]
+            mm = sum(c['wall'] for c in members if c['wall'] is not None)
+            tinker = None
+            if any(c['record'] for c in members):
+                tinker = sum(s['wall'] for c in members if c['record']
+                             for s in c['record'].get('subprocesses', ()))
+            steps.append({'label': step['label'], 'calls': len(members), 'wall': step['wall'],
+                          'mm': mm, 'tinker': tinker,
+                          'qm': None if step['wall'] is None else max(step['wall'] - mm, 0.0)})
+
+    # Trends along the optimization: one value per step, or per call
+    series = [(s['label'], s['mm']) for s in steps if s['calls']] or \
+             [(str(i + 1), c['wall']) for i, c in enumerate(calls) if c['wall'] is not None]
+    trends = {}
+    if len(series) > 1:
+        values = [v for (_, v) in series]
+        trends['mm'] = {'first': values[0], 'last': values[-1], 'slope': _slope(values),
+                        'per': 'step' if steps else 'call'}
+        for name in sorted(phases):
+            values = [(c['record'] or {}).get('phases', {}).get(name, {}).get('wall', 0.0)
+                      for c in calls if c['record']]
+            if len(values) > 1:
+                trends[name] = {'first': values[0], 'last': values[-1], 'slope': _slope(values),
+                                'per': 'call'}
+
+    slowest = sorted((c for c in calls if c['wall'] is not None),
+                     key=lambda c: -c['wall'])[:top]
+    return {
+        'job': job,
+        'wall': total_wall,
+        'cpu': parsed['cpu'] if parsed is not None else None,
+        'normal_termination': parsed['normal_termination'] if parsed is not None else None,
+        'calls': len(calls),
+        'mm_wall': mm_wall,
+        'mm_share': mm_wall / total_wall if total_wall else None,
+        'launch_overhead': sum(launch) if launch else None,
+        'steps': steps,
+        'programs': programs,
+        'phases': phases,
+        'trends': trends,
+        'slowest': [{'step': c['step'], 'layer': c['layer'], 'wall': c['wall'],
+                     'n_atoms': (c['record'] or {}).get('n_atoms'),
+                     'derivatives': (c['record'] or {}).get('derivatives'),
+                     'tinker': None if c['record'] is None else
+                               sum(s['wall'] for s in c['record'].get('subprocesses', ()))}
+                    for c in slowest],
+        'notes': notes,
+    }
+
+
+def _seconds(value):
+    return '-' if value is None else '{:.2f}'.format(value)
+
+
+def _percent(part, whole):
+    return '-' if part is None or not whole else '{:.1f}%'.format(100 * part / whole)
+
+
+def format_report(report):
+    """
+    Human-readable version of :func:`build_report`'s output
+    """
+    out = ['Garleek performance report' + ('' if report['job'] is None
+                                          else ' for job {}'.format(report['job'])), '']
+    out.append('Job wall time         {:>10} s'.format(_seconds(report['wall'])))
+    if report['cpu']:
+        out.append('Job CPU time (QM)     {:>10} s'.format(_seconds(report['cpu'])))
+    out.append('MM calls              {:>10}'.format(report['calls']))
+    out.append('MM wall time          {:>10} s  ({} of the job)'.format(
+               _seconds(report['mm_wall']), _percent(report['mm_wall'], report['wall'])))
+    if report['launch_overhead'] is not None:
+        out.append('Backend launch (est.) {:>10} s'.format(_seconds(report['launch_overhead'])))
+    if report['normal_termination'] is False:
+        out.append('Warning: the job did not terminate normally')
+
+    if report['steps']:
+        out += ['', 'Per step', '--------',
+                '{:>6} {:>6} {:>10} {:>10} {:>10} {:>10} {:>7}'.format(
+                    'step', 'calls', 'wall', 'QM', 'MM', 'TINKER', 'MM %')]
+        for s in report['steps']:
+            out.append('{:>6} {:>6} {:>10} {:>10} {:>10} {:>10} {:>7}'.format(
+                s['label'], s['calls'], _seconds(s['wall']), _seconds(s['qm']),
+                _seconds(s['mm']), _seconds(s['tinker']), _percent(s['mm'], s['wall'])))
+
+    if report['slowest']:
+        out += ['', 'Slowest MM calls', '----------------',
+                '{:>6} {:>6} {:>8} {:>6} {:>10} {:>10}'.format(
+                    'step', 'layer', 'atoms', 'deriv', 'wall', 'TINKER')]
+        for c in report['slowest']:
+            out.append('{:>6} {:>6} {:>8} {:>6} {:>10} {:>10}'.format(
+                c['step'] or '-', c['layer'] or '-',
+                '-' if c['n_atoms'] is None else c['n_atoms'],
+                '-' if c['derivatives'] is None else c['derivatives'],
+                _seconds(c['wall']), _seconds(c['tinker'])))
+
+    if report['programs']:
+        out += ['', 'TINKER programs', '---------------',
+                '{:<12} {:>6} {:>10} {:>10} {:>8} {:>10} {:>10} {:>10} {:>7}'.format(
+                    'program', 'calls', 'wall', 'cpu', 'cpu/wall', 'mean', 'max',
+                    'peak RSS', 'of MM')]
+        for name, p in sorted(report['programs'].items(), key=lambda kv: -kv[1]['wall']):
+            out.append('{:<12} {:>6} {:>10} {:>10} {:>8} {:>10} {:>10} {:>10} {:>7}'.format(
+                name, p['calls'], _seconds(p['wall']), _seconds(p['cpu']),
+                '-' if not p['wall'] else '{:.2f}'.format(p['cpu'] / p['wall']),
+                _seconds(p['wall'] / p['calls']), _seconds(p['max']),
+                '-' if p['max_rss'] is None else '{:.1f} MB'.format(p['max_rss'] / 2**20),
+                _percent(p['wall'], report['mm_wall'])))
+            if p['failed']:
+                out.append('  {} of them exited with an error'.format(p['failed']))
+
+    if report['phases']:
+        out += ['', 'Backend phases', '--------------',
+                '{:<16} {:>10} {:>10} {:>7}'.format('phase', 'wall', 'cpu', 'of MM')]
+        for name, p in sorted(report['phases'].items(), key=lambda kv: -kv[1]['wall']):
+            out.append('{:<16} {:>10} {:>10} {:>7}'.format(
+                name, _seconds(p['wall']), _seconds(p['cpu']),
+                _percent(p['wall'], report['mm_wall'])))
+
+    if report['trends']:
+        out += ['', 'Trends', '------',
+                '{:<16} {:>10} {:>10} {:>14}'.format('', 'first', 'last', 'slope')]
+        for name, t in sorted(report['trends'].items(), key=lambda kv: kv[0] != 'mm'):
+            out.append('{:<16} {:>10} {:>10} {:>14}'.format(
+                'MM per ' + t['per'] if name == 'mm' else name, _seconds(t['first']),
+                _seconds(t['last']), '{:+.4f} s/{}'.format(t['slope'], t['per'])))
+
+    for note in report['notes']:
+        out.append('')
+        out.append('Note: ' + note)
+    return '\n'.join(out)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+scratch.py
+==========
+
+Per-job scratch workspaces for the files exchanged with the MM engine.
+
+Every MM step writes an input structure, a key file and (for frequency
+jobs) reads back a Hessian file. Writing those to the working directory
+or the default temporary directory can be slow on clusters, where both
+often live on a parallel filesystem. Instead, each QM job gets its own
+directory in a fast, local location:
+
+1. ``$GARLEEK_SCRATCH``, if set
+2. ``/dev/shm``, if available (a RAM-backed tmpfs on Linux)
+3. the system temporary directory
+
+The same directory is reused by all the steps of a job. Jobs are told
+apart by the process ID embedded by Gaussian in the ``Gau-<PID>.EIn``
+file names (the parent process ID is used otherwise), so concurrent
+jobs on the same node never share a workspace. Workspaces are named
+``garleek-<user>-<host>-<job>``; those whose job process is gone are
+removed the next time any workspace is opened on that host, and when
+``garleek-server`` exits.
+
+.. note::
+
+    Very large frequency jobs produce multi-GB Hessian files. If
+    ``/dev/shm`` is too small for them, point ``$GARLEEK_SCRATCH`` to a
+    local disk.
+"""
+
+from __future__ import print_function, absolute_import, division
+import errno
+import getpass
+import os
+import re
+import shutil
+import socket
+import tempfile
+
+
+_workspaces = {}
+
+
+def scratch_root():
+    """
+    Base directory for the workspaces
+    """
+    root = os.environ.get('GARLEEK_SCRATCH')
+    if root:
+        return root
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK | os.X_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+def job_id(ein_filename=None):
+    """
+    Identify the running QM job: the PID in Gaussian's ``Gau-<PID>``
+    file names if available, or the parent PID of this process.
+    """
+    if ein_filename:
+        match = re.search(r'Gau-(\d+)', os.path.basename(ein_filename))
+        if match:
+            return int(match.group(1))
+    return os.getppid()
+
+
+def _prefix():
+    try:
+        user = getpass.getuser()
+    except Exception:  # no user name available, e.g. in containers
+        user = str(os.getuid())
+    return 'garleek-{}-{}-'.format(user, socket.gethostname().split('.')[0])
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM  # alive, but owned by someone else
+    return True
+
+
+class Workspace(object):
+
+    """
+    Scratch directory shared by all the MM steps of a QM job.
+
+    Parameters
+    ----------
+    job : int, optional
+        Process ID of the QM job owning the workspace. Defaults to the
+        parent process ID.
+    root : str, optional
+        Base directory. Defaults to ``scratch_root()``.
+    """
+
+    def __init__(self, job=None, root=None):
+        self.job = job_id() if job is None else job
+        self.root = root or scratch_root()
+        self.directory = os.path.join(self.root, '{}{}'.format(_prefix(), self.job))
+        if not os.path.isdir(self.directory):
+            collect_garbage(self.root)
+            try:
+                os.makedirs(self.directory, 0o700)
+            except OSError:  # created by a concurrent step
+                if not os.path.isdir(self.directory):
+                    raise
+
+    def path(self, *names):
+        """
+        Path to a file inside the workspace
+        """
+        return os.path.join(self.directory, *names)
+
+    def cleanup(self):
+        """
+        Remove the workspace and everything in it
+        """
+        shutil.rmtree(self.directory, ignore_errors=True)
+        _workspaces.pop((self.root, self.job), None)
+
+
+def workspace(ein_filename=None, root=None):
+    """
+    Return the (cached) workspace of the job that wrote ``ein_filename``
+    """
+    job = job_id(ein_filename)
+    root = root or scratch_root()
+    ws = _workspaces.get((root, job))
+    if ws is None or not os.path.isdir(ws.directory):
+        ws = _workspaces[(root, job)] = Workspace(job, root=root)
+    return ws
+
+
+def collect_garbage(root=None):
+    """
+    Remove the workspaces of this user and host whose job
+    is no longer running. Returns the removed directories.
+    """
+    root = root or scratch_root()
+    prefix = _prefix()
+    removed = []
+    try:
+        names = os.listdir(root)
+    except OSError:
+        return removed
+    for name in names:
+        if not name.startswith(prefix):
+            continue
+        try:
+            pid = int(name[len(prefix):])
+        except ValueError:
+            continue
+        if not _pid_alive(pid):
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+            removed.append(os.path.join(root, name))
+    return removed
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+session.py
+==========
+
+Per-job snapshots of the setup work done by ``garleek-backend``.
+
+All the calls of an optimization describe the same system: only the
+coordinates change from one step to the next. Still, every call would
+locate the TINKER executables, generate (or trim) the key and forcefield
+files, parse the connectivity and format the bonds of the TINKER XYZ
+file again. The first call of each ONIOM layer saves all that in the
+job's scratch workspace (see :mod:`garleek.scratch`), as
+``session-<layer>.npz``, and the following calls reuse it:
+
+- the resolved TINKER executables
+- the key file and the (trimmed) forcefield in use
+- the connectivity, which is only parsed again if the connectivity block
+  of the EIn file changed
+- the per-atom fields of the TINKER XYZ file, preformatted, so only the
+  coordinates are formatted
+
+A snapshot is only used if it was saved with the same forcefield file
+(path, size and modification time), Gaussian version, key file options
+and atom types; otherwise it is rebuilt. Snapshots are plain ``.npz``
+files, loaded without ``pickle``. Use ``--no-session`` (or set
+``$GARLEEK_NO_SESSION``) to disable them.
+"""
+
+from __future__ import print_function, absolute_import, division
+import os
+from tempfile import NamedTemporaryFile
+
+import numpy as np
+
+FORMAT = 1
+_PROGRAMS = 'analyze', 'testgrad', 'testhess'
+
+
+def session_settings(forcefield, qm_version=None, tinker_keywords=None, trim_forcefield=False):
+    """
+    String describing everything a snapshot depends on, besides the
+    system itself
+    """
+    try:
+        stat = os.stat(forcefield)
+        signature = '{}:{}:{}'.format(os.path.abspath(forcefield), stat.st_size, stat.st_mtime)
+    except OSError:
+        signature = forcefield
+    return '\n'.join(['format {}'.format(FORMAT), signature, str(qm_version),
+                      'trim' if trim_forcefield else 'full'] + list(tinker_keywords or ()))
+
+
+class Session(object):
+
+    """
+    Setup of the backend calls of one ONIOM layer of a job.
+
+    Parameters
+    ----------
+    settings : str
+        See :func:`session_settings`
+    ein : garleek.qm.gaussian.GaussianEIn
+        Parsed EIn file, with its ``connectivity_hash``
+    forcefield, key : str
+        Forcefield and key files passed to TINKER
+    executables : dict, optional
+        Path to each TINKER program
+    templates : list of str, optional
+        TINKER XYZ templates (see :func:`garleek.mm.tinker.tinker_xyz_templates`).
+        Built from ``ein`` if not given.
+    """
+
+    def __init__(self, settings, ein, forcefield, key, executables=None, templates=None):
+        from .mm.tinker import tinker_xyz_templates
+        self.settings = settings
+        self.n_atoms = ein.n_atoms
+        self.elements = np.asarray(ein.elements)
+        self.types = np.asarray(ein.types)
+        self.bond_indptr = ein.bond_indptr
+        self.bond_indices = ein.bond_indices
+        self.bond_orders = ein.bond_orders
+        self.has_bonds = ein.has_bonds
+        self.connectivity_hash = ein.connectivity_hash
+        self.forcefield = forcefield
+        self.key = key
+        self.executables = dict(executables or {})
+        if templates is None:
+            templates = tinker_xyz_templates(self.elements, self.types, self.bond_indptr,
+                                             self.bond_indices, self.bond_orders)
+        self.templates = templates
+
+    @classmethod
+    def load(cls, path, settings):
+        """
+        Load the snapshot in ``path``. Returns None if there is none,
+        or if it was saved with different ``settings``.
+        """
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                if int(data['format']) != FORMAT or str(data['settings']) != settings:
+                    return None
+                session = cls.__new__(cls)
+                session.settings = settings
+                session.n_atoms = int(data['n_atoms'])
+                session.elements = data['elements']
+                session.types = data['types']
+                session.bond_indptr = data['bond_indptr']
+                session.bond_indices = data['bond_indices']
+                session.bond_orders = data['bond_orders']
+                session.has_bonds = bool(data['has_bonds'])
+                session.connectivity_hash = str(data['connectivity_hash'])
+                session.forcefield = str(data['forcefield'])
+                session.key = str(data['key'])
+                session.executables = dict((p, str(e)) for (p, e) in
+                                           zip(_PROGRAMS, data['executables'].tolist()) if e)
+                text = data['templates'].tobytes().decode('utf-8')
+                ends = data['template_ends'].tolist()
+                session.templates = [text[a:b] for (a, b) in zip([0] + ends[:-1], ends)]
+        except (IOError, OSError, KeyError, ValueError):
+            return None
+        return session
+
+    def save(self, path):
+        """
+        Write the snapshot to ``path``, atomically
+        """
+        text = ''.join(self.templates).encode('utf-8')
+        ends = np.cumsum([len(t) for t in self.templates])
+        directory = os.path.dirname(os.path.abspath(path))
+        with NamedTemporaryFile(dir=directory, prefix='.tmp', suffix='.npz', delete=False) as f:
+            np.savez(f, format=FORMAT, settings=self.settings, n_atoms=self.n_atoms,
+                     elements=self.elements, types=self.types, bond_indptr=self.bond_indptr,
+                     bond_indices=self.bond_indices, bond_orders=self.bond_orders,
+                     has_bonds=self.has_bonds, connectivity_hash=self.connectivity_hash,
+                     forcefield=self.forcefield, key=self.key,
+                     executables=np.array([self.executables.get(p) or '' for p in _PROGRAMS]),
+                     templates=np.frombuffer(text, dtype=np.uint8), template_ends=ends)
+        os.rename(f.name, path)
+        return path
+
+    def matches(self, ein):
+        """
+        Whether the snapshot describes the system in ``ein``, parsed
+        with this session as ``connectivity``, and its files are still
+        in place
+        """
+        return (ein.n_atoms == self.n_atoms
+                and ein.bond_indices is self.bond_indices  # connectivity was reused
+                and ein.types is not None and np.array_equal(ein.types, self.types)
+                and np.array_equal(ein.elements, self.elements)
+                and os.path.isfile(self.key) and os.path.isfile(self.forcefield))
+
+    def restore_executables(self):
+        """
+        Let :func:`garleek.mm.tinker.tinker_executable` skip the
+        ``$PATH`` lookups done by the first call
+        """
+        from .mm import tinker
+        for program, path in self.executables.items():
+            if not os.environ.get('TINKER_' + program.upper()) and os.path.isfile(path):
+                tinker._tinker_executables.setdefault(program, path)
+
+    def write_xyz(self, path, xyz):
+        """
+        Write the TINKER XYZ file for coordinates ``xyz`` (bohr)
+        """
+        from .mm.tinker import write_tinker_xyz_templates
+        return write_tinker_xyz_templates(path, self.templates, xyz)
+
+
+def session_path(workspace, layer):
+    """
+    Snapshot file of ``layer`` in ``workspace``
+    """
+    return workspace.path('session-{}.npz'.format(layer))
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+timing.py
+=========
+
+Lightweight instrumentation of the backend pipeline.
+
+When enabled (``--timings FILE`` or ``$GARLEEK_TIMINGS``), each backend
+invocation appends one JSON document per line to ``FILE``, like::
+
+    {"time": 1700000000.0, "pid": 1234, "job": 5678, "layer": "R",
+     "ein": "Gau-5678.EIn", "n_atoms": 1200, "derivatives": 1,
+     "cached": false, "wall": 1.92, "cpu": 0.21,
+     "phases": {"parse_ein": {"wall": 0.01, "cpu": 0.01}, ...},
+     "subprocesses": [{"program": "testgrad", "wall": 1.7, "cpu": 1.65,
+                       "user": 1.6, "sys": 0.05, "max_rss": 48103424,
+                       "returncode": 0, "threads": 4}, ...]}
+
+``wall`` and ``cpu`` are in seconds, ``max_rss`` (peak resident memory)
+in bytes. Phase CPU times only count the backend process itself; the
+resource usage of each TINKER program is reported in ``subprocesses``.
+
+When disabled, :data:`NULL_RECORDER` is used instead, whose methods do
+nothing, so instrumented code pays a couple of attribute lookups at most.
+"""
+
+from __future__ import print_function, absolute_import, division
+import json
+import os
+import threading
+import time
+
+
+def _cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+class _Phase(object):
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.wall, self.cpu = time.time(), _cpu_time()
+        return self
+
+    def __exit__(self, *exc):
+        phase = self.recorder.phases.setdefault(self.name, {'wall': 0.0, 'cpu': 0.0})
+        phase['wall'] += time.time() - self.wall
+        phase['cpu'] += _cpu_time() - self.cpu
+        return False
+
+
+class TimingRecorder(object):
+
+    """
+    Collect the timings of a single backend invocation and append them
+    to ``path`` as a JSON line when ``write`` is called.
+
+    Parameters
+    ----------
+    path : str
+        JSON-lines file the record is appended to
+    fields :
+        Initial fields of the record (``layer``, ``n_atoms``...)
+    """
+
+    enabled = True
+
+    def __init__(self, path, **fields):
+        self.path = path
+        self.fields = fields
+        self.phases = {}
+        self.subprocesses = []
+        self._lock = threading.Lock()
+        self._wall, self._cpu = time.time(), _cpu_time()
+
+    def phase(self, name):
+        """
+        Context manager timing the block it wraps as phase ``name``.
+        Repeated phases are accumulated.
+        """
+        return _Phase(self, name)
+
+    def subprocess(self, program, wall, cpu=None, **extra):
+        """
+        Record a finished child process, with any other resource
+        usage figures in ``extra``. Thread-safe.
+        """
+        entry = dict(program=program, wall=wall, cpu=cpu, **extra)
+        with self._lock:
+            self.subprocesses.append(entry)
+
+    def update(self, **fields):
+        self.fields.update(fields)
+
+    def as_dict(self):
+        record = {'time': self._wall, 'pid': os.getpid()}
+        record.update(self.fields)
+        record.update(wall=time.time() - self._wall, cpu=_cpu_time() - self._cpu,
+                      phases=self.phases, subprocesses=self.subprocesses)
+        return record
+
+    def write(self):
+        """
+        Append the record to ``path``, in a single write so records
+        from concurrent processes do not interleave.
+        """
+        line = (json.dumps(self.as_dict(), sort_keys=True) + '\n').encode('utf-8')
+        try:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+        except OSError as e:  # never break a QM job because of the timings
+            print('Warning: could not write timings to', self.path, '-', e)
+
+
+class _NullPhase(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class NullRecorder(object):
+
+    """
+    Do-nothing stand-in for :class:`TimingRecorder`
+    """
+
+    enabled = False
+    _phase = _NullPhase()
+
+    def phase(self, name):
+        return self._phase
+
+    def subprocess(self, *args, **kwargs):
+        pass
+
+    def update(self, **fields):
+        pass
+
+    def write(self):
+        pass
+
+
+NULL_RECORDER = NullRecorder()
+
+
+def recorder(path=None, **fields):
+    """
+    A :class:`TimingRecorder` writing to ``path``, or
+    :data:`NULL_RECORDER` if ``path`` is empty.
+    """
+    if not path:
+        return NULL_RECORDER
+    return TimingRecorder(path, **fields)
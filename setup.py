@@ -47,5 +47,9 @@ setup(
         [console_scripts]
         garleek=garleek.cli:frontend_app_main
         garleek-backend=garleek.cli:backend_app_main
+        garleek-server=garleek.cli:server_app_main
+        garleek-client=garleek.client:client_app_main
+        garleek-report=garleek.cli:report_app_main
+        garleek-replay=garleek.cli:replay_app_main
         '''
 )
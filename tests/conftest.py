@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+"""
+Fixtures shared by the test modules
+"""
+
+from __future__ import print_function, division, absolute_import
+import io
+import os
+import pytest
+import numpy as np
+
+from garleek.mm import tinker
+
+here = os.path.abspath(os.path.dirname(__file__))
+moredata = os.path.join(here, 'moredata')
+
+
+def _write_hes(path, matrix):
+    """
+    Write a symmetric matrix like TINKER's testhess does
+    """
+    size = matrix.shape[0]
+
+    def block(values):
+        return ''.join('%12.4f' % v + ('\n' if i % 6 == 5 else '')
+                       for i, v in enumerate(values)).rstrip('\n') + '\n'
+
+    with open(path, 'w') as f:
+        f.write('\n Diagonal Hessian Elements  (3 per Atom)\n\n')
+        f.write(block(np.diag(matrix)))
+        for j in range(size - 1):
+            f.write('\n Off-diagonal Hessian Elements for Atom%6d %s\n\n' % (j // 3 + 1, 'XYZ'[j % 3]))
+            f.write(block(matrix[j+1:, j]))
+
+
+def _read(*path):
+    with open(os.path.join(moredata, *path), 'rb') as f:
+        return f.read()
+
+
+class FakePopen(object):
+
+    """
+    Stand-in for ``subprocess.Popen`` replaying canned TINKER outputs
+    """
+
+    outputs = {}
+    calls = []
+
+    def __init__(self, command, **kwargs):
+        self.calls.append(command[0])
+        output = self.outputs[command[0]]
+        if callable(output):
+            output = output(command)
+        self.stdout = io.BytesIO(output)
+
+    def wait(self):
+        return 0
+
+
+@pytest.fixture
+def canned_tinker(monkeypatch):
+    """
+    Replace TINKER calls with the recorded outputs for A_5,
+    keeping track of the programs run.
+    """
+    calls = []
+    monkeypatch.setattr(FakePopen, 'calls', calls)
+    monkeypatch.setattr(FakePopen, 'outputs', {'analyze': _read('epouts', 'A_5.epout'),
+                                               'testgrad': _read('gouts', 'A_5.gout')})
+    monkeypatch.setattr(tinker, '_tinker_executables',
+                        dict((p, p) for p in ('analyze', 'testgrad', 'testhess')))
+    monkeypatch.setattr(tinker, 'Popen', FakePopen)
+    return calls
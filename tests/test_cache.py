@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+from __future__ import print_function, division, absolute_import
+import os
+import pytest
+import numpy as np
+
+from garleek.cache import ResultCache
+
+
+@pytest.fixture
+def results():
+    return {'energy': -1.5,
+            'dipole_moment': np.array([0.1, 0.2, 0.3]),
+            'gradients': np.arange(6, dtype=float).reshape(2, 3),
+            'hessian': np.eye(6)}
+
+
+def test_result_cache_levels(tmpdir, results):
+    cache = ResultCache(str(tmpdir))
+    xyz = np.array([[0.0, 0.0, 0.0], [1.0, 0.0, 0.0]])
+    key = cache.key(xyz, '1 5', 'mm3')
+    assert cache.get(key, 0) is None
+    cache.put(key, 2, results)
+    # Same geometry within tolerance, lower derivative level
+    hit = cache.get(cache.key(xyz + 1e-8, '1 5', 'mm3'), 1)
+    assert hit['energy'] == results['energy']
+    assert np.allclose(hit['gradients'], results['gradients'])
+    assert 'hessian' not in hit
+    assert np.allclose(cache.get(key, 2)['hessian'], results['hessian'])
+    # Different types or geometries are different entries
+    assert cache.key(xyz, '1 6', 'mm3') != key
+    assert cache.get(cache.key(xyz + 1e-3, '1 5', 'mm3'), 0) is None
+    assert cache.stats() == {'hits': 2, 'misses': 2}
+    assert (cache.hits, cache.misses) == (2, 2)
+
+
+def test_result_cache_keeps_higher_level(tmpdir, results):
+    cache = ResultCache(str(tmpdir))
+    key = cache.key(np.zeros((2, 3)))
+    cache.put(key, 2, results)
+    cache.put(key, 0, {'energy': 0.0, 'dipole_moment': np.zeros(3)})
+    assert cache.get(key, 2)['energy'] == results['energy']
+
+
+def test_result_cache_eviction(tmpdir, results):
+    cache = ResultCache(str(tmpdir))
+    first = cache.put(cache.key(np.zeros((2, 3))), 2, results)
+    os.utime(first, (0, 0))  # least recently used
+    cache.max_size = 1.5 * os.path.getsize(first)
+    second = cache.put(cache.key(np.ones((2, 3))), 2, results)
+    assert not os.path.exists(first)
+    assert os.path.exists(second)
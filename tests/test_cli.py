@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+from __future__ import print_function, division, absolute_import
+import os
+import sys
+from subprocess import check_output
+
+here = os.path.abspath(os.path.dirname(__file__))
+root = os.path.dirname(here)
+moredata = os.path.join(here, 'moredata')
+prmdata = os.path.join(root, 'garleek', 'data', 'prm')
+
+
+def test_backend_import_is_lazy():
+    code = ("import sys, garleek.cli; "
+            "print(','.join(m for m in ('numpy', 'garleek._version', 'garleek.mm.tinker', "
+            "'garleek.qm.gaussian') if m in sys.modules))")
+    output = check_output([sys.executable, '-c', code], cwd=root)
+    assert not output.strip()
+
+
+def test_backend_fast_start_banner():
+    env = os.environ.copy()
+    env['GARLEEK_FAST_START'] = '1'
+    env['GARLEEK_IMPORT_BUDGET'] = '100000'
+    code = ("import garleek.cli as c; "
+            "c.backend_app = lambda **kw: None; "
+            "c.backend_app_main(['R'])")
+    output = check_output([sys.executable, '-c', code], cwd=root, env=env).decode()
+    assert 'Entering Garleek (fast start)' in output
+    assert 'Import time:' in output
+    assert 'WARNING' not in output
+
+
+def test_backend_profile(canned_tinker, monkeypatch, tmpdir):
+    import pstats
+    from garleek.cli import backend_app
+    monkeypatch.setenv('GARLEEK_SCRATCH', str(tmpdir.mkdir('scratch')))
+    monkeypatch.setenv('GARLEEK_PROFILE', str(tmpdir.join('profiles')))
+    ein = os.path.join(moredata, 'EIns', 'A_5.EIn')
+    for layer in 'RM':
+        backend_app([layer, ein, str(tmpdir.join('A_5.EOu'))],
+                    ff=os.path.join(prmdata, 'mmff.prm'))
+    base = str(tmpdir.join('profiles', 'garleek-{}-'.format(os.getppid())))
+    assert sorted(os.listdir(str(tmpdir.join('profiles')))) == [
+        os.path.basename(base) + name for name in
+        ('0001-R.alloc.txt', '0001-R.prof', '0002-M.alloc.txt', '0002-M.prof')]
+    stats = pstats.Stats(base + '0001-R.prof')
+    assert any(func[2] == 'gaussian_tinker' for func in stats.stats)
+    with open(base + '0002-M.alloc.txt') as f:
+        assert 'Traced memory' in f.read()
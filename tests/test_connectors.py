@@ -1,12 +1,14 @@
 #!/usr/bin/env python
 
 from __future__ import print_function, division, absolute_import
+import json
 import os
 import sys
 import shutil
 import re
 from contextlib import contextmanager
 from distutils.spawn import find_executable
+import tempfile
 from tempfile import mkdtemp
 from subprocess import call
 import pytest
@@ -18,9 +20,13 @@ except ImportError:
     HAS_CCLIB = False
 
 from garleek.cli import frontend_app as frontend_garleek, _extant_file_types, _extant_file_prm
+from garleek.mm import tinker
+from conftest import FakePopen, _write_hes
 
 here = os.path.abspath(os.path.dirname(__file__))
 data = os.path.join(here, 'data')
+moredata = os.path.join(here, 'moredata')
+prmdata = os.path.join(here, '..', 'garleek', 'data', 'prm')
 WORKING_DIR = os.getcwd()
 
 gaussian_exe = find_executable('g16') or find_executable('g09')  or 'g16'
@@ -120,3 +126,107 @@ def test_gaussian_tinker(directory):
             cc_calculated = cclib.ccopen(garleek_out).parse()
             assert isclose(cc_original.scfenergies[-1], cc_calculated.scfenergies[-1])
             assert np.sqrt(np.mean(np.square(cc_original.atomcoords[-1]-cc_calculated.atomcoords[-1]))) < 0.001
+
+
+def test_gaussian_tinker_hessian_modes(canned_tinker, monkeypatch, tmpdir):
+    from garleek.connectors import gaussian_tinker
+    monkeypatch.setenv('GARLEEK_SCRATCH', str(tmpdir.mkdir('scratch')))
+    matrix = np.round(np.random.RandomState(2).randn(15, 15) * 100, 4)
+    matrix = matrix + matrix.T
+    def testhess(command):
+        _write_hes(os.path.splitext(command[1])[0] + '.hes', matrix)
+        return b''
+
+    FakePopen.outputs['testhess'] = testhess
+    memmaps = []
+
+    class RecordedDiskHessian(tinker.DiskHessian):
+        def __init__(self, *args, **kwargs):
+            super(RecordedDiskHessian, self).__init__(*args, **kwargs)
+            memmaps.append(self.path)
+
+    monkeypatch.setattr(tinker, 'DiskHessian', RecordedDiskHessian)
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmpdir.mkdir('tmp')))  # $TMPDIR
+    with open(os.path.join(moredata, 'EIns', 'A_5.EIn')) as f:
+        lines = f.read().splitlines()
+    lines[0] = lines[0].replace(' 1 ', ' 2 ', 1)  # request frequencies
+    ein = tmpdir.join('A_5.EIn')
+    ein.write('\n'.join(lines) + '\n')
+    eous = []
+    for mode in ('memory', 'memmap', 'sparse'):
+        eou = str(tmpdir.join(mode + '.EOu'))
+        gaussian_tinker(['R', str(ein), eou], forcefield=os.path.join(prmdata, 'mmff.prm'),
+                        hessian_mode=mode, hessian_memory=0.001, hessian_cutoff=0)
+        with open(eou) as f:
+            eous.append(f.read())
+    assert eous[0] == eous[1] == eous[2]
+    # The memmap file lives in $TMPDIR, never in the (RAM-backed) scratch workspace
+    assert [os.path.dirname(path) for path in memmaps] == [str(tmpdir.join('tmp'))]
+    assert len(eous[0].splitlines()) == 1 + 5 + 2 + 15 + 15*16//2//3
+
+
+def test_gaussian_tinker_returns_eou(canned_tinker, monkeypatch, tmpdir):
+    from garleek.connectors import gaussian_tinker
+    monkeypatch.setenv('GARLEEK_SCRATCH', str(tmpdir.mkdir('scratch')))
+    args = ['R', os.path.join(moredata, 'EIns', 'A_5.EIn'), str(tmpdir.join('A_5.EOu'))]
+    ff = os.path.join(prmdata, 'mmff.prm')
+    eou = gaussian_tinker(args, forcefield=ff)
+    assert eou == tmpdir.join('A_5.EOu').read()
+    assert eou == gaussian_tinker(args, forcefield=ff, write_file=False)
+    assert gaussian_tinker(args, forcefield=ff, return_path=True) == args[2]
+
+
+def test_gaussian_tinker_timings(canned_tinker, monkeypatch, tmpdir):
+    from garleek.connectors import gaussian_tinker
+    monkeypatch.setenv('GARLEEK_SCRATCH', str(tmpdir.mkdir('scratch')))
+    timings = str(tmpdir.join('timings.jsonl'))
+    ein = os.path.join(moredata, 'EIns', 'A_5.EIn')
+    for path in (None, timings, timings):
+        eou, info = gaussian_tinker(['R', ein, str(tmpdir.join('A_5.EOu'))],
+                                    forcefield=os.path.join(prmdata, 'mmff.prm'),
+                                    timings=path, full_output=True)
+        assert not info['cached']
+        assert [p['program'] for p in info['processes']] == ['analyze', 'testgrad']
+        assert all(p['returncode'] == 0 for p in info['processes'])
+    with open(timings) as f:
+        records = [json.loads(line) for line in f]
+    assert len(records) == 2
+    record = records[0]
+    assert record['layer'] == 'R' and record['ein'] == 'A_5.EIn'
+    assert record['n_atoms'] == 5 and record['derivatives'] == 1
+    assert not record['cached']
+    assert set(record['phases']) == {'parse_ein', 'prepare_inputs', 'run_tinker', 'write_eou'}
+    assert sorted(p['program'] for p in record['subprocesses']) == ['analyze', 'testgrad']
+    assert all(p['wall'] >= 0 for p in record['subprocesses'])
+
+
+def test_gaussian_tinker_session(canned_tinker, monkeypatch, tmpdir):
+    from garleek import connectors, scratch
+    monkeypatch.setenv('GARLEEK_SCRATCH', str(tmpdir.mkdir('scratch')))
+    ff = os.path.join(prmdata, 'mmff.prm')
+    ein = os.path.join(moredata, 'EIns', 'A_5.EIn')
+    eou = str(tmpdir.join('A_5.EOu'))
+    timings = str(tmpdir.join('timings.jsonl'))
+    workspace = scratch.workspace(ein)
+    outputs = []
+    for layer in 'RRM':
+        connectors.gaussian_tinker([layer, ein, eou], forcefield=ff, timings=timings)
+        with open(eou) as f, open(workspace.path('tinker.xyz')) as f_xyz:
+            outputs.append((f.read(), f_xyz.read()))
+    assert outputs[0] == outputs[1] == outputs[2]
+    assert sorted(n for n in os.listdir(workspace.directory) if n.startswith('session')) == [
+        'session-M.npz', 'session-R.npz']
+    with open(timings) as f:
+        assert [json.loads(line)['reused_session'] for line in f] == [False, True, False]
+
+    # Reused sessions do not prepare the key file again...
+    def fail(*args, **kwargs):
+        raise AssertionError('key file prepared again')
+
+    monkeypatch.setattr(tinker, 'prepare_tinker_key', fail)
+    connectors.gaussian_tinker(['R', ein, eou], forcefield=ff)
+    # ...unless the options change
+    with pytest.raises(AssertionError):
+        connectors.gaussian_tinker(['R', ein, eou], forcefield=ff, tinker_keywords=['verbose'])
+    with pytest.raises(AssertionError):
+        connectors.gaussian_tinker(['M', ein, eou], forcefield=ff, session=False)
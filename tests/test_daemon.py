@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+from __future__ import print_function, division, absolute_import
+import json
+import os
+import threading
+import time
+import pytest
+
+from garleek.daemon import BackendServer
+from garleek.client import forward, stop_server, _split_args
+from garleek.mm import tinker, tinker_standin
+
+here = os.path.abspath(os.path.dirname(__file__))
+
+
+@pytest.fixture
+def server(tmpdir):
+    path = str(tmpdir.join('garleek.sock'))
+    srv = BackendServer(path, timeout=30)
+    thread = threading.Thread(target=srv.serve)
+    thread.start()
+    for _ in range(100):
+        if os.path.exists(path):
+            break
+        time.sleep(0.05)
+    yield srv
+    stop_server(path)
+    thread.join()
+
+
+def test_split_args():
+    path, stop, forwarded = _split_args(['--socket', 'x.sock', '--qm', 'gaussian', 'R', 'a.EIn'])
+    assert path == 'x.sock'
+    assert not stop
+    assert forwarded == ['--qm', 'gaussian', 'R', 'a.EIn']
+
+
+def test_no_server(tmpdir):
+    assert forward(['R'], path=str(tmpdir.join('missing.sock'))) is None
+
+
+def test_server_roundtrip(server):
+    reply = forward(['--qm', 'unknown', 'R', 'x.EIn', 'x.EOu'], path=server.path)
+    assert reply['returncode'] == 1
+    assert 'is not available' in reply['output']
+    assert server.served == 1
+
+
+def test_server_backend_call(server, tmpdir, monkeypatch):
+    from garleek.cli import backend_app
+    monkeypatch.setattr(tinker, '_tinker_executables',
+                        tinker_standin.install(str(tmpdir.join('bin'))))
+    monkeypatch.setenv('GARLEEK_SCRATCH', str(tmpdir.mkdir('scratch')))
+    monkeypatch.chdir(str(tmpdir))
+    ein = os.path.join(here, 'moredata', 'EIns', 'A_5.EIn')
+    reply = forward(['--ff', 'mmff.prm', 'R', ein, 'served.EOu'], path=server.path)
+    assert reply['returncode'] == 0, reply['output']
+    assert server.served == 1
+    backend_app(['R', ein, 'direct.EOu'], ff='mmff.prm')
+    served = tmpdir.join('served.EOu').read()
+    assert len(served.splitlines()) == 1 + 5  # energy and dipole, gradients
+    assert served == tmpdir.join('direct.EOu').read()
+
+
+def test_server_applies_client_environment(tmpdir, monkeypatch):
+    monkeypatch.setattr(tinker, '_tinker_executables', {})
+    monkeypatch.setenv('GARLEEK_TINKER_MODE', 'combined')  # server only: not applied
+    monkeypatch.delenv('GARLEEK_TIMINGS', raising=False)
+    monkeypatch.chdir(str(tmpdir))
+    env = dict(('TINKER_' + program.upper(), path) for (program, path) in
+               tinker_standin.install(str(tmpdir.join('bin'))).items())
+    env['GARLEEK_SCRATCH'] = str(tmpdir.mkdir('scratch'))
+    env['GARLEEK_TIMINGS'] = str(tmpdir.join('timings.jsonl'))
+    ein = os.path.join(here, 'moredata', 'EIns', 'A_5.EIn')
+    srv = BackendServer(str(tmpdir.join('garleek.sock')))
+    reply = srv.handle({'argv': ['--ff', 'mmff.prm', 'R', ein, 'A_5.EOu'],
+                        'cwd': str(tmpdir), 'env': env})
+    assert reply['returncode'] == 0, reply['output']
+    with open(env['GARLEEK_TIMINGS']) as f:
+        record = json.loads(f.readline())
+    assert sorted(p['program'] for p in record['subprocesses']) == ['analyze', 'testgrad']
+    # The server environment is back as it was
+    assert os.environ['GARLEEK_TINKER_MODE'] == 'combined'
+    assert 'GARLEEK_TIMINGS' not in os.environ
+    assert tinker._tinker_executables == {}
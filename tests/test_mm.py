@@ -1,29 +1,300 @@
 #!/usr/bin/env python
 
 from __future__ import print_function, division, absolute_import
+import os
+import shutil
+import sys
+import time
+from subprocess import CalledProcessError
 import pytest
+import numpy as np
+
+from garleek.mm import tinker
+from garleek.mm.tinker import (_parse_tinker_analyze, _parse_tinker_testgrad, _parse_tinker_testhess,
+                               _run_tinker_jobs, run_tinker, prepare_tinker_key,
+                               trim_tinker_prm, _trim_tinker_prm_lines, prepare_tinker_xyz,
+                               write_tinker_xyz, tinker_xyz_templates, write_tinker_xyz_templates)
+from garleek.qm.gaussian import parse_gaussian_EIn
+from conftest import FakePopen, _read, _write_hes
+
+here = os.path.abspath(os.path.dirname(__file__))
+moredata = os.path.join(here, 'moredata')
+prmdata = os.path.join(here, '..', 'garleek', 'data', 'prm')
+HAS_TINKER = all(tinker.tinker_executable(p) for p in ('analyze', 'testgrad', 'testhess'))
 
 
 def test_prepare_tinker_xyz():
     pass
 
 
-def test_prepare_tinker_inpkey():
-    pass
+def test_write_tinker_xyz(tmpdir):
+    ein = parse_gaussian_EIn(os.path.join(moredata, 'EIns', 'A_5.EIn'))
+    ein.bond_orders[0] = 0.1  # C1-H2 should be skipped
+    path = write_tinker_xyz(str(tmpdir.join('a.xyz')), ein.elements, ein.types, ein.xyz,
+                            ein.bond_indptr, ein.bond_indices, ein.bond_orders, chunk_size=2)
+    with open(path) as f:
+        written = [line.split() for line in f.read().splitlines()]
+    expected = [line.split() for line in prepare_tinker_xyz(ein['atoms'], ein['bonds']).splitlines()]
+    assert written[0] == expected[0] == ['5']
+    assert written[1][5:] == ['C_3', '3', '4', '5']
+    for new, old in zip(written[1:], expected[1:]):
+        assert new[:2] == old[:2] and new[5:] == old[5:]
+        assert np.allclose(np.array(new[2:5], dtype=float), np.array(old[2:5], dtype=float))
+
+
+def test_write_tinker_xyz_templates(tmpdir):
+    ein = parse_gaussian_EIn(os.path.join(moredata, 'EIns', 'A_5.EIn'))
+    expected = write_tinker_xyz(str(tmpdir.join('a.xyz')), ein.elements, ein.types, ein.xyz,
+                                ein.bond_indptr, ein.bond_indices, ein.bond_orders)
+    templates = tinker_xyz_templates(ein.elements, ein.types, ein.bond_indptr, ein.bond_indices,
+                                     ein.bond_orders, chunk_size=2)
+    assert len(templates) == 3
+    path = write_tinker_xyz_templates(str(tmpdir.join('b.xyz')), templates, ein.xyz, chunk_size=2)
+    with open(expected) as f_expected, open(path) as f:
+        assert f.read() == f_expected.read()
+
+
+def test_prepare_tinker_inpkey(tmpdir):
+    mm3 = os.path.join(prmdata, 'mm3.prm')
+    key = prepare_tinker_key(mm3, directory=str(tmpdir))
+    mtime = os.path.getmtime(key)
+    assert prepare_tinker_key(mm3, directory=str(tmpdir)) == key
+    assert os.path.getmtime(key) == mtime
+    with open(key) as f:
+        assert f.read() == 'parameters {}\n'.format(os.path.abspath(mm3))
+    key2 = prepare_tinker_key(mm3, extra_keywords=['digits 8'], directory=str(tmpdir))
+    assert key2 != key
+    # User key files with extra keywords are copied with absolute parameters
+    userkey = tmpdir.mkdir('user').join('custom.key')
+    shutil.copy(mm3, str(tmpdir.join('user', 'mm3.prm')))
+    userkey.write('parameters mm3.prm\nvdw 1 2.0 0.03\n')
+    assert prepare_tinker_key(str(userkey), directory=str(tmpdir)) == str(userkey)
+    key3 = prepare_tinker_key(str(userkey), extra_keywords=['digits 8'], directory=str(tmpdir))
+    with open(key3) as f:
+        lines = f.read().splitlines()
+    assert lines == ['parameters ' + str(tmpdir.join('user', 'mm3.prm')),
+                     'vdw 1 2.0 0.03', 'digits 8']
+
+
+def test_trim_tinker_prm(tmpdir):
+    mm3 = os.path.join(prmdata, 'mm3.prm')
+    trimmed = trim_tinker_prm(mm3, ['5', '1', '5'], directory=str(tmpdir))
+    assert trim_tinker_prm(mm3, [1, 5], directory=str(tmpdir)) == trimmed
+    assert len(tmpdir.listdir()) == 1
+    with open(trimmed) as f:
+        entries = [line.split() for line in f]
+    keywords = set(fields[0] for fields in entries)
+    assert set(['forcefield', 'vdwtype', 'bond-cubic']) <= keywords
+    assert set(int(fields[1]) for fields in entries if fields[0] == 'atom') == set([1, 5])
+    assert ['bond', '1', '5'] in [fields[:3] for fields in entries]
+    assert ['bond', '1', '2'] not in [fields[:3] for fields in entries]
+    assert ['strtors', '0', '1', '1', '0'] in [fields[:5] for fields in entries]
+    assert os.path.getsize(trimmed) < os.path.getsize(mm3) / 10
+
+
+def test_trim_tinker_prm_mmff(tmpdir):
+    mmff = os.path.join(prmdata, 'mmff.prm')
+    with open(trim_tinker_prm(mmff, [1, 5], directory=str(tmpdir))) as f:  # ethane
+        entries = [line.split() for line in f]
+    assert ['mmffbond', '1', '1', '4.258', '1.508', '0'] in entries
+    assert ['mmffbond', '1', '5'] in [fields[:3] for fields in entries]
+    assert ['mmffbond', '1', '2'] not in [fields[:3] for fields in entries]
+    assert ['mmffangle', '1', '1', '1'] in [fields[:4] for fields in entries]
+    assert ['mmffangle', '1', '1', '2'] not in [fields[:4] for fields in entries]
+    assert ['mmffbci', '1', '2'] not in [fields[:3] for fields in entries]
+    # Type index first: the last class is checked too
+    lines = ['atom 1 1 CR "ALKYL CARBON SP3" 6 12.000 4',
+             'mmffbond 0 1 1 4.258 1.508', 'mmffbond 0 1 2 4.539 1.482',
+             'mmffangle 1 1 1 2 0.851 109.608', 'mmfftorsion 0 0 1 1 0 0.0 0 1 0.0 180 2 0.3 0 3',
+             'mmfftorsion 0 0 1 1 2 0.0 0 1 0.0 180 2 0.3 0 3']
+    assert _trim_tinker_prm_lines(lines, [1]) == [lines[0], lines[1], lines[4]]
 
 
 def test__parse_tinker_analyze():
-    pass
+    energy, dipole = _parse_tinker_analyze(_read('epouts', 'A_5.epout'))
+    assert energy == 0.3518
+    assert np.allclose(dipole, [0, 0, 0])
+
+
+def test__parse_tinker_analyze_no_dipole():
+    lines = [line for line in _read('epouts', 'A_5.epout').decode().splitlines()
+             if 'Dipole' not in line]
+    energy, dipole = _parse_tinker_analyze(lines)
+    assert energy == 0.3518
+    assert dipole is None
+
+
+def test_run_tinker_missing_values(canned_tinker):
+    xyz = _read('xyzs', 'A_5.xyz').decode()
+    epout, gout = FakePopen.outputs['analyze'], FakePopen.outputs['testgrad']
+    FakePopen.outputs['analyze'] = b'\n'.join(line for line in epout.splitlines()
+                                              if b'Dipole' not in line)
+    with pytest.raises(ValueError) as excinfo:
+        run_tinker(xyz, 5, 'garleek.key', hessian=False)
+    assert 'Could not obtain dipole' in str(excinfo.value)
+    FakePopen.outputs['analyze'] = epout
+    FakePopen.outputs['testgrad'] = gout[:gout.index(b'Cartesian Gradient Breakdown')]
+    with pytest.raises(ValueError) as excinfo:
+        run_tinker(xyz, 5, 'garleek.key', hessian=False)
+    assert 'Could not obtain gradients' in str(excinfo.value)
 
 
 def test__parse_tinker_testgrad():
-    pass
+    energy, gradients = _parse_tinker_testgrad(_read('gouts', 'A_5.gout'))
+    assert energy == 0.3518
+    assert gradients.shape == (5, 3)
+    assert np.allclose(gradients[-1], [4.4287, 6.2594, 10.8416])
 
 
-def test__parse_tinker_testhess():
-    pass
+def test__parse_tinker_testgrad_stops_early():
+    lines = iter(_read('gouts', 'A_5.gout').decode().splitlines())
+    energy, gradients = _parse_tinker_testgrad(lines, n_atoms=5)
+    assert energy == 0.3518
+    assert np.allclose(gradients[-1], [4.4287, 6.2594, 10.8416])
+    assert next(lines).strip().startswith('Total Gradient Norm')  # not consumed
+
+
+def test__parse_tinker_testgrad_incomplete():
+    output = _read('gouts', 'A_5.gout').decode()
+    truncated = output[:output.index('Cartesian Gradient Breakdown')]
+    assert _parse_tinker_testgrad(truncated, n_atoms=5) == (0.3518, None)
+    with pytest.raises(ValueError):
+        _parse_tinker_testgrad(output, n_atoms=6)
+
+
+def test__parse_tinker_testhess(tmpdir):
+    n_atoms = 4
+    rng = np.random.RandomState(0)
+    matrix = np.round(rng.randn(3*n_atoms, 3*n_atoms) * 100, 4)
+    matrix = matrix + matrix.T
+    hesfile = str(tmpdir.join('a.hes'))
+    _write_hes(hesfile, matrix)
+    hessian = _parse_tinker_testhess(hesfile, n_atoms)
+    assert not os.path.exists(hesfile)
+    assert hessian.shape == (3*n_atoms*(3*n_atoms+1)//2,)
+    assert np.allclose(hessian, matrix[np.tril_indices(3*n_atoms)])
+
+
+def test__parse_tinker_testhess_memmap(tmpdir):
+    n_atoms = 5
+    matrix = np.round(np.random.RandomState(1).randn(3*n_atoms, 3*n_atoms) * 100, 4)
+    matrix = matrix + matrix.T
+    hesfile = str(tmpdir.join('a.hes'))
+    _write_hes(hesfile, matrix)
+    # A tiny budget forces several decoding groups and row bands
+    hessian = _parse_tinker_testhess(hesfile, n_atoms, mode='memmap', max_memory=2000,
+                                     directory=str(tmpdir.mkdir('hessian')))
+    assert os.path.dirname(hessian.path) == str(tmpdir.join('hessian'))
+    bands = list(hessian.packed_rows(scale=2.0))
+    assert len(bands) > 1
+    assert np.allclose(np.concatenate(bands), 2 * matrix[np.tril_indices(3*n_atoms)])
+    hessian.close()
+    assert not os.path.exists(hessian.path)
+
+
+@pytest.mark.skipif(sys.version_info < (3,), reason='tracemalloc not available')
+def test__parse_tinker_testhess_bounded_memory(tmpdir, monkeypatch):
+    import tracemalloc
+    n_atoms = 200
+    matrix = np.round(np.random.RandomState(3).randn(3*n_atoms, 3*n_atoms) * 100, 4)
+    matrix = matrix + matrix.T
+    hesfile = str(tmpdir.join('a.hes'))
+    _write_hes(hesfile, matrix)
+    assert os.path.getsize(hesfile) > 2 * 2**20
+    monkeypatch.setattr(tinker, 'HES_DECODE_BYTES', 256 * 2**10)
+    tracemalloc.start()
+    try:
+        hessian = _parse_tinker_testhess(hesfile, n_atoms)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert np.allclose(hessian, matrix[np.tril_indices(3*n_atoms)])
+    # Decoding the whole file at once needs several times its size
+    assert peak < hessian.nbytes + 2 * 2**20
+
+
+def test__parse_fixed_width():
+    block = (b'\n    352.8104-123456.1234      0.0001\n'
+             b'     -0.5000\n\n')
+    assert np.allclose(tinker._parse_fixed_width(block), [352.8104, -123456.1234, 0.0001, -0.5])
+    # Free-format data is left to the caller
+    assert tinker._parse_fixed_width(b'\n 1.5 -2.25 3.0\n') is None
+    assert tinker._parse_fixed_width(b'\n  0.1000000D+01\n') is None
 
 
 def test_run_tinker():
     pass
 
+
+def test__run_tinker_jobs_concurrently():
+    command = [sys.executable, '-c',
+               'import os, time; time.sleep(0.5); print(os.environ["OMP_NUM_THREADS"])']
+    jobs = [(name, command, lambda lines: int(next(iter(lines)))) for name in ('a', 'b', 'c')]
+    t0 = time.time()
+    outputs = _run_tinker_jobs(jobs, concurrency=3, threads=6)
+    assert time.time() - t0 < 1.4
+    assert sorted(outputs) == ['a', 'b', 'c']
+    assert all(parsed == 2 for (_, parsed, _) in outputs.values())
+
+
+@pytest.mark.skipif(not hasattr(os, 'wait4'), reason='os.wait4 not available')
+def test__run_tinker_job_usage():
+    from garleek.timing import TimingRecorder
+    recorder = TimingRecorder(None)
+    command = [sys.executable, '-c', 'x = bytearray(64 * 2**20); print(len(x))']
+    _, parsed, usage = tinker._run_tinker_job(command, lambda lines: int(next(iter(lines))),
+                                              name='alloc', recorder=recorder)
+    assert parsed == 64 * 2**20
+    assert usage['program'] == 'alloc' and usage['returncode'] == 0
+    assert usage['max_rss'] > 64 * 2**20
+    assert abs(usage['cpu'] - usage['user'] - usage['sys']) < 1e-9
+    assert usage['wall'] > 0
+    with pytest.raises(CalledProcessError):
+        tinker._run_tinker_job([sys.executable, '-c', 'import sys; sys.exit(3)'], list,
+                               name='fail', recorder=recorder)
+    assert [p['returncode'] for p in recorder.subprocesses] == [0, 3]
+
+
+@pytest.mark.parametrize('dipole_moment', [True, False])
+def test_run_tinker_combined_mode(canned_tinker, dipole_moment):
+    xyz = _read('xyzs', 'A_5.xyz').decode()
+    separate = run_tinker(xyz, 5, 'garleek.key', hessian=False, mode='separate')
+    assert canned_tinker == ['analyze', 'testgrad']
+    del canned_tinker[:]
+    combined = run_tinker(xyz, 5, 'garleek.key', hessian=False, mode='combined',
+                          dipole_moment=dipole_moment)
+    assert canned_tinker == (['analyze', 'testgrad'] if dipole_moment else ['testgrad'])
+    assert combined['energy'] == separate['energy']
+    assert np.allclose(combined['gradients'], separate['gradients'])
+    assert np.allclose(combined['dipole_moment'], separate['dipole_moment'])
+
+
+def test__parse_tinker_testhess_sparse(tmpdir):
+    n_atoms = 4
+    matrix = np.round(np.random.RandomState(3).randn(3*n_atoms, 3*n_atoms) * 10, 4)
+    matrix = matrix + matrix.T
+    hesfile = str(tmpdir.join('a.hes'))
+    _write_hes(hesfile, matrix)
+    hessian = _parse_tinker_testhess(hesfile, n_atoms, mode='sparse', cutoff=5.0, max_memory=2000)
+    expected = np.where((np.abs(matrix) >= 5.0) | np.eye(3*n_atoms, dtype=bool), matrix, 0)
+    assert np.allclose(np.concatenate(list(hessian.packed_rows())),
+                       expected[np.tril_indices(3*n_atoms)])
+    discarded = matrix - expected
+    assert hessian.discarded['count'] == np.count_nonzero(np.tril(discarded))
+    assert np.isclose(hessian.discarded['max'], np.abs(discarded).max())
+    assert np.isclose(hessian.discarded['norm'], np.linalg.norm(discarded))
+    assert np.isclose(hessian.discarded['relative_norm'],
+                      np.linalg.norm(discarded) / np.linalg.norm(matrix))
+    assert 'discarded' in hessian.report()
+
+
+@pytest.mark.skipif(not HAS_TINKER, reason='TINKER not available')
+def test_run_tinker_modes_match(tmpdir):
+    with tmpdir.as_cwd():
+        key = prepare_tinker_key(os.path.join(here, '..', 'garleek', 'data', 'prm', 'mmff.prm'))
+        xyz = _read('xyzs', 'A_5.xyz').decode()
+        separate = run_tinker(xyz, 5, key, hessian=False, mode='separate')
+        combined = run_tinker(xyz, 5, key, hessian=False, mode='combined')
+    assert abs(combined['energy'] - separate['energy']) < 1e-4
+    assert np.allclose(combined['gradients'], separate['gradients'])
+    assert np.allclose(combined['dipole_moment'], separate['dipole_moment'])
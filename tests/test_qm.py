@@ -1,7 +1,14 @@
 #!/usr/bin/env python
 
 from __future__ import print_function, division, absolute_import
+import os
 import pytest
+import numpy as np
+
+from garleek.qm.gaussian import parse_gaussian_EIn, prepare_gaussian_EOu, write_gaussian_EOu
+
+here = os.path.abspath(os.path.dirname(__file__))
+moredata = os.path.join(here, 'moredata')
 
 
 def test_patch_gaussian_input():
@@ -9,9 +16,92 @@ def test_patch_gaussian_input():
 
 
 def test_parse_gaussian_EIn():
-    pass
+    ein = parse_gaussian_EIn(os.path.join(moredata, 'EIns', 'A_5.EIn'))
+    assert ein['n_atoms'] == ein.n_atoms == 5
+    assert ein.xyz.shape == (5, 3)
+    assert ein.bond_indptr.shape == (6,)
+    assert ein.bond_indices.shape == ein.bond_orders.shape
+    # The dict adapter exposes the same data
+    atoms, bonds = ein['atoms'], ein['bonds']
+    assert list(atoms) == list(bonds) == [1, 2, 3, 4, 5]
+    for i, atom in atoms.items():
+        assert np.array_equal(atom['xyz'], ein.xyz[i-1])
+        assert atom['type'] == ein.types[i-1]
+        assert bonds[i] == ein.bonds_of(i)
+
+
+def test_parse_gaussian_EIn_09a(tmpdir):
+    ein_file = tmpdir.join('old.EIn')
+    ein_file.write('     3     1     0     1\n'
+                   '  6  0.0 0.0 0.0  0.1  C_3\n'
+                   '  1  0.0 0.0 2.0 -0.05 H_\n'
+                   '  1  2.0 0.0 0.0 -0.05 H_\n'
+                   ' Bond 1 x x x 1 2 1.0 3 1.0\n'
+                   ' Bond 2 x x x 2 1 1.0\n'
+                   ' Bond 3 x x x 3 1 1.0\n')
+    ein = parse_gaussian_EIn(str(ein_file), version='09a')
+    assert list(ein.types) == ['C_3', 'H_', 'H_']
+    assert ein['bonds'][1] == [(2, 1.0), (3, 1.0)]
+    assert ein['bonds'][3] == [(1, 1.0)]
+
+
+def test_parse_gaussian_EIn_wrong_version(tmpdir):
+    with pytest.raises(ValueError) as excinfo:
+        parse_gaussian_EIn(os.path.join(moredata, 'EIns', 'A_5.EIn'), version='09a')
+    assert 'Gaussian 09a' in str(excinfo.value)
+    ein_file = tmpdir.join('old.EIn')
+    ein_file.write('     2     1     0     1\n'
+                   '  6  0.0 0.0 0.0  0.1  C_3\n'
+                   '  1  0.0 0.0 2.0 -0.05 H_\n'
+                   ' Bond 1 x x x 1 2 1.0\n'
+                   ' Bond 2 x x x 2 1 1.0\n')
+    with pytest.raises(ValueError):
+        parse_gaussian_EIn(str(ein_file), version='16')
+    ein_file.write('     2     1     0     1\n'
+                   '  6  0.0 0.0 0.0  0.1  C_3\n'
+                   '  1  0.0 0.0 2.0 -0.05 H_\n'
+                   'Connectivity\n'
+                   ' 1 3 1.0\n'  # out of range
+                   ' 2\n')
+    with pytest.raises(ValueError):
+        parse_gaussian_EIn(str(ein_file))
+
+
+def test_parse_gaussian_EIn_reuses_connectivity(tmpdir):
+    path = os.path.join(moredata, 'EIns', 'A_5.EIn')
+    first = parse_gaussian_EIn(path)
+    assert first.connectivity_hash is None
+    first = parse_gaussian_EIn(path, hash_connectivity=True)
+    second = parse_gaussian_EIn(path, connectivity=first)
+    assert second.connectivity_hash == first.connectivity_hash
+    assert second.bond_indices is first.bond_indices
+    with open(path) as f:
+        lines = f.read().splitlines()
+    lines[-2] = lines[-2].replace('1.000', '2.000', 1)  # new bond order
+    changed = tmpdir.join('changed.EIn')
+    changed.write('\n'.join(lines) + '\n')
+    third = parse_gaussian_EIn(str(changed), connectivity=first)
+    assert third.connectivity_hash != first.connectivity_hash
+    assert third.bond_indices is not first.bond_indices
+    assert 2.0 in third.bond_orders
 
 
 def test_prepare_gaussian_EOu():
-    pass
+    eou = prepare_gaussian_EOu(1, -1.5, np.array([0.1, 0, 0]), gradients=np.array([[1e-5, 2, -3]]))
+    assert eou == (' -1.500000000000e+00  1.000000000000e-01  0.000000000000e+00  0.000000000000e+00\n'
+                   '  1.000000000000e-05  2.000000000000e+00 -3.000000000000e+00\n')
+
 
+def test_write_gaussian_EOu_streaming(tmpdir):
+    n_atoms = 3
+    rng = np.random.RandomState(0)
+    gradients = rng.randn(n_atoms, 3)
+    hessian = rng.randn(3*n_atoms*(3*n_atoms+1)//2)
+    expected = prepare_gaussian_EOu(n_atoms, -1.0, np.ones(3), gradients, hessian)
+    assert len(expected.splitlines()) == 1 + n_atoms + 2 + 3*n_atoms + hessian.size // 3
+    # Hessian chunks that do not fill whole rows, and tiny write blocks
+    chunks = iter(np.array_split(hessian, 7))
+    path = write_gaussian_EOu(str(tmpdir.join('x.EOu')), n_atoms, -1.0, np.ones(3),
+                              gradients, chunks, chunk_size=4)
+    with open(path) as f:
+        assert f.read() == expected
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+from __future__ import print_function, division, absolute_import
+import glob
+import json
+import os
+from garleek import scratch
+from garleek.atom_types import parse as parse_atom_types
+from garleek.qm.gaussian import parse_gaussian_EIn
+from garleek.replay import record_ein, replay_entries, translate_types, MANIFEST
+
+here = os.path.abspath(os.path.dirname(__file__))
+eins = os.path.join(here, 'moredata', 'EIns')
+prmdata = os.path.join(here, '..', 'garleek', 'data', 'prm')
+
+
+def test_replay_entries_natural_order(tmpdir):
+    for name in ('C_10.EIn', 'C_9.EIn', 'C_1.EIn', 'notes.txt'):
+        tmpdir.join(name).write('')
+    entries = replay_entries(str(tmpdir))
+    assert [os.path.basename(e['path']) for e in entries] == ['C_1.EIn', 'C_9.EIn', 'C_10.EIn']
+
+
+def test_record_ein(tmpdir):
+    source = os.path.join(eins, 'A_5.EIn')
+    for layer in 'RM':
+        record_ein(str(tmpdir), source, layer, qm_version='09a')
+    job_dir = tmpdir.join(str(os.getppid()))
+    with open(str(job_dir.join(MANIFEST))) as f:
+        manifest = [json.loads(line) for line in f]
+    assert [(e['call'], e['file'], e['layer'], e['qm_version']) for e in manifest] == \
+        [(1, '0001-R.EIn', 'R', '09a'), (2, '0002-M.EIn', 'M', '09a')]
+    assert job_dir.join('0002-M.EIn').read() == open(source).read()
+    entries = replay_entries(str(job_dir))
+    assert [(e['layer'], e['qm_version']) for e in entries] == [('R', '09a'), ('M', '09a')]
+
+
+def test_translate_types(tmpdir):
+    mapping = parse_atom_types(os.path.join(here, 'data', 'A_5', 'atom.types'))
+    translated = translate_types(os.path.join(eins, 'A_5.EIn'), str(tmpdir.join('A_5.EIn')),
+                                 mapping)
+    original = parse_gaussian_EIn(os.path.join(eins, 'A_5.EIn'))
+    ein = parse_gaussian_EIn(translated)
+    assert list(ein.types) == [mapping[t.upper()] for t in original.types]
+    assert (ein.xyz == original.xyz).all()
+    assert (ein.bond_indices == original.bond_indices).all()
+
+
+def test_record_and_replay(canned_tinker, monkeypatch, tmpdir):
+    from garleek.cli import backend_app, replay_app
+    monkeypatch.setenv('GARLEEK_SCRATCH', str(tmpdir.mkdir('scratch')))
+    records = str(tmpdir.join('records'))
+    ein = os.path.join(eins, 'A_5.EIn')
+    for layer in 'RMR':
+        backend_app([layer, ein, str(tmpdir.join('A_5.EOu'))],
+                    ff=os.path.join(prmdata, 'mmff.prm'), record=records)
+    job_dir = os.path.join(records, str(os.getppid()))
+    assert sorted(os.listdir(job_dir)) == ['0001-R.EIn', '0002-M.EIn', '0003-R.EIn',
+                                           'manifest.jsonl']
+    del canned_tinker[:]
+
+    def live_scratch():
+        return sorted((path, os.path.getmtime(path)) for path in
+                      glob.glob(str(tmpdir.join('scratch', '*', '*'))))
+
+    before = live_scratch()
+    summary = json.loads(replay_app(job_dir, repeat=2, warmup=1, json=True,
+                                    backend_kwargs={'ff': os.path.join(prmdata, 'mmff.prm')}))
+    # Replays have their own scratch workspaces, removed afterwards
+    assert live_scratch() == before and before
+    assert os.environ['GARLEEK_SCRATCH'] == str(tmpdir.join('scratch'))
+    assert not any('garleek-replay-' in root for (root, _) in scratch._workspaces)
+    assert canned_tinker == ['analyze', 'testgrad'] * 7
+    assert summary['inputs'] == 3 and summary['calls'] == 6
+    assert summary['latency']['count'] == 6
+    assert summary['latency']['p50'] <= summary['latency']['p99'] <= summary['latency']['max']
+    assert summary['phases']['run_tinker']['count'] == 6
+    assert summary['programs']['testgrad']['count'] == 6
+    assert sorted(os.listdir(job_dir)) == ['0001-R.EIn', '0002-M.EIn', '0003-R.EIn',
+                                           'manifest.jsonl']
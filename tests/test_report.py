@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+from __future__ import print_function, division, absolute_import
+import json
+import os
+from garleek.cli import report_app
+from garleek.report import parse_gaussian_log, build_report
+
+
+here = os.path.abspath(os.path.dirname(__file__))
+A_3 = os.path.join(here, 'data', 'A_3', 'A_3.out')
+
+
+def _write_timings(path, n, job=4967):
+    with open(path, 'w') as f:
+        for i in range(n):
+            f.write(json.dumps({'time': 1000.0 + i, 'job': job, 'layer': 'RM'[i % 2],
+                                'n_atoms': 11, 'derivatives': 1, 'wall': 1.0 + 0.1 * i,
+                                'phases': {'run_tinker': {'wall': 0.5 + 0.1 * i, 'cpu': 0.1}},
+                                'subprocesses': [{'program': 'testgrad',
+                                                  'wall': 0.4 + 0.1 * i, 'cpu': 0.3}]}) + '\n')
+        f.write('{"truncated": \n')  # killed job
+
+
+def test_parse_gaussian_log():
+    log = parse_gaussian_log(A_3)
+    assert log['job'] == 4967
+    assert log['normal_termination']
+    assert log['wall'] == 32  # 16:24:51 to 16:25:23
+    assert abs(log['cpu'] - 198.1) < 1e-6
+    assert [c['layer'] for c in log['calls']] == ['R', 'M'] * 4
+    assert [c['step'] for c in log['calls']] == ['1', '1', '2', '2', '3', '3', '4', '4']
+    assert log['calls'][0]['ein'] == 'Gau-4967.EIn'
+    assert log['calls'][0]['wall'] == 3
+    assert [s['label'] for s in log['steps']] == ['1', '2', '3', '4']
+
+
+def test_build_report(tmpdir):
+    timings = str(tmpdir.join('timings.jsonl'))
+    _write_timings(timings, 8)
+    with open(timings, 'a') as f:  # another job sharing the file
+        f.write(json.dumps({'time': 1.0, 'job': 1, 'wall': 100.0}) + '\n')
+    report = build_report(A_3, timings, top=3)
+    assert report['calls'] == 8
+    assert abs(report['mm_wall'] - 10.8) < 1e-9
+    assert abs(report['mm_share'] - 10.8 / 32) < 1e-9
+    assert report['programs']['testgrad']['calls'] == 8
+    assert [s['calls'] for s in report['steps']] == [2, 2, 2, 2]
+    assert abs(report['steps'][0]['mm'] - 2.1) < 1e-9
+    assert [round(c['wall'], 6) for c in report['slowest']] == [1.7, 1.6, 1.5]
+    assert abs(report['trends']['mm']['slope'] - 0.4) < 1e-9
+    assert not report['notes']
+    text = report_app(A_3, timings)
+    for section in ('Per step', 'Slowest MM calls', 'TINKER programs', 'Trends'):
+        assert section in text
+
+
+def test_build_report_partial(tmpdir):
+    report = build_report(A_3)
+    assert report['mm_wall'] == sum(c['wall'] for c in parse_gaussian_log(A_3)['calls'])
+    assert not report['programs']
+    timings = str(tmpdir.join('timings.jsonl'))
+    _write_timings(timings, 6)
+    report = build_report(A_3, timings)
+    assert report['notes']
+    report = json.loads(report_app(timings=timings, json=True))
+    assert report['calls'] == 6 and report['steps'] == []
@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+
+from __future__ import print_function, division, absolute_import
+import os
+from subprocess import Popen
+import sys
+
+from garleek import scratch
+
+
+def test_job_id():
+    assert scratch.job_id('/scratch/Gau-12345.EIn') == 12345
+    assert scratch.job_id('input.EIn') == os.getppid()
+
+
+def test_workspace_reuse_and_garbage_collection(tmpdir, monkeypatch):
+    monkeypatch.setenv('GARLEEK_SCRATCH', str(tmpdir))
+    ws = scratch.workspace('Gau-{}.EIn'.format(os.getpid()))
+    assert scratch.workspace('Gau-{}.EIn'.format(os.getpid())) is ws
+    assert os.path.dirname(ws.path('tinker.xyz')) == ws.directory
+    # A workspace whose job has finished
+    dead = Popen([sys.executable, '-c', 'pass'])
+    dead.wait()
+    stale = scratch.Workspace(dead.pid)
+    open(stale.path('tinker.xyz'), 'w').close()
+    assert scratch.collect_garbage() == [stale.directory]
+    assert os.path.isdir(ws.directory)
+    ws.cleanup()
+    assert not os.path.exists(ws.directory)
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+
+from __future__ import print_function, division, absolute_import
+import os
+import sys
+import pytest
+
+from garleek.atom_types import parse as parse_atom_types
+from garleek.qm.gaussian import GaussianPatcher, parse_gaussian_EIn, supported_versions
+
+here = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'benchmarks'))
+import synthetic  # noqa
+
+
+@pytest.mark.parametrize('kind', synthetic.KINDS)
+def test_synthetic_ein_all_versions(tmpdir, kind):
+    system = synthetic.build_system(300, kind=kind)
+    n_atoms, n_bonds = len(system['xyz']), len(system['bonds'])
+    for version in supported_versions:
+        path = synthetic.write_ein(str(tmpdir.join(version + '.EIn')), system, version)
+        ein = parse_gaussian_EIn(path, version=version)
+        assert ein.n_atoms == n_atoms
+        assert ein.has_bonds
+        # every bond is listed from both of its atoms
+        assert ein.bond_indices.size == 2 * n_bonds
+        assert ein.bond_indptr[-1] == 2 * n_bonds
+        assert list(ein.types) == list(system['mm_types'])
+
+
+def test_synthetic_gaussian_input(tmpdir):
+    system = synthetic.build_system(100)
+    paths = synthetic.write_system(str(tmpdir), 100)
+    patched = GaussianPatcher(paths['input'], parse_atom_types(paths['types'])).patch()
+    assert patched.count('garleek-backend') == 1
+    assert sum(1 for line in patched.splitlines() if '(PDBName=' in line) == len(system['xyz'])
+    assert len(system['links']) == 1
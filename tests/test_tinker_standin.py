@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+from __future__ import print_function, division, absolute_import
+import os
+from subprocess import CalledProcessError
+import numpy as np
+import pytest
+
+from garleek.mm import tinker, tinker_standin
+from garleek.mm.tinker import write_tinker_xyz, run_tinker
+from garleek.qm.gaussian import parse_gaussian_EIn
+
+here = os.path.abspath(os.path.dirname(__file__))
+ein_path = os.path.join(here, 'moredata', 'EIns', 'C_1.EIn')
+
+
+@pytest.fixture
+def standin(tmpdir, monkeypatch):
+    """
+    Use the TINKER stand-in, and return the XYZ and key files for C_1
+    """
+    paths = tinker_standin.install(str(tmpdir.join('bin')))
+    monkeypatch.setattr(tinker, '_tinker_executables', paths)
+    ein = parse_gaussian_EIn(ein_path)
+    xyz = write_tinker_xyz(str(tmpdir.join('C_1.xyz')), ein.elements, ein.types, ein.xyz,
+                           ein.bond_indptr, ein.bond_indices, ein.bond_orders)
+    key = tmpdir.join('C_1.key')
+    key.write('parameters none\n')
+    return xyz, str(key), ein['n_atoms']
+
+
+def test_standin_matches_model(standin, monkeypatch):
+    xyz_file, key, n_atoms = standin
+    monkeypatch.setenv('GARLEEK_STANDIN_STARTUP', '0.05')  # .hes written late
+    results = run_tinker(None, n_atoms, key, xyz_file=xyz_file, mode='separate')
+    xyz, types, bonds = tinker_standin.read_tinker_xyz(xyz_file)
+    energy, gradients, dipole = tinker_standin.model(xyz, types, bonds)
+    assert len(bonds) > 0
+    assert abs(results['energy'] - energy) < 1e-4
+    assert np.allclose(results['gradients'], gradients, atol=1e-4)
+    assert np.allclose(results['dipole_moment'], dipole, atol=1e-3)
+    assert not os.path.exists(os.path.splitext(xyz_file)[0] + '.hes')
+    # Packed lower triangle of the Hessian vs finite differences of the gradients
+    size = 3 * n_atoms
+    hessian = np.zeros((size, size))
+    hessian[np.tril_indices(size)] = results['hessian']
+    numerical = np.empty((size, size))
+    for i in range(size):
+        shifted = xyz.copy()
+        shifted.flat[i] += 1e-5
+        numerical[:, i] = (tinker_standin.model(shifted, types, bonds)[1].ravel()
+                           - gradients.ravel()) / 1e-5
+    assert np.allclose(np.tril(numerical), hessian, atol=0.05)
+    assert [p['program'] for p in results['processes']] == ['analyze', 'testgrad', 'testhess']
+    assert all(p['wall'] >= 0.05 for p in results['processes'])
+
+
+def test_standin_combined_mode_and_cost(standin, monkeypatch):
+    xyz_file, key, n_atoms = standin
+    monkeypatch.setenv('GARLEEK_STANDIN_PER_ATOM', '0.01')
+    separate = run_tinker(None, n_atoms, key, hessian=False, xyz_file=xyz_file)
+    combined = run_tinker(None, n_atoms, key, hessian=False, xyz_file=xyz_file,
+                          mode='combined', dipole_moment=False)
+    assert abs(combined['energy'] - separate['energy']) < 1e-4
+    assert np.allclose(combined['gradients'], separate['gradients'])
+    assert [p['program'] for p in combined['processes']] == ['testgrad']
+    assert combined['processes'][0]['wall'] >= 0.01 * n_atoms
+
+
+def test_standin_missing_file(tmpdir):
+    output = tmpdir.join('out')
+    with open(str(output), 'w') as f:
+        assert tinker_standin.run('analyze', [str(tmpdir.join('missing.xyz'))], f) == 1
+
+
+def test_standin_failing_testhess(standin, tmpdir):
+    xyz_file, key, n_atoms = standin
+    missing = str(tmpdir.join('missing.xyz'))
+    with pytest.raises(CalledProcessError) as excinfo:
+        run_tinker(None, n_atoms, key, energy=False, dipole_moment=False, gradients=False,
+                   xyz_file=missing)
+    assert b'Unable to Find' in excinfo.value.output
+
+
+def test_standin_banded_hessian(standin, monkeypatch):
+    xyz_file, key, n_atoms = standin
+    size = 3 * n_atoms
+    packed = {}
+    for setting in ('bonds', 'band:2'):
+        monkeypatch.setenv('GARLEEK_STANDIN_HESSIAN', setting)
+        results = run_tinker(None, n_atoms, key, energy=False, dipole_moment=False,
+                             gradients=False, xyz_file=xyz_file, hessian_mode='sparse')
+        hessian = np.concatenate(list(results['hessian'].packed_rows()))
+        packed[setting] = np.zeros((size, size))
+        packed[setting][np.tril_indices(size)] = hessian
+    band = packed['band:2'] - packed['bonds']
+    assert np.allclose(band[3:6, 0:3], tinker_standin.BAND_K)  # atoms 1-2
+    assert np.allclose(band[6:9, 0:3], tinker_standin.BAND_K / 2)  # atoms 1-3
+    assert not band[9:, 0:3].any() and not band[12:, 3:6].any()
+    monkeypatch.setenv('GARLEEK_STANDIN_HESSIAN', 'dense')
+    with pytest.raises(ValueError):
+        tinker_standin.hessian_band()